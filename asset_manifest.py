@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Asset manifest: every trait PNG of the assets folder, found in a single pass and shared by all modules
+#
+# Each layer folder is scanned once per process with os.scandir. Its PNGs are mapped by their trait name ('Title Style')
+# to their filename, size, modification time and SHA-256. The manifest is saved into MANIFEST_PATH so the following runs
+# only hash the PNGs whose size or modification time changed, which makes startup near-instant on large asset trees.
+#
+# File layout (JSON):
+#
+#   {
+#       'version': MANIFEST_VERSION,
+#       'layers': {
+#           'directory_1': {'Trait Name 1': {'filename', 'size', 'mtime_ns', 'sha256'}, ...}
+#           ...
+#       }
+#   }
+#
+# Layers are keyed by their folder (relative to ASSETS_DIR), and their traits are in the order of their filenames.
+# Run this file to scan the assets and print a summary of the manifest:
+#
+#   python asset_manifest.py
+
+import os
+import json
+import hashlib
+
+from checkpoint import write_atomic
+from config import CONFIG, ASSETS_DIR
+
+####################################################################################
+
+# GLOBALS
+
+MANIFEST_PATH = os.path.join('output', 'assets_manifest.json')
+MANIFEST_VERSION = 1
+
+# The manifest of this process, scanned on first use (see get_asset_manifest)
+MANIFEST = None
+
+####################################################################################
+#
+# HELPER FUNCTIONS
+#
+#------------------------------------------------------------------------------------
+# Public Helper Funcions:
+#
+
+# Check if a filename can be a trait's: a PNG, and only visible ones
+def is_trait_filename(trait_filename):
+    return trait_filename.endswith('.png') and trait_filename[0] != '.'
+
+
+# Remove the '.png' extension from trait filenames if they have
+def fix_trait(trait):
+
+    if trait.endswith('.png'):
+        trait = trait[:-4]
+
+    # No traits should be named as "none.png" since 'none' is reserved for trait's absence
+    if trait.lower() == 'none':
+        raise ValueError("Not allowed 'none.png', 'None.png', 'NONE.png', etc. filenames for traits.")
+
+    return trait
+
+
+# Re-style name to "A Title Style", but keep the upparcase words intact
+def title_style(name):
+    words = name.split()
+    idxs = [i for i, tr in  enumerate(words) if tr.isupper()]
+    name = name.title()
+    words = name.split()
+    for i in idxs:
+        words[i] = words[i].upper()
+    name = ' '.join(words)
+    return name
+
+
+# Get the SHA-256 of a file
+def get_file_hash(path):
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+#------------------------------------------------------------------------------------
+# Private Helper Funcions:
+#
+
+# Scan a layer folder (relative to ASSETS_DIR) in a single pass. Return its traits
+# PNGs whose size and modification time match the 'previous' scan of the folder keep their hash
+def scan_layer(directory, previous):
+
+    layer_path = os.path.join(ASSETS_DIR, directory)
+
+    with os.scandir(layer_path) as entries:
+        files = sorted((entry.name, entry.stat()) for entry in entries \
+                        if is_trait_filename(entry.name) and entry.is_file())
+
+    known = {entry['filename']: entry for entry in previous.values()}
+
+    traits = {}
+    for filename, stat in files:
+
+        # Reject 'none.png', 'None.png', 'NONE.png', etc
+        try:
+            trait = title_style(fix_trait(filename))
+        except ValueError as e:
+            raise ValueError("%s One found in folder '%s'" % (str(e), layer_path))
+
+        entry = known.get(filename)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {
+                'filename': filename,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'sha256': get_file_hash(os.path.join(layer_path, filename))
+            }
+
+        traits[trait] = entry
+
+    return traits
+
+
+# Load a saved manifest. Return None if there's none (or it's of another version)
+def load_asset_manifest(path=MANIFEST_PATH):
+
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except ValueError:
+        return None
+
+    return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+
+# Save a manifest into a file (atomically)
+def save_asset_manifest(manifest, path=MANIFEST_PATH):
+
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    def write(temp_path):
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+    write_atomic(path, write)
+
+
+# ======================================================================================
+#       PUBLIC
+# ======================================================================================
+
+# Scan the layer folders of CONFIG again, re-using the hashes of the saved manifest, and save it if anything changed
+# Return the new manifest, which this process uses from now on
+def refresh_asset_manifest(path=MANIFEST_PATH):
+
+    global MANIFEST
+
+    saved = load_asset_manifest(path)
+    previous = saved['layers'] if saved is not None else {}
+
+    manifest = {'version': MANIFEST_VERSION, 'layers': {}}
+    for layer in CONFIG:
+        directory = layer['directory']
+        if directory not in manifest['layers']:
+            manifest['layers'][directory] = scan_layer(directory, previous.get(directory, {}))
+
+    if manifest != saved:
+        save_asset_manifest(manifest, path)
+
+    MANIFEST = manifest
+    return manifest
+
+
+# Get the manifest of the assets, scanning them on first use in this process
+def get_asset_manifest():
+
+    if MANIFEST is None:
+        refresh_asset_manifest()
+
+    return MANIFEST
+
+
+# Get the traits of a CONFIG layer: {'Trait Name': {'filename', 'size', 'mtime_ns', 'sha256'}}, in filename order
+def get_layer_traits(layer):
+    return get_asset_manifest()['layers'][layer['directory']]
+
+
+# Get the PNG filenames of a CONFIG layer's traits: {'Trait Name': 'trait name.png'}, in filename order
+def get_trait_files(layer):
+    return {trait: entry['filename'] for trait, entry in get_layer_traits(layer).items()}
+
+
+# Get the paths (relative to ASSETS_DIR) of a CONFIG layer's trait PNGs, in filename order
+def get_trait_paths(layer):
+    return [os.path.join(layer['directory'], entry['filename']) for entry in get_layer_traits(layer).values()]
+
+
+# Get the hash of every trait of CONFIG: {layer name: {'Trait Name': SHA-256}}. Editions record them when rendered
+def get_asset_hashes():
+    return {
+        layer['name']: {trait: entry['sha256'] for trait, entry in get_layer_traits(layer).items()} for layer in CONFIG
+    }
+
+
+# Get the traits whose PNG changed (or is gone) since their hashes were recorded: {layer name: set of trait names}
+def get_changed_traits(recorded):
+
+    current = get_asset_hashes()
+    return {
+        name: {trait for trait, sha in traits.items() if current.get(name, {}).get(trait) != sha} \
+            for name, traits in recorded.items()
+    }
+
+
+# Main function: scan the assets and print how many traits each layer has
+def main():
+
+    saved = load_asset_manifest()
+    manifest = refresh_asset_manifest()
+
+    for layer in CONFIG:
+        traits = get_layer_traits(layer)
+        print("  %-20s %6i traits %10s MB" % (
+            layer['name'],
+            len(traits),
+            "{:.2f}".format(sum(entry['size'] for entry in traits.values()) / 2**20)
+        ))
+
+    print("Asset manifest %s: '%s'." % ('unchanged' if manifest == saved else 'updated', MANIFEST_PATH))
+
+
+# Run the main function
+if __name__ == '__main__':
+    main()
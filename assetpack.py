@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Asset pack: every trait of CONFIG decoded once into a single binary file that render processes map into memory
+#
+# Decoding the trait PNGs is done once for all runs, and since the pack is mapped read-only, the operating system
+# shares its pages between all render workers instead of each one holding a private copy of the decoded layers.
+#
+# File layout:
+#
+#   b'NFTPACK1'     magic
+#   8 bytes         length of the index (little endian)
+#   index           JSON: the pack's traits, keyed by layer name and trait name ('Title Style'), with the source PNG's
+#                   path, size, modification time and SHA-256, plus where its pixels are in the file
+#   pixels          raw decoded pixels of each trait, one after another (each one aligned to PACK_ALIGN bytes)
+#
+# Upper layers are stored in 'RGBA' mode, ready to be pasted with their own alpha, and cropped to the bounding box of
+# their non transparent pixels ('box'), as render_cache.get_upper_layer does. The first layer (background) is kept whole,
+# in its original mode, as render_cache.get_layer does. Pixels are stored straight (not premultiplied by their alpha),
+# exactly as PIL pastes them, so the avatars are pixel-identical to the ones composited from the PNGs.
+#
+# The pack is rebuilt whenever a trait is added, removed or changed. Run this file to build it beforehand
+# ('--force' rebuilds it even if it's up to date):
+#
+#   python assetpack.py [--force]
+
+import os
+import sys
+import json
+import mmap
+from PIL import Image
+
+from asset_manifest import get_layer_traits
+from checkpoint import write_atomic
+from config import CONFIG, ASSETS_DIR
+
+####################################################################################
+
+# GLOBALS
+
+PACK_PATH = os.path.join('output', 'assets.pack')
+PACK_MAGIC = b'NFTPACK1'
+PACK_VERSION = 2
+PACK_ALIGN = 64
+
+# Modes of the layers that can be packed: their raw pixels are enough to rebuild the image
+PACK_MODES = ('RGB', 'RGBA')
+
+# The pack mapped by this process, opened on first use (see get_packed_layer):
+#   {'map': mmap, 'start': offset of the pixels, 'layers': {(PNG path relative to ASSETS_DIR, mode): index entry}}
+# It's an empty dictionary if there's no up to date pack to map
+PACK = None
+
+####################################################################################
+#
+# HELPER FUNCTIONS
+#
+#------------------------------------------------------------------------------------
+
+# Get the trait PNGs of CONFIG as (layer, trait name, PNG path relative to ASSETS_DIR, asset manifest entry) tuples
+def list_sources():
+    return [
+        (layer, trait, os.path.join(layer['directory'], asset['filename']), asset) \
+            for layer in CONFIG for trait, asset in get_layer_traits(layer).items()
+    ]
+
+
+# Get the bounding box of an image's non transparent pixels: (left, upper, right, lower). (0, 0, 0, 0) if there's none
+def get_alpha_box(img):
+
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+
+    return img.getchannel('A').getbbox() or (0, 0, 0, 0)
+
+
+# Get the offset of the pixels within a pack, given the length of its index
+def get_pixels_start(header_length):
+    return -(-(len(PACK_MAGIC) + 8 + header_length) // PACK_ALIGN) * PACK_ALIGN
+
+
+# Read the index of a pack, along with the offset of its pixels ('start'). Return None if there's no valid pack
+def read_index(path=PACK_PATH):
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, 'rb') as f:
+        if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+            return None
+
+        header_length = int.from_bytes(f.read(8), 'little')
+        index = json.loads(f.read(header_length))
+
+    if index.get('version') != PACK_VERSION:
+        return None
+
+    index['start'] = get_pixels_start(header_length)
+    return index
+
+
+# Check that a pack's index matches the current trait PNGs. Return the reason why it doesn't, or None if it's up to date
+def get_stale_reason(index):
+
+    if index is None:
+        return "there's no asset pack yet"
+
+    packed = {entry['path']: entry for traits in index['layers'].values() for entry in traits.values()}
+    sources = list_sources()
+
+    if set(packed) != set(path for _, _, path, _ in sources) or \
+        list(index['layers']) != [layer['name'] for layer in CONFIG]:
+        return "traits have been added, removed or moved"
+
+    # The asset manifest has the current hash of every PNG: none of them is read here
+    for _, _, path, asset in sources:
+        if asset['sha256'] != packed[path]['sha256']:
+            return "'%s' has changed" % path
+
+    return None
+
+
+# ======================================================================================
+#       PUBLIC
+# ======================================================================================
+
+# Build the asset pack from all trait PNGs of CONFIG
+def build_asset_pack(path=PACK_PATH):
+
+    index = {'version': PACK_VERSION, 'layers': {layer['name']: {} for layer in CONFIG}}
+    packed = []
+    offset = 0
+
+    # Room is made for each trait beforehand, so pixels are decoded again (one trait at a time) while writing
+    for layer, trait, filepath, asset in list_sources():
+        source = os.path.join(ASSETS_DIR, filepath)
+
+        # Same modes as render_cache: the background whole and as is, the upper layers in 'RGBA' and cropped
+        mode = None if layer is CONFIG[0] else 'RGBA'
+        with Image.open(source) as img:
+            image_mode = img.mode if mode is None else mode
+            box = None
+            if mode is not None:
+                box = list(get_alpha_box(img))
+                width, height = box[2] - box[0], box[3] - box[1]
+            else:
+                width, height = img.size
+
+        entry = {
+            'path': filepath,
+            'size': asset['size'],
+            'mtime_ns': asset['mtime_ns'],
+            'sha256': asset['sha256'],
+            'mode': mode,
+            'image_mode': image_mode,
+            'box': box,
+            'width': width,
+            'height': height,
+            'offset': None,
+        }
+
+        # Layers in other modes (e.g. palette backgrounds) are still decoded from their PNG
+        if image_mode in PACK_MODES:
+            entry['offset'] = offset
+            entry['nbytes'] = width * height * len(image_mode)
+            offset += -(-entry['nbytes'] // PACK_ALIGN) * PACK_ALIGN
+            packed.append(entry)
+
+        index['layers'][layer['name']][trait] = entry
+
+    # Pixel offsets are relative to the (aligned) end of the index
+    header = json.dumps(index).encode()
+    start = get_pixels_start(len(header))
+
+    def write(temp_path):
+        with open(temp_path, 'wb') as f:
+            f.write(PACK_MAGIC + len(header).to_bytes(8, 'little') + header)
+            f.write(b'\0' * (start - f.tell()))
+
+            for entry in packed:
+                with Image.open(os.path.join(ASSETS_DIR, entry['path'])) as img:
+                    img.load()
+                    if img.mode != entry['image_mode']:
+                        img = img.convert(entry['image_mode'])
+
+                if entry['box'] is not None:
+                    img = img.crop(entry['box'])
+
+                f.write(img.tobytes())
+                f.write(b'\0' * (-entry['nbytes'] % PACK_ALIGN))
+
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    # Processes that mapped the previous pack keep reading it: the new one replaces it under its name
+    write_atomic(path, write)
+
+    return index
+
+
+# Make sure the asset pack is up to date, re-building it if needed
+def update_asset_pack(path=PACK_PATH):
+
+    reason = get_stale_reason(read_index(path))
+    if reason is None:
+        print("The asset pack is up to date.")
+        return
+
+    print("Building the asset pack (%s)..." % reason)
+    index = build_asset_pack(path)
+    print("...%i traits packed into '%s' (%s MB)." % (
+        sum(len(traits) for traits in index['layers'].values()),
+        path,
+        "{:.2f}".format(os.path.getsize(path) / 2**20)
+    ))
+
+
+# Get a trait's decoded image from the asset pack, given its PNG path (relative to ASSETS_DIR) and the mode it's used in
+# Return (box, image): 'box' is where the image goes on the canvas if it's cropped (see render_cache.get_upper_layer),
+# None otherwise. Return None if it's not in the pack, or there's no up to date pack to map
+def get_packed_layer(filepath, mode=None):
+
+    global PACK
+
+    # Map the pack on first use. A stale pack is never used: its traits are decoded from the PNGs instead
+    if PACK is None:
+        PACK = {}
+        index = read_index()
+        if index is not None and get_stale_reason(index) is None:
+            with open(PACK_PATH, 'rb') as f:
+                PACK['map'] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            PACK['start'] = index['start']
+            PACK['layers'] = {
+                (entry['path'], entry['mode']): entry \
+                    for traits in index['layers'].values() for entry in traits.values() if entry['offset'] is not None
+            }
+
+    entry = PACK.get('layers', {}).get((filepath, mode))
+    if entry is None:
+        return None
+
+    box = None if entry['box'] is None else tuple(entry['box'])
+    size = (entry['width'], entry['height'])
+
+    # Fully transparent layers have nothing to read
+    if entry['nbytes'] == 0:
+        return box, Image.new(entry['image_mode'], size)
+
+    # The image reads the mapped pixels in place ('RGBA' layers are not even copied)
+    start = PACK['start'] + entry['offset']
+    buffer = memoryview(PACK['map'])[start:start + entry['nbytes']]
+    return box, Image.frombuffer(entry['image_mode'], size, buffer, 'raw', entry['image_mode'], 0, 1)
+
+
+# Main function: build (or refresh) the asset pack
+def main():
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--force':
+        print("Building the asset pack...")
+        build_asset_pack()
+        print("...done.")
+    else:
+        update_asset_pack()
+
+
+# Run the main function
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Headless batch runner: generates several editions back-to-back in a single process, never asking anything
+#
+#   python batch.py job.json
+#
+# Assets, rarity weights, restrictions and the valid space are set up once, and the decoded layers (and the render
+# worker processes) are re-used from edition to edition. The job spec is a JSON file like this one:
+#
+#   {
+#       "seed": 7,
+#       "warnings": {"collisions": "continue", "all_none": "abort", "new_csvs": "continue", "low_acceptance": "abort"},
+#       "stop_on_error": false,
+#       "report": "output/batch_report.json",
+#       "editions": [
+#           {"name": "1", "count": 1000, "seed": 1, "metadata": true},
+#           {"name": "2", "count": 5000, "resume": "auto"}
+#       ]
+#   }
+#
+#   "seed":             master seed of the 'random' rarity weights, and of the editions without a seed. SEED by default
+#   "warnings":         policy of the warnings that would ask whether to continue: "continue" or "abort" (the default)
+#   "stop_on_error":    skip the remaining editions once one fails. False by default
+#   "report":           JSON file where the results of all editions are written, with their time per stage. Optional
+#
+# Per edition:
+#
+#   "name":             the edition's name, as asked by nft.py. Required
+#   "count":            number of avatars. Required unless an unfinished job of the edition is resumed
+#   "seed":             seed of the edition's trait table. By default, it's derived from the job's seed and the edition's
+#                       position in the job. Either way, it's recorded in the edition's render manifest: nft.py with that
+#                       SEED draws the same trait table (as long as the rarity weights are the same, e.g. not 'random')
+#   "resume":           "auto" resumes an unfinished job of the edition if there's one (the default), true requires it,
+#                       false always starts over
+#   "metadata":         also write the JSON metadata, along with the images (see metadata.py). FUSED_METADATA by default
+#
+# Exit codes: 0 if all editions are complete, 1 if any edition failed, 2 if the job spec is invalid or the setup aborted
+
+import os
+import sys
+import json
+import time
+import traceback
+import numpy as np
+
+import nft
+import restriction_code
+from checkpoint import load_manifest, load_render_report
+
+####################################################################################
+
+# GLOBALS
+
+# Warnings that may ask whether to continue (see restriction_code.WARNING_POLICIES)
+WARNINGS = ('collisions', 'all_none', 'new_csvs', 'low_acceptance')
+
+####################################################################################
+#
+# HELPER FUNCTIONS
+#
+#------------------------------------------------------------------------------------
+
+# Load the job spec and make sure it's valid
+def load_job(job_path):
+
+    with open(job_path) as f:
+        job = json.load(f)
+
+    if type(job) is not dict or type(job.get('editions')) is not list or not job['editions']:
+        raise ValueError("The job spec must be an object with a non empty list of 'editions'")
+
+    for warning, policy in job.get('warnings', {}).items():
+        if warning not in WARNINGS:
+            raise ValueError("Unknown warning '%s'. Expected one of: %s" % (warning, ', '.join(WARNINGS)))
+        if policy not in ('continue', 'abort'):
+            raise ValueError("Policy of warning '%s' must be 'continue' or 'abort', not '%s'" % (warning, policy))
+
+    names = set()
+    for edition in job['editions']:
+
+        if type(edition) is not dict or 'name' not in edition:
+            raise ValueError("Every edition must be an object with a 'name'")
+
+        if str(edition['name']) in names:
+            raise ValueError("Edition '%s' is listed twice" % edition['name'])
+        names.add(str(edition['name']))
+
+        if 'count' in edition and not (type(edition['count']) is int and edition['count'] > 0):
+            raise ValueError("Edition '%s': 'count' must be an integer greater than 0" % edition['name'])
+
+        if edition.get('resume', 'auto') not in ('auto', True, False):
+            raise ValueError("Edition '%s': 'resume' must be \"auto\", true or false" % edition['name'])
+
+    return job
+
+
+# Check if an edition has an unfinished job that can be resumed
+def has_unfinished_job(edition_name):
+
+    manifest = load_manifest(os.path.join('output', 'edition ' + str(edition_name)))
+
+    return manifest is not None and manifest['status'] != 'complete' and \
+        manifest['layers'] == [layer['name'] for layer in nft.CONFIG]
+
+
+# Get the seed of an edition's trait table: its own, or a child of the job's seed for its position (index) in the job
+# Editions never depend on the ones before them, so each one is reproduced by its own seed
+def get_edition_seed(edition, index, job_seed):
+
+    if 'seed' in edition:
+        return edition['seed']
+
+    return int(np.random.SeedSequence(job_seed, spawn_key=(index,)).generate_state(1, np.uint64)[0])
+
+
+# Get how long the main stages of an edition's last render run took (see metrics.py): {'sampling', 'render'} in seconds
+# A resumed edition has no sampling stage: its trait table was already drawn
+def get_stage_timings(name):
+
+    report = load_render_report(os.path.join('output', 'edition ' + name))
+    if report is None or not report.get('runs'):
+        return {}
+
+    stages = report['runs'][-1]['stages']
+    return {stage: stages[stage]['seconds'] for stage in ('sampling', 'render') if stage in stages}
+
+
+# Generate a single edition of the job. Return its result: status, timings (in seconds) and error if any
+# Timings are the 'total', and its 'sampling', 'render' and 'metadata' (writing metadata.csv) stages
+def run_edition(edition, seed):
+
+    name = str(edition['name'])
+    result = {'name': name, 'status': 'failed', 'count': None, 'timings': {}, 'error': None}
+    init_time = time.time()
+
+    try:
+        # Decide whether to resume an unfinished job of this edition
+        resume = edition.get('resume', 'auto')
+        unfinished = has_unfinished_job(name)
+
+        if resume is True and not unfinished:
+            raise ValueError("There's no unfinished job of edition '%s' to resume" % name)
+        resume = unfinished and resume is not False
+
+        if not resume and 'count' not in edition:
+            raise ValueError("Edition '%s' requires a 'count'" % name)
+
+        # Each edition draws its trait table from its own seed, recorded in its render manifest
+        nft.seed_generators(seed)
+
+        print("Starting edition '%s'%s..." % (name, " (resuming its unfinished job)" if resume else ""))
+        print()
+
+        # The JSON metadata is written in the same pass as the images
+        rt = nft.generate_images(name, edition.get('count'), resume, metadata=edition.get('metadata', nft.FUSED_METADATA))
+        result['timings'].update(get_stage_timings(name))
+
+        metadata_time = time.time()
+        rt.to_csv(os.path.join('output', 'edition ' + name, 'metadata.csv'))
+        result['timings']['metadata'] = time.time() - metadata_time
+        result['count'] = int(rt.shape[0])
+
+        result['status'] = 'complete'
+
+    except SystemExit as e:
+        # A warning policy (or an impossible request) aborted the edition
+        result['error'] = "Execution aborted (exit code %s)" % e.code
+
+    except Exception as e:
+        traceback.print_exc()
+        result['error'] = "%s: %s" % (type(e).__name__, str(e))
+
+    result['timings']['total'] = time.time() - init_time
+
+    return result
+
+
+# Print a summary of all editions' results
+def print_summary(results):
+
+    print()
+    print("Batch summary (seconds: total, sampling, render, metadata):")
+    for result in results:
+        timings = ["{:.2f}".format(result['timings'][stage]) if stage in result['timings'] else '-' \
+                   for stage in ('total', 'sampling', 'render', 'metadata')]
+        print("  %-20s %-9s %8s avatars  %10s s  %10s %10s %10s%s" % tuple(
+            [result['name'], result['status'], '-' if result['count'] is None else result['count']] + timings +
+            ["  " + result['error'] if result['error'] else ""]
+        ))
+    print()
+
+
+# ======================================================================================
+#       PUBLIC
+# ======================================================================================
+
+# Run all editions of a job spec. Return the exit code
+def run_job(job):
+
+    # Nothing is ever asked: unlisted warnings abort
+    restriction_code.WARNING_POLICIES.update({warning: 'abort' for warning in WARNINGS})
+    restriction_code.WARNING_POLICIES.update(job.get('warnings', {}))
+
+    if 'seed' in job:
+        nft.seed_generators(job['seed'])
+
+    # Editions' seeds are derived from the job's one (a fresh one if neither the job nor SEED sets it)
+    job_seed = nft.SEED_SEQUENCE.entropy
+
+    try:
+        nft.setup()
+    except SystemExit:
+        print("Setup aborted! No edition has been generated.")
+        return 2
+
+    results = []
+    try:
+        for index, edition in enumerate(job['editions']):
+
+            if job.get('stop_on_error', False) and any(result['status'] != 'complete' for result in results):
+                results.append({'name': str(edition['name']), 'status': 'skipped', 'count': None, 'timings': {}, 'error': None})
+                continue
+
+            results.append(run_edition(edition, get_edition_seed(edition, index, job_seed)))
+
+    finally:
+        nft.close_render_pool()
+
+    print_summary(results)
+
+    if job.get('report'):
+        report_dir = os.path.dirname(job['report'])
+        if report_dir and not os.path.exists(report_dir):
+            os.makedirs(report_dir)
+
+        with open(job['report'], 'w') as f:
+            json.dump({'editions': results}, f, indent=4)
+
+    return 0 if all(result['status'] == 'complete' for result in results) else 1
+
+
+# Main function. Point of entry
+def main():
+
+    if len(sys.argv) != 2:
+        print("Usage: python batch.py job.json")
+        sys.exit(2)
+
+    try:
+        job = load_job(sys.argv[1])
+    except (OSError, ValueError) as e:
+        print("Invalid job spec '%s': %s" % (sys.argv[1], str(e)))
+        sys.exit(2)
+
+    sys.exit(run_job(job))
+
+
+# Run the main function
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Benchmark suite: times the hot paths of nft.py and metadata.py on synthetic assets and restrictions, at several scales
+#
+#   python bench.py [scale ...] [--repeat n] [--baseline path] [--save-baseline] [--verbose]
+#   python bench.py custom --layers 12 --traits 50 --canvas 512 --density 0.5 --rows 100000 --tokens 5000 --images 40
+#
+# Scales are the presets of BENCH_SCALES ('small' and 'medium' by default), or 'custom' for one set on the command line.
+# For each scale, N layers of M traits are drawn at the chosen canvas size into output/bench/<scale>/assets (re-used as
+# long as they're the same), along with a random RESTRICTIONS_CONFIG of the chosen density (restrictions per trait).
+#
+# Each scale runs in a process of its own, working in output/bench/<scale>: CONFIG and RESTRICTIONS_CONFIG are replaced
+# by the synthetic ones before anything maps the assets, and the peak memory of a scale is never inflated by another.
+# These stages are timed, in this order:
+#
+#   parse_config                traits parsed
+#   setup_restrictions          restrictions parsed, set up and compiled into conflict matrices
+#   valid_space                 layers (exact count, acceptance and marginals of the valid combinations)
+#   generate_imgs_table         rows of trait codes drawn and validated
+#   is_image_invalid            rows checked one by one against the workable dictionary (the reference check)
+#   generate_exact_imgs_table   distinct valid tokens of an edition
+#   asset_pack                  traits packed (only with ASSET_PACK)
+#   generate_single_image       images composited and encoded, from cold caches
+#   metadata                    JSON files written by metadata.py
+#
+# Results (seconds, items/s and the process' peak RSS at the end of each stage) are written to
+# output/bench/results.json. They're compared with a baseline (output/bench/baseline.json by default, see
+# '--save-baseline'): a stage is a regression if its throughput drops, or its peak RSS grows, by more than
+# BENCH_TOLERANCE. The exit code is 1 if there's any.
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import platform
+import argparse
+import subprocess
+from PIL import Image, ImageDraw
+
+import config
+from metrics import get_peak_rss
+from config import CONFIG
+from restrictions import RESTRICTIONS_CONFIG
+
+####################################################################################
+
+# GLOBALS
+
+BENCH_DIR = os.path.join('output', 'bench')
+RESULTS_FILE = 'results.json'
+BASELINE_FILE = 'baseline.json'
+RESULTS_VERSION = 1
+
+# Scale presets:
+#   'layers' x 'traits' PNGs of 'canvas' x 'canvas' pixels, 'density' restrictions per trait,
+#   'rows' trait sets drawn by generate_imgs_table, 'checks' of them checked by is_image_invalid,
+#   'tokens' in the edition (generate_exact_imgs_table and metadata) and 'images' of them rendered
+BENCH_SCALES = {
+    'small':  {'layers': 6,  'traits': 8,   'canvas': 256,  'density': 0.5, 'rows': 20000,   'checks': 2000,
+               'tokens': 1000,  'images': 20},
+    'medium': {'layers': 10, 'traits': 30,  'canvas': 512,  'density': 0.5, 'rows': 200000,  'checks': 10000,
+               'tokens': 10000, 'images': 50},
+    'large':  {'layers': 16, 'traits': 100, 'canvas': 1024, 'density': 0.5, 'rows': 1000000, 'checks': 20000,
+               'tokens': 50000, 'images': 100},
+}
+DEFAULT_SCALES = ('small', 'medium')
+
+# Seed of the synthetic assets, restrictions, rarity weights and trait sets: every run benchmarks the same work
+BENCH_SEED = 0
+
+# Restrictions only relate layers up to BENCH_SPAN apart in CONFIG order (e.g. a hat and a hairstyle, not every layer
+# with every other). The exact valid space (see valid_space.py) costs as much as the restrictions are entangled:
+# restrictions between any two layers at random would make it grow as traits ** layers
+BENCH_SPAN = 2
+
+# Relative drop in throughput (or growth in peak RSS) against the baseline reported as a regression
+BENCH_TOLERANCE = 0.2
+
+# Settings of config.py the results depend on, recorded along with them
+BENCH_SETTINGS = ('SAMPLING_MODE', 'SAMPLING_MEMORY_BYTES', 'IMAGE_ENCODER', 'ASSET_PACK', 'LAYER_CACHE_BYTES',
+                  'PREFIX_CACHE_DEPTH', 'OCCLUSION_TILE', 'METADATA_FAST', 'METADATA_WORKERS', 'METADATA_SINK')
+
+# Warnings that may ask whether to continue (see restriction_code.WARNING_POLICIES): a benchmark never waits
+WARNINGS = ('collisions', 'all_none', 'new_csvs', 'low_acceptance')
+
+####################################################################################
+#
+# HELPER FUNCTIONS
+#
+#------------------------------------------------------------------------------------
+# Synthetic assets and restrictions
+#
+
+# Get the synthetic CONFIG of a scale: the first layer is the (required) background, others are optional half the time
+def get_bench_config(spec):
+
+    rnd = random.Random(BENCH_SEED)
+
+    layers = []
+    for j in range(spec['layers']):
+        name = 'Layer %02i' % (j + 1)
+        layers.append({
+            'id': j + 1,
+            'name': name,
+            'directory': name,
+            'required': j == 0 or rnd.random() < 0.5,
+            'rarity_weights': 'random' if rnd.random() < 0.5 else None
+        })
+
+    return layers
+
+
+# Get the trait names of a synthetic layer (already in 'Title Style')
+def get_bench_traits(spec):
+    return ['Trait %03i' % (k + 1) for k in range(spec['traits'])]
+
+
+# Draw a synthetic trait: an opaque background, or a few (mostly opaque) shapes on a transparent canvas
+def draw_trait(rnd, canvas, background):
+
+    if background:
+        img = Image.new('RGB', (canvas, canvas), tuple(rnd.randrange(256) for _ in range(3)))
+    else:
+        img = Image.new('RGBA', (canvas, canvas), (0, 0, 0, 0))
+
+    draw = ImageDraw.Draw(img)
+    for _ in range(rnd.randint(1, 3)):
+
+        # Shapes take from 10% to 60% of the canvas side, like the parts of an avatar
+        width, height = [int(canvas * rnd.uniform(0.1, 0.6)) for _ in range(2)]
+        left, upper = rnd.randrange(canvas - width), rnd.randrange(canvas - height)
+        color = tuple(rnd.randrange(256) for _ in range(3)) + (255 if rnd.random() < 0.8 else rnd.randrange(64, 255),)
+
+        shape = draw.ellipse if rnd.random() < 0.5 else draw.rectangle
+        shape((left, upper, left + width, upper + height), fill=color if not background else color[:3])
+
+    return img
+
+
+# Make the synthetic assets of a scale into a workspace's assets folder, unless they're already there
+def make_bench_assets(spec, workspace):
+
+    assets_path = os.path.join(workspace, config.ASSETS_DIR)
+    stamp_path = os.path.join(workspace, 'assets.json')
+    stamp = {key: spec[key] for key in ('layers', 'traits', 'canvas')}
+    stamp['seed'] = BENCH_SEED
+
+    if os.path.isfile(stamp_path):
+        with open(stamp_path) as f:
+            if json.load(f) == stamp:
+                return
+
+    if os.path.exists(assets_path):
+        shutil.rmtree(assets_path)
+
+    rnd = random.Random(BENCH_SEED)
+    for j, layer in enumerate(get_bench_config(spec)):
+        layer_path = os.path.join(assets_path, layer['directory'])
+        os.makedirs(layer_path)
+
+        for trait in get_bench_traits(spec):
+            draw_trait(rnd, spec['canvas'], j == 0).save(os.path.join(layer_path, trait + '.png'))
+
+    with open(stamp_path, 'w') as f:
+        json.dump(stamp, f)
+
+
+# Get a random RESTRICTIONS_CONFIG: each restriction forbids a trait along with 1 to 3 traits of a nearby layer
+def get_bench_restrictions(spec, layers):
+
+    rnd = random.Random(BENCH_SEED)
+    traits = get_bench_traits(spec)
+
+    restrictions = []
+    for _ in range(round(spec['density'] * len(layers) * len(traits))):
+        i = rnd.randrange(len(layers))
+        j = rnd.choice([j for j in range(i - BENCH_SPAN, i + BENCH_SPAN + 1) if j != i and 0 <= j < len(layers)])
+
+        restrictions.append([
+            [(layers[i]['name'], rnd.choice(traits))],
+            [(layers[j]['name'], trait) for trait in rnd.sample(traits, rnd.randint(1, min(3, len(traits))))]
+        ])
+
+    return restrictions
+
+
+#------------------------------------------------------------------------------------
+# Measures
+#
+
+# Run a stage and record its time, throughput and the peak RSS so far into 'stages'. Return what the stage returns
+# 'items' is the number of items the stage deals with, or a function of what it returns
+def run_stage(stages, name, items, function, *args):
+
+    init_time = time.perf_counter()
+    value = function(*args)
+    seconds = time.perf_counter() - init_time
+
+    items = items(value) if callable(items) else items
+    peak = get_peak_rss()
+
+    stages[name] = {
+        'seconds': seconds,
+        'items': items,
+        'rate': items / max(seconds, 1e-9),
+        'peak_rss_mb': None if peak is None else peak / 2**20
+    }
+
+    return value
+
+
+# Run all stages of a scale in this process, working in its workspace. Return the stages' measures
+def run_scale(spec, workspace):
+
+    make_bench_assets(spec, workspace)
+
+    # The synthetic CONFIG and restrictions replace the project's ones in place, since every module shares those lists.
+    # Assets are mapped when restriction_code is imported, so nft and metadata are only imported afterwards
+    CONFIG[:] = get_bench_config(spec)
+    RESTRICTIONS_CONFIG[:] = get_bench_restrictions(spec, CONFIG)
+    os.chdir(workspace)
+
+    import nft
+    import metadata
+    import restriction_code
+    from assetpack import update_asset_pack, PACK_PATH
+    from asset_manifest import refresh_asset_manifest
+
+    restriction_code.WARNING_POLICIES.update({warning: 'continue' for warning in WARNINGS})
+    nft.seed_generators(BENCH_SEED)
+
+    # Each run builds the asset pack and writes its edition from scratch
+    if os.path.exists(PACK_PATH):
+        os.remove(PACK_PATH)
+
+    edition_path = os.path.join('output', 'edition bench')
+    if os.path.exists(edition_path):
+        shutil.rmtree(edition_path)
+    os.makedirs(os.path.join(edition_path, config.IMGS_DIR))
+
+    stages = {}
+
+    # Importing restriction_code scanned the assets already: this is the scan of every later startup
+    run_stage(stages, 'asset_manifest', spec['layers'] * spec['traits'], refresh_asset_manifest)
+    run_stage(stages, 'parse_config', spec['layers'] * spec['traits'], nft.parse_config)
+
+    def setup_restrictions():
+        restriction_code.parse_restrictions()
+        nft.RESTRICTIONS.update(restriction_code.setup_restrictions())
+        nft.CONFLICTS.update(restriction_code.compile_restrictions(nft.RESTRICTIONS, CONFIG))
+
+    run_stage(stages, 'setup_restrictions', len(RESTRICTIONS_CONFIG), setup_restrictions)
+    nft.VALID_SPACE.update(run_stage(stages, 'valid_space', spec['layers'], nft.get_valid_space, CONFIG, nft.CONFLICTS))
+
+    run_stage(stages, 'generate_imgs_table', spec['rows'], nft.generate_imgs_table, spec['rows'])
+
+    table = nft.get_table_from_codes(nft.sample_trait_codes(spec['checks']))
+    run_stage(stages, 'is_image_invalid', spec['checks'], table.apply, nft.is_image_invalid, 1)
+
+    # Impossible restrictions leave nothing to render
+    if nft.VALID_SPACE['count'] == 0:
+        return stages
+
+    rt = run_stage(stages, 'generate_exact_imgs_table', lambda rt: rt.shape[0], nft.generate_exact_imgs_table, spec['tokens'])
+    zfill_count = len(str(rt.shape[0] - 1))
+
+    if config.ASSET_PACK:
+        run_stage(stages, 'asset_pack', spec['layers'] * spec['traits'], update_asset_pack)
+
+    def generate_single_images():
+        for idx, traits in zip(rt.index[:spec['images']], rt.itertuples(index=False)):
+            filepaths = nft.generate_layer_paths_from_traits(list(traits))
+            nft.generate_single_image(filepaths, os.path.join(edition_path, config.IMGS_DIR, nft.get_img_name(idx, zfill_count)))
+
+    run_stage(stages, 'generate_single_image', min(spec['images'], rt.shape[0]), generate_single_images)
+
+    rt.to_csv(os.path.join(edition_path, 'metadata.csv'))
+    run_stage(stages, 'metadata', rt.shape[0], metadata.generate_metadata, 'bench')
+
+    return stages
+
+
+#------------------------------------------------------------------------------------
+# Results
+#
+
+# Run a scale 'repeat' times, each in a new process. Keep the best time and the lowest peak RSS of each stage
+def bench_scale(name, spec, repeat, verbose):
+
+    workspace = os.path.abspath(os.path.join(BENCH_DIR, name))
+    os.makedirs(workspace, exist_ok=True)
+
+    spec_path = os.path.join(workspace, 'spec.json')
+    result_path = os.path.join(workspace, 'stages.json')
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f)
+
+    best = {}
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run', spec_path, result_path, workspace],
+            stdout=None if verbose else subprocess.PIPE, stderr=None if verbose else subprocess.STDOUT,
+            universal_newlines=True
+        )
+
+        if process.returncode != 0:
+            if not verbose:
+                print(process.stdout[-4000:])
+            raise RuntimeError("Scale '%s' failed (exit code %i)" % (name, process.returncode))
+
+        with open(result_path) as f:
+            stages = json.load(f)
+
+        for stage, measure in stages.items():
+            if stage not in best:
+                best[stage] = measure
+                continue
+
+            if measure['seconds'] < best[stage]['seconds']:
+                best[stage].update({key: measure[key] for key in ('seconds', 'items', 'rate')})
+            if measure['peak_rss_mb'] is not None:
+                best[stage]['peak_rss_mb'] = min(best[stage]['peak_rss_mb'], measure['peak_rss_mb'])
+
+    return best
+
+
+# Compare a scale's stages with the baseline's. Return (stage, rate ratio, peak RSS ratio, regression) per stage
+# Ratios are None when the baseline has no figure to compare with
+def compare_stages(stages, base_stages):
+
+    comparison = []
+    for stage, measure in stages.items():
+        base = base_stages.get(stage)
+
+        rate_ratio = measure['rate'] / base['rate'] if base and base['rate'] else None
+        rss_ratio = measure['peak_rss_mb'] / base['peak_rss_mb'] \
+            if base and measure['peak_rss_mb'] and base['peak_rss_mb'] else None
+
+        regression = (rate_ratio is not None and rate_ratio < 1 - BENCH_TOLERANCE) or \
+            (rss_ratio is not None and rss_ratio > 1 + BENCH_TOLERANCE)
+
+        comparison.append((stage, rate_ratio, rss_ratio, regression))
+
+    return comparison
+
+
+# Print a scale's stages, along with how they compare with the baseline. Return the number of regressions
+def print_scale(name, scale, base_scale=None):
+
+    spec = scale['spec']
+    print("Scale '%s': %i layers x %i traits, %ipx, %s restrictions per trait" % (
+        name, spec['layers'], spec['traits'], spec['canvas'], spec['density']))
+
+    comparison = [(stage, None, None, False) for stage in scale['stages']]
+    if base_scale is not None:
+        if base_scale['spec'] != spec:
+            print("  (the baseline's scale '%s' is a different one: not compared)" % name)
+        else:
+            comparison = compare_stages(scale['stages'], base_scale['stages'])
+
+    print("  %-26s %10s %12s %12s %9s %9s" % ('stage', 'seconds', 'items', 'items/s', 'peak MB', 'vs base'))
+    for stage, rate_ratio, rss_ratio, regression in comparison:
+        measure = scale['stages'][stage]
+        print("  %-26s %10s %12i %12s %9s %9s%s" % (
+            stage,
+            "{:.3f}".format(measure['seconds']),
+            measure['items'],
+            "{:.1f}".format(measure['rate']),
+            '-' if measure['peak_rss_mb'] is None else "{:.0f}".format(measure['peak_rss_mb']),
+            '-' if rate_ratio is None else "x{:.2f}".format(rate_ratio),
+            "  <- REGRESSION" + (" (memory x{:.2f})".format(rss_ratio) if rss_ratio and rss_ratio > 1 + BENCH_TOLERANCE else "") \
+                if regression else ""
+        ))
+    print()
+
+    return sum(1 for *_, regression in comparison if regression)
+
+
+# ======================================================================================
+#       PUBLIC
+# ======================================================================================
+
+# Run the benchmark on some scales: {name: spec}. Return the results, ready to be saved as JSON
+def run_benchmark(scales, repeat=1, verbose=False):
+
+    results = {
+        'version': RESULTS_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {setting: getattr(config, setting) for setting in BENCH_SETTINGS},
+        'scales': {}
+    }
+
+    for name, spec in scales.items():
+        print("Benchmarking scale '%s'%s..." % (name, " (%i runs)" % repeat if repeat > 1 else ""))
+        results['scales'][name] = {'spec': spec, 'stages': bench_scale(name, spec, repeat, verbose)}
+
+    print()
+    return results
+
+
+# Load saved results (e.g. a baseline). None if there are none
+def load_results(path):
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as f:
+        results = json.load(f)
+
+    return results if results.get('version') == RESULTS_VERSION else None
+
+
+# Save results as JSON
+def save_results(results, path):
+
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+# Print results, compared with a baseline if given. Return the number of regressions
+def print_results(results, baseline=None):
+
+    if baseline is not None and baseline['settings'] != results['settings']:
+        changed = [setting for setting in results['settings'] if baseline['settings'].get(setting) != results['settings'][setting]]
+        print("Settings changed since the baseline: %s" % ', '.join(changed))
+        print()
+
+    regressions = 0
+    for name, scale in results['scales'].items():
+        base_scale = baseline['scales'].get(name) if baseline is not None else None
+        regressions += print_scale(name, scale, base_scale)
+
+    return regressions
+
+
+# Parse the command line arguments
+def parse_args():
+
+    parser = argparse.ArgumentParser(description="Time the hot paths of nft.py and metadata.py on synthetic assets.")
+    parser.add_argument('scales', nargs='*', metavar='scale',
+                        help="scales to run: %s, or 'custom' (default: %s)" % (', '.join(BENCH_SCALES), ' '.join(DEFAULT_SCALES)))
+    parser.add_argument('--repeat', type=int, default=1, help="runs per scale: the best one is kept (default: 1)")
+    parser.add_argument('--baseline', default=os.path.join(BENCH_DIR, BASELINE_FILE), help="baseline to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="save these results as the baseline")
+    parser.add_argument('--verbose', action='store_true', help="show the output of the stages")
+
+    # The 'custom' scale (unset figures are the 'small' ones)
+    for key, kind in (('layers', int), ('traits', int), ('canvas', int), ('density', float),
+                      ('rows', int), ('checks', int), ('tokens', int), ('images', int)):
+        parser.add_argument('--' + key, type=kind, help="'custom' scale: %s" % key)
+
+    # Internal: run a scale's stages in this process (see bench_scale)
+    parser.add_argument('--run', nargs=3, metavar=('SPEC', 'RESULT', 'WORKSPACE'), help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+# Main function: run the benchmark, save its results and compare them with the baseline
+def main():
+
+    args = parse_args()
+
+    if args.run is not None:
+        spec_path, result_path, workspace = args.run
+        with open(spec_path) as f:
+            stages = run_scale(json.load(f), workspace)
+        with open(result_path, 'w') as f:
+            json.dump(stages, f)
+        return
+
+    scales = {}
+    for name in args.scales or DEFAULT_SCALES:
+        if name == 'custom':
+            scales[name] = {key: getattr(args, key) if getattr(args, key) is not None else value \
+                                for key, value in BENCH_SCALES['small'].items()}
+        elif name in BENCH_SCALES:
+            scales[name] = BENCH_SCALES[name]
+        else:
+            print("Scale '%s' is invalid: expected one of %s, or 'custom'" % (name, ', '.join(BENCH_SCALES)))
+            sys.exit(2)
+
+    baseline = load_results(args.baseline)
+    results = run_benchmark(scales, max(args.repeat, 1), args.verbose)
+
+    save_results(results, os.path.join(BENCH_DIR, RESULTS_FILE))
+    print("Results saved into '%s'." % os.path.join(BENCH_DIR, RESULTS_FILE))
+    print()
+
+    regressions = print_results(results, baseline)
+
+    if baseline is None:
+        print("There's no baseline to compare with in '%s'. Save one with '--save-baseline'." % args.baseline)
+    elif regressions:
+        print("%i stages regressed by more than %i%% against the baseline." % (regressions, 100 * BENCH_TOLERANCE))
+
+    if args.save_baseline:
+        save_results(results, args.baseline)
+        print("Results saved as the baseline into '%s'." % args.baseline)
+
+    if regressions:
+        sys.exit(1)
+
+
+# Run the main function
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# Checkpoints of an edition, so a render job that dies midway can be resumed
+#
+# Before rendering begins, each edition persists:
+#
+#   traits.csv              the final trait table (the rarity table), so a resumed job renders the same avatars
+#   render_manifest.json    what the edition is made of: layers, number of avatars, filenames padding, seed, status...
+#                           and the hash of every trait's PNG, so a later re-render finds the ones changed since
+#
+# Once rendered, render_report.json tells how the render went: layers skipped because they were hidden, and avatars
+# whose images came out pixel-identical despite their different traits (visual collisions).
+#
+# An edition may be rendered by several machines, each one taking a shard (a slice of token ids) of the same trait table.
+# Each shard leaves a record in the 'shards' folder, so merging their outputs can check every id is covered exactly once.
+#
+# Images (and checkpoints) are written to a temporary file first, then renamed into place. A file under its final name
+# is always complete, so resuming only has to re-render the avatars whose image is missing or fails to verify.
+
+import os
+import json
+import hashlib
+import pandas as pd
+from PIL import Image
+
+####################################################################################
+
+# GLOBALS
+
+# Checkpoint filenames, within the edition's folder
+TRAITS_FILE = 'traits.csv'
+MANIFEST_FILE = 'render_manifest.json'
+REPORT_FILE = 'render_report.json'
+SHARDS_DIR = 'shards'
+
+####################################################################################
+#
+# HELPER FUNCTIONS
+#
+#------------------------------------------------------------------------------------
+
+# Get the temporary path a file is written to before it's renamed into place
+# It's a hidden file in the same folder, so the rename never crosses filesystems
+def get_temp_path(path):
+    folder, filename = os.path.split(path)
+    return os.path.join(folder, '.' + filename + '.tmp')
+
+
+# Write a file through a temporary one. 'write' receives the temporary path
+def write_atomic(path, write):
+
+    temp_path = get_temp_path(path)
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+
+    except BaseException:
+        # Never leave half written temporary files behind
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# ======================================================================================
+#       PUBLIC
+# ======================================================================================
+
+# Remove the temporary files left behind by a job that was killed while writing them
+def remove_temp_files(folder):
+    for filename in os.listdir(folder):
+        if filename.startswith('.') and filename.endswith('.tmp'):
+            os.remove(os.path.join(folder, filename))
+
+
+# Check that an image file exists and is not corrupt
+def is_image_ok(path):
+
+    if not os.path.isfile(path):
+        return False
+
+    try:
+        # verify() checks the file's integrity (e.g. PNG chunks' CRCs) without decoding it
+        with Image.open(path) as img:
+            img.verify()
+        return True
+
+    except Exception:
+        return False
+
+
+# Save the trait table and the render manifest of an edition
+def save_checkpoint(edition_path, rarity_table, manifest):
+
+    write_atomic(os.path.join(edition_path, TRAITS_FILE), lambda temp_path: rarity_table.to_csv(temp_path))
+    save_manifest(edition_path, manifest)
+
+
+# Save the render manifest of an edition (e.g. to update its status)
+def save_manifest(edition_path, manifest):
+
+    def write(temp_path):
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=4)
+
+    write_atomic(os.path.join(edition_path, MANIFEST_FILE), write)
+
+
+# Load the render manifest of an edition. Return None if the edition has none
+def load_manifest(edition_path):
+
+    path = os.path.join(edition_path, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+# Save the render report of an edition (see nft.get_render_report)
+def save_render_report(edition_path, report, filename=REPORT_FILE):
+
+    def write(temp_path):
+        with open(temp_path, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    write_atomic(os.path.join(edition_path, filename), write)
+
+
+# Load the render report of an edition. Return None if the edition has none
+def load_render_report(edition_path, filename=REPORT_FILE):
+
+    path = os.path.join(edition_path, filename)
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+# Load the trait table of an edition, exactly as it was saved (or its metadata.csv, which holds the same table)
+def load_traits(edition_path, filename=TRAITS_FILE):
+
+    # Trait names are kept as strings ('none' included), even if they look like numbers
+    rarity_table = pd.read_csv(os.path.join(edition_path, filename), index_col=0, dtype=str, keep_default_na=False)
+    rarity_table.index = rarity_table.index.astype(int)
+
+    return rarity_table
+
+
+# Get the SHA-256 of the edition's trait table: shards rendered from the same table share it
+def get_traits_hash(edition_path):
+
+    sha = hashlib.sha256()
+    with open(os.path.join(edition_path, TRAITS_FILE), 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+# Get the token ids of a shard: the i-th of N consecutive slices (as even as possible) of range(count)
+def get_shard_ids(count, shard, shards):
+    return range(shard * count // shards, (shard + 1) * count // shards)
+
+
+# Save the record of a rendered shard
+def save_shard_record(edition_path, record):
+
+    shards_path = os.path.join(edition_path, SHARDS_DIR)
+    if not os.path.exists(shards_path):
+        os.makedirs(shards_path)
+
+    def write(temp_path):
+        with open(temp_path, 'w') as f:
+            json.dump(record, f, indent=4)
+
+    write_atomic(os.path.join(shards_path, 'shard-%i-of-%i.json' % (record['shard'], record['shards'])), write)
+
+
+# Load the records of all shards rendered for an edition
+def load_shard_records(edition_path):
+
+    shards_path = os.path.join(edition_path, SHARDS_DIR)
+    if not os.path.isdir(shards_path):
+        return []
+
+    records = []
+    for filename in sorted(os.listdir(shards_path)):
+        if filename.startswith('shard-') and filename.endswith('.json'):
+            with open(os.path.join(shards_path, filename)) as f:
+                records.append(json.load(f))
+
+    return records
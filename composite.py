@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# NumPy compositing engine: stacks the layers of a whole batch of avatars at once
+#
+# The PIL path (render_cache.composite_layers) pastes layer by layer on a new image per avatar.
+# This engine keeps every decoded layer as a NumPy array and composites a batch of avatars into
+# a single output buffer that's re-used from batch to batch. PIL is only used to encode the PNGs.
+#
+# Run this file to check that both engines are pixel-exact, see how much cropping the layers saves, and compare their
+# throughput:
+#
+#   python composite.py [number of avatars] [batch size]
+
+import sys
+import time
+import random
+import numpy as np
+from PIL import Image
+
+from asset_manifest import get_trait_paths
+import render_cache
+from render_cache import get_layer, get_upper_layer, get_cached_layer, get_paste_boxes, composite_layers, clear_render_cache
+from config import CONFIG, COMPOSITE_BATCH, OCCLUSION_TILE
+
+####################################################################################
+
+# GLOBALS
+
+# Output buffer re-used from batch to batch: (batch size, height, width, bands)
+BUFFER = np.empty((0, 0, 0, 0), dtype=np.uint8)
+
+####################################################################################
+#
+# HELPER FUNCTIONS
+#
+#------------------------------------------------------------------------------------
+
+# Get the background layer as an uint8 array in its original mode: (array, mode)
+# Layers' arrays are kept in the decoded layers cache (see render_cache.get_cached_layer), under their own keys
+def get_background_array(filepath):
+
+    def make_array():
+        img = get_layer(filepath)
+
+        # Pasting is only reproduced for these modes
+        if img.mode not in ('RGB', 'RGBA'):
+            raise ValueError("The NumPy compositing engine requires backgrounds in 'RGB' or 'RGBA' mode. '%s' is '%s'." % \
+                             (filepath, img.mode))
+
+        return (np.asarray(img), img.mode)
+
+    return get_cached_layer((filepath, 'array'), make_array)
+
+
+# Get an upper layer as premultiplied uint16 arrays for a destination with given number of bands
+# It's cropped to its non transparent area, ready to blend:
+#   (box, color * alpha + 128, 255 - alpha)    where box is the (left, upper, right, lower) alpha bounding box
+def get_upper_array(filepath, bands):
+
+    def make_array():
+
+        # Fully transparent pixels leave the destination untouched, so they're cropped away
+        box, img = get_upper_layer(filepath)
+        arr = np.asarray(img).astype(np.uint16).reshape(img.height, img.width, 4)
+        alpha = arr[..., 3:4]
+
+        # The rounding constant of DIV255 is folded into the premultiplied color
+        return (box, arr[..., :bands] * alpha + 128, 255 - alpha)
+
+    return get_cached_layer((filepath, 'array-%i' % bands), make_array)
+
+
+# Get the re-usable output buffer with room for 'n' images of given shape
+def get_buffer(n, shape):
+
+    global BUFFER
+
+    # Only allocate when the buffer is too small or the canvas changes
+    if BUFFER.shape[0] < n or BUFFER.shape[1:] != shape:
+        BUFFER = np.empty((max(n, BUFFER.shape[0] if BUFFER.shape[1:] == shape else 0),) + shape, dtype=np.uint8)
+
+    return BUFFER[:n]
+
+
+# Blend a layer into a set of images exactly as PIL's Image.paste(img, (0,0), img) does
+def blend(dst, layer):
+    """
+    PIL pastes with a mask using straight (non premultiplied) alpha on every band, alpha included:
+
+        out = DIV255(dst * (255 - a) + src * a)    where    DIV255(v) = ((v + 128) >> 8 + v + 128) >> 8
+
+    The same integer arithmetic is used here, so the result is pixel-exact. All values fit into uint16.
+    """
+    _, premultiplied, inv_alpha = layer
+
+    tmp = dst.astype(np.uint16)
+    tmp *= inv_alpha
+    tmp += premultiplied
+    tmp += tmp >> 8
+    tmp >>= 8
+
+    return tmp.astype(np.uint8)
+
+
+# ======================================================================================
+#       PUBLIC
+# ======================================================================================
+
+# Composite a batch of avatars given their layers' PNG paths (in CONFIG order, None for an absent trait)
+def composite_batch(batch_paths):
+    """
+    Return a (batch size, height, width, bands) uint8 array with the final images and the PIL mode to encode them.
+
+    The array is a view of a buffer re-used by the next batch: encode (or copy) the images before compositing again.
+    Layers are blended per distinct trait, all the avatars having that trait at once.
+    """
+
+    # Backgrounds: all avatars of a batch must share the canvas size and mode
+    backgrounds = [get_background_array(paths[0]) for paths in batch_paths]
+    mode = backgrounds[0][1]
+    if any(bg_mode != mode for _, bg_mode in backgrounds):
+        raise ValueError("The NumPy compositing engine requires all backgrounds in the same mode.")
+
+    out = get_buffer(len(batch_paths), backgrounds[0][0].shape)
+    for i, (arr, _) in enumerate(backgrounds):
+        out[i] = arr
+
+    # Layers fully hidden by the opaque layers above them are left out (see render_cache.get_paste_boxes)
+    # Partly hidden ones are blended whole: avatars sharing a trait are blended at once, over the same area
+    canvas_size = (out.shape[2], out.shape[1])
+    boxes = [get_paste_boxes(paths, 1, canvas_size, clip=False) if OCCLUSION_TILE else None for paths in batch_paths]
+
+    # Loop through layers 1 to n and blend each distinct trait into all the avatars that have it
+    for layer_idx in range(1, max(len(paths) for paths in batch_paths)):
+
+        groups = {}
+        for i, paths in enumerate(batch_paths):
+            filepath = paths[layer_idx] if layer_idx < len(paths) else None
+            if filepath is not None and filepath.endswith('.png') and (boxes[i] is None or boxes[i][layer_idx] is not None):
+                groups.setdefault(filepath, []).append(i)
+
+        for filepath, idxs in groups.items():
+            layer = get_upper_array(filepath, out.shape[-1])
+            left, upper, right, lower = layer[0]
+            if left == right:
+                continue
+
+            # A single avatar is blended through a view, avoiding the copies of fancy indexing
+            if len(idxs) == 1:
+                region = out[idxs[0], upper:lower, left:right]
+                region[...] = blend(region, layer)
+            else:
+                out[idxs, upper:lower, left:right] = blend(out[idxs, upper:lower, left:right], layer)
+
+    return out, mode
+
+
+# Convert an image composited by composite_batch into a PIL image, ready for encoding
+def to_image(arr, mode):
+    return Image.fromarray(arr, mode)
+
+
+#------------------------------------------------------------------------------------
+# Reference mode and benchmark
+#
+
+# Get the layers' paths of 'count' random avatars from the assets (restrictions are not needed to composite)
+def get_sample_paths(count, seed=0):
+
+    rnd = random.Random(seed)
+
+    options = []
+    for layer in CONFIG:
+        paths = get_trait_paths(layer)
+        options.append(paths if layer['required'] else [None] + paths)
+
+    return [[rnd.choice(paths) for paths in options] for _ in range(count)]
+
+
+# Stack an avatar's layers pasting them whole, on the full canvas: the reference the engines must match
+def paste_full_canvas(filepaths):
+
+    bg = get_layer(filepaths[0]).copy()
+    for filepath in filepaths[1:]:
+        if filepath is not None and filepath.endswith('.png'):
+            img = get_layer(filepath, 'RGBA')
+            bg.paste(img, (0,0), img)
+
+    return bg
+
+
+# Check that both engines (PIL paste of the cropped layers and NumPy) produce the same pixels as pasting whole layers
+# Return the mismatches of each engine
+def check_against_paste(sample_paths, batch_size=COMPOSITE_BATCH):
+
+    mismatches = {'pil': [], 'numpy': []}
+    for start in range(0, len(sample_paths), batch_size):
+        batch = sample_paths[start:start + batch_size]
+        out, mode = composite_batch(batch)
+
+        for i, paths in enumerate(batch):
+            reference = paste_full_canvas(paths)
+            if reference.mode != mode or reference.tobytes() != out[i].tobytes():
+                mismatches['numpy'].append(start + i)
+            if reference.tobytes() != composite_layers(paths).tobytes():
+                mismatches['pil'].append(start + i)
+
+    return mismatches
+
+
+# Get how much of the canvas the upper layers of each CONFIG layer take once cropped to their non transparent pixels
+# Return (layer name, number of traits, average cropped area / canvas area) per layer
+def get_crop_report():
+
+    report = []
+    for layer in CONFIG[1:]:
+        filepaths = get_trait_paths(layer)
+
+        ratios = []
+        for filepath in filepaths:
+            box, img = get_upper_layer(filepath)
+            canvas = get_layer(filepath, 'RGBA')
+            ratios.append((box[2] - box[0]) * (box[3] - box[1]) / (canvas.width * canvas.height))
+
+        report.append((layer['name'], len(filepaths), sum(ratios) / len(ratios) if ratios else 0.0))
+
+    return report
+
+
+# Measure the compositing throughput (avatars per second) of pasting whole layers, pasting cropped layers (the PIL
+# engine) and the NumPy engine. Encoding is excluded
+def benchmark(sample_paths, batch_size=COMPOSITE_BATCH):
+
+    # Warm up the decoded layers so only compositing is measured
+    check_against_paste(sample_paths[:batch_size], batch_size)
+
+    init_time = time.time()
+    for paths in sample_paths:
+        paste_full_canvas(paths)
+    full_time = time.time() - init_time
+
+    # The partial composites cache is disabled for a fair layer by layer comparison
+    depth, render_cache.PREFIX_CACHE_DEPTH = render_cache.PREFIX_CACHE_DEPTH, 0
+
+    init_time = time.time()
+    for paths in sample_paths:
+        composite_layers(paths)
+    pil_time = time.time() - init_time
+
+    render_cache.PREFIX_CACHE_DEPTH = depth
+
+    init_time = time.time()
+    for start in range(0, len(sample_paths), batch_size):
+        composite_batch(sample_paths[start:start + batch_size])
+    numpy_time = time.time() - init_time
+
+    return len(sample_paths) / full_time, len(sample_paths) / pil_time, len(sample_paths) / numpy_time
+
+
+# Main function: reference check, cropped layers' area and throughput on the sample assets
+def main():
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else COMPOSITE_BATCH
+
+    sample_paths = get_sample_paths(count)
+
+    print("Checking both engines against pasting whole layers on %i random avatars..." % count)
+    mismatches = check_against_paste(sample_paths, batch_size)
+
+    for engine in ('pil', 'numpy'):
+        if mismatches[engine]:
+            print("...%i avatars of the '%s' engine don't match pixel by pixel! First ones: %s" % \
+                  (len(mismatches[engine]), engine, mismatches[engine][:10]))
+        else:
+            print("...all %i avatars of the '%s' engine match pixel by pixel." % (count, engine))
+    print()
+
+    print("Upper layers cropped to their non transparent pixels (share of the canvas actually pasted):")
+    for name, traits, ratio in get_crop_report():
+        print("  %-20s %3i traits  %6s%% of the canvas" % (name, traits, "{:.1f}".format(100 * ratio)))
+    clear_render_cache()
+    print()
+
+    print("Measuring compositing throughput (batches of %i)..." % batch_size)
+    full_rate, pil_rate, numpy_rate = benchmark(sample_paths, batch_size)
+    print("PIL paste, whole layers:   %s avatars/s" % "{:.1f}".format(full_rate))
+    print("PIL paste, cropped layers: %s avatars/s (x%s)" % ("{:.1f}".format(pil_rate), "{:.2f}".format(pil_rate / full_rate)))
+    print("NumPy batch:               %s avatars/s (x%s)" % ("{:.1f}".format(numpy_rate), "{:.2f}".format(numpy_rate / full_rate)))
+
+    if mismatches['pil'] or mismatches['numpy']:
+        sys.exit(1)
+
+
+# Run the main function
+if __name__ == '__main__':
+    main()
@@ -69,6 +69,131 @@ ZEROS_PAD = True
 # I heartly hope this remarkable code (thanks to rounakbanik) and the improvements I made will be of good help on your projects.
 # ----------------------------------------
 
+# Master seed. Set it to an integer to get the same 'random' rarity weights and the same rarity table on every run,
+# as long as the assets, CONFIG, RESTRICTIONS_CONFIG and the sampling settings below don't change.
+# With None, every run produces a different one. The seed actually used is recorded in the edition's render_manifest.json
+# ('seed'): set SEED to it to reproduce that edition.
+#
+# A seed is required to split an edition across several machines (see '--shard' in nft.py), unless every machine is
+# given a copy of the edition's traits.csv and render_manifest.json beforehand.
+SEED = None
+
+# How trait sets are drawn:
+#   'rejection': every layer is drawn with its rarity weights, and avatars breaking a restriction are discarded.
+#                Realized frequencies are those weights conditioned on validity. Tight restrictions waste lots of samples.
+#   'sequential': layers are drawn in CONFIG order, masking out the traits restricted by the ones already drawn.
+#                Nearly no sample is wasted, but the distribution differs: the first layers keep their rarity weights,
+#                while the later layers absorb the restrictions' effect (their allowed traits become more frequent).
+#   'unrank': every valid combination gets a number (rank) from 0 to V - 1, V being the exact number of valid
+#                combinations. Distinct ranks are drawn and turned into trait sets: no rejections and no duplicates,
+#                so exactly the requested number of avatars is produced, even all V of them.
+# Realized vs target frequencies are printed before rendering, so you can compare the modes.
+SAMPLING_MODE = 'rejection'
+
+# Only for SAMPLING_MODE = 'unrank':
+#   True: avatars follow the rarity weights, exactly as in 'rejection' mode. When the requested number approaches V,
+#         the last ones are drawn uniformly among the combinations left, since rare combinations would take forever.
+#   False: all valid combinations are equally likely (rarity weights are ignored).
+RANK_WEIGHTED = True
+
+# Where the images (IMAGES_SINK) and the JSON metadata (METADATA_SINK) are written:
+#   'flat':     one file per token in the IMGS_DIR (or JSON_DIR) folder, as usual.
+#   'sharded':  one file per token, spread over 256 subfolders of IMGS_DIR (or JSON_DIR), named after 2 hex digits of
+#               a hash of the filename, so no folder holds too many files.
+#   'tar':      a single uncompressed archive, IMGS_DIR.tar (or JSON_DIR.tar), written as the tokens are rendered.
+#   'zip':      same, as a zip archive (IMGS_DIR.zip or JSON_DIR.zip). Files are stored: PNGs are already compressed.
+#   'ndjson':   JSON metadata only (not for IMAGES_SINK). A single JSON_DIR.ndjson file with one token per line, plus JSON_DIR.ndjson.index.npy,
+#               a NumPy array of each token's (offset, length) within the file (see sinks.read_ndjson_record).
+# Files are named 000.png, 000.json... (or 0.png, 0.json... if ZEROS_PAD is False) right when they're written.
+# Only 'flat' and 'sharded' can be split into shards ('--shard' in nft.py), or resumed without starting over.
+IMAGES_SINK = 'flat'
+METADATA_SINK = 'flat'
+
+# ----------------------------------------
+# PERFORMANCE SETTINGS:
+#----------------------------------------------------------------------------------------------
+# If True, nft.py also writes each token's JSON metadata (into JSON_DIR) right after rendering its image, so there's
+# no need to run metadata.py afterwards. The JSON files are the same metadata.py would write. metadata.csv is still saved.
+FUSED_METADATA = False
+
+# metadata.py assembles the JSON files from pre-serialized pieces and writes them with METADATA_WORKERS threads.
+# The files are byte-identical to the ones of the original token by token loop, which is used if METADATA_FAST is False.
+METADATA_FAST = True
+METADATA_WORKERS = 8
+
+# Candidate trait sets are generated, validated and deduplicated in chunks, stopping as soon as enough avatars are accepted.
+# SAMPLING_MEMORY_BYTES bounds the memory (in bytes) taken by a chunk. The accepted avatars themselves come on top.
+SAMPLING_MEMORY_BYTES = 256 * 2**20
+
+# How the avatar images are encoded (all presets are lossless: they only trade encoding speed for file size):
+#   'png':                  Pillow's default PNG settings (zlib level 6), as usual.
+#   'png-fast':             PNG with zlib level 1. Much faster to encode, somewhat larger files.
+#   'png-small':            PNG with zlib level 9 and Pillow's optimize. Slower to encode, smaller files.
+#   'png-palette':          avatars with 256 colors or less are saved as palette PNGs (with per color transparency),
+#                           which are much smaller. The others are saved as 'png'.
+#   'png-palette-small':    same as 'png-palette', with the settings of 'png-small'.
+#   'webp-lossless':        lossless WebP files (.webp). Usually the smallest, but slower to encode, and not every
+#                           marketplace or tool takes them.
+# Each avatar's encode time and file size is recorded in the edition's encode_stats.csv.
+# Run 'python encoder.py [edition]' to compare all presets on a sample of an edition's avatars.
+IMAGE_ENCODER = 'png'
+
+# If True, all traits are decoded once into a single asset pack file (output/assets.pack) that render processes map
+# into memory: PNGs aren't decoded on every run, and all render workers share the same decoded layers instead of holding
+# a copy each. The pack is rebuilt automatically when a trait is added, removed or changed. See assetpack.py.
+ASSET_PACK = True
+
+# Every trait PNG is decoded only once per process and kept in memory, so it can be re-used by all avatars.
+# LAYER_CACHE_BYTES sets the maximum amount of memory (in bytes) the decoded layers may take, including the arrays the
+# 'numpy' compositing engine keeps of them.
+# Once exceeded, the least recently used layers are released and decoded again if needed.
+# Set it to None to keep all decoded layers pinned in memory (recommended unless your assets are huge).
+LAYER_CACHE_BYTES = None
+
+# Number of processes used to render the avatar images. Set it up to the number of CPU cores available.
+# With 1, images are rendered one after another within the main process.
+# Each worker process keeps its own decoded layers cache (see LAYER_CACHE_BYTES).
+RENDER_WORKERS = 1
+
+# Avatars share long stacks of bottom layers (e.g. the same "Background + Body" combination).
+# The composites of the first PREFIX_CACHE_DEPTH layers (in CONFIG order) are kept in memory and re-used,
+# so each avatar only pastes the layers above its deepest cached stack. Set it to 0 to disable it.
+# PREFIX_CACHE_BYTES bounds the memory taken by these partial composites (per render process).
+PREFIX_CACHE_DEPTH = 3
+PREFIX_CACHE_BYTES = 512 * 2**20
+
+# If True, avatars are rendered grouped by their bottom layers to make the most of the cache above.
+# Avatars keep their numbering: only the rendering order changes.
+PREFIX_REORDER = True
+
+# Layers fully hidden by opaque layers above them (e.g. a body under a full suit) are not pasted at all, and partly
+# hidden ones only where they can still be seen. The canvas is split into square tiles of OCCLUSION_TILE pixels to
+# work out which parts are hidden: smaller tiles find more hidden parts, at a higher cost per avatar.
+# Avatars stay exactly the same. Set it to 0 to disable it.
+OCCLUSION_TILE = 16
+
+# Compositing engine used to stack the layers:
+#   'pil': pastes layer by layer with Pillow, one avatar at a time (uses the partial composites cache above).
+#   'numpy': composites batches of COMPOSITE_BATCH avatars at once into a re-used NumPy buffer.
+# Both produce exactly the same pixels. Run 'python composite.py' to check it and compare their speed on your assets.
+COMPOSITE_ENGINE = 'pil'
+COMPOSITE_BATCH = 32
+
+# Every run measures the time of each of its stages (assets scan, sampling, per token decode, composite, encode and
+# write...), counts what they deal with (rows sampled, rejected, duplicated, cache hits...) and its peak memory.
+# nft.py adds them to the edition's render_report.json ('runs'), and metadata.py writes them into metadata_report.json.
+#
+# If LIVE_METRICS is True, nft.py also keeps 'live_metrics.json' in the edition's folder up to date while it runs
+# (every LIVE_METRICS_INTERVAL seconds at most): progress, avatars per second, time left and the metrics so far.
+# Handy to follow long runs, even from another machine.
+LIVE_METRICS = False
+LIVE_METRICS_INTERVAL = 10
+
+# If True, the render loop runs under Python's profiler (cProfile). The statistics of all render processes are saved
+# together into 'render_profile.pstats' in the edition's folder, and the most expensive functions are printed.
+# Profiling slows rendering down: only turn it on to find out where the time goes.
+PROFILE_RENDER = False
+
 CONFIG = [
     {
         'id': 1,
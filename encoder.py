@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Image encoder: turns a composited avatar into the bytes of its file, with the IMAGE_ENCODER preset (see config.py)
+#
+# Every preset is lossless: a decoded file has exactly the pixels of the composite. Presets only trade encoding
+# speed for file size. Run this file to compare them on a sample of an edition's avatars:
+#
+#   python encoder.py [edition] [number of avatars]
+
+import os
+import io
+import sys
+import time
+import pandas as pd
+import numpy as np
+from PIL import Image
+
+from asset_manifest import get_trait_files
+from render_cache import composite_layers
+from checkpoint import write_atomic, load_traits
+from config import CONFIG, IMAGE_ENCODER
+
+####################################################################################
+
+# GLOBALS
+
+# Encoder presets:
+#   'format' and 'params' are given to Pillow's Image.save. 'extension' is the one of the files
+#   'palette' turns avatars with 256 colors or less into palette images (with per color transparency) before encoding
+ENCODER_PRESETS = {
+    'png':              {'format': 'PNG', 'extension': '.png', 'params': {}, 'palette': False},
+    'png-fast':         {'format': 'PNG', 'extension': '.png', 'params': {'compress_level': 1}, 'palette': False},
+    'png-small':        {'format': 'PNG', 'extension': '.png', 'params': {'optimize': True}, 'palette': False},
+    'png-palette':      {'format': 'PNG', 'extension': '.png', 'params': {}, 'palette': True},
+    'png-palette-small':{'format': 'PNG', 'extension': '.png', 'params': {'optimize': True}, 'palette': True},
+    'webp-lossless':    {'format': 'WEBP', 'extension': '.webp',
+                         'params': {'lossless': True, 'quality': 100, 'method': 4, 'exact': True}, 'palette': False},
+}
+
+# Per token encode records of an edition: one row per token (id, encoder, seconds, bytes, sha1)
+# 'sha1' is the hash of the image file: avatars with the same one have pixel-identical images
+ENCODE_STATS_FILE = 'encode_stats.csv'
+
+####################################################################################
+#
+# HELPER FUNCTIONS
+#
+#------------------------------------------------------------------------------------
+
+# Get an encoder preset by name
+def get_preset(encoder):
+
+    if encoder not in ENCODER_PRESETS:
+        raise ValueError("Encoder '%s' is invalid: expected one of %s" % (encoder, ', '.join(ENCODER_PRESETS)))
+
+    return ENCODER_PRESETS[encoder]
+
+
+# Turn an image into an exact palette image. Return None if it has more than 256 colors
+def to_palette(img):
+
+    rgba = img if img.mode == 'RGBA' else img.convert('RGBA')
+
+    # getcolors gives up (None) as soon as it finds more colors than asked for
+    colors = rgba.getcolors(256)
+    if colors is None:
+        return None
+
+    # Colors as single uint32 keys (R, G, B, A), so every pixel can be looked up in the sorted palette at once
+    palette = np.sort(np.array([color for _, color in colors], dtype=np.uint8).view(np.uint32)[:, 0])
+    keys = np.asarray(rgba).view(np.uint32)[..., 0]
+
+    pal_img = Image.fromarray(np.searchsorted(palette, keys).astype(np.uint8), 'P')
+
+    colors = palette.view(np.uint8).reshape(-1, 4)
+    pal_img.putpalette(colors[:, :3].tobytes(), 'RGB')
+
+    # Transparency (per palette color) is only kept for the images that have it
+    if (colors[:, 3] < 255).any():
+        pal_img.info['transparency'] = colors[:, 3].tobytes()
+
+    return pal_img
+
+
+# ======================================================================================
+#       PUBLIC
+# ======================================================================================
+
+# Get the extension of the image files written with an encoder
+def get_image_extension(encoder=IMAGE_ENCODER):
+    return get_preset(encoder)['extension']
+
+
+# Encode an image into the bytes of its file
+def encode_image(img, encoder=IMAGE_ENCODER):
+
+    preset = get_preset(encoder)
+    params = dict(preset['params'])
+
+    if preset['palette']:
+        pal_img = to_palette(img)
+        if pal_img is not None:
+            img = pal_img
+            if 'transparency' in img.info:
+                params['transparency'] = img.info['transparency']
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=preset['format'], **params)
+    return buffer.getvalue()
+
+
+# Save an image into a file (atomically) with an encoder
+def save_encoded_image(img, path, encoder=IMAGE_ENCODER):
+
+    data = encode_image(img, encoder)
+
+    def write(temp_path):
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+
+    write_atomic(path, write)
+
+
+# Save the encode records of an edition's tokens: (id, seconds, bytes, sha1) tuples
+# Records of a previous job for other tokens (e.g. before a resume) are kept. Return all the edition's records
+def save_encode_stats(edition_path, records, filename=ENCODE_STATS_FILE):
+
+    stats = pd.DataFrame(records, columns=['id', 'seconds', 'bytes', 'sha1']).set_index('id')
+    stats.insert(0, 'encoder', IMAGE_ENCODER)
+
+    path = os.path.join(edition_path, filename)
+    if os.path.isfile(path):
+        previous = pd.read_csv(path, index_col=0)
+        stats = pd.concat([previous[~previous.index.isin(stats.index)], stats])
+
+    stats = stats.sort_index()
+    write_atomic(path, lambda temp_path: stats.to_csv(temp_path))
+
+    return stats
+
+
+# Load the encode records of an edition (or of all its shards, given their filenames). None if there are none
+# A token's records in later files replace the ones in earlier files (e.g. the shards' ones, once re-rendered)
+def load_encode_stats(edition_path, filenames=(ENCODE_STATS_FILE,)):
+
+    paths = [os.path.join(edition_path, filename) for filename in filenames]
+    stats = [pd.read_csv(path, index_col=0) for path in paths if os.path.isfile(path)]
+    if not stats:
+        return None
+
+    stats = pd.concat(stats)
+    return stats[~stats.index.duplicated(keep='last')].sort_index()
+
+
+# Get the groups of tokens whose images are pixel-identical, given their encode records. Lists of token ids
+def get_visual_collisions(stats):
+
+    duplicated = stats[stats['sha1'].duplicated(keep=False)]
+    return sorted(sorted(int(idx) for idx in group.index) for _, group in duplicated.groupby('sha1'))
+
+
+# Print the totals of some encode records: (id, seconds, bytes, sha1) tuples
+def print_encode_stats(records):
+
+    if not records:
+        return
+
+    seconds = sum(record[1] for record in records)
+    size = sum(record[2] for record in records)
+    print("Encoded %i images with '%s': %s ms per image, %s KB per image, %s MB in total." % (
+        len(records),
+        IMAGE_ENCODER,
+        "{:.1f}".format(1000 * seconds / len(records)),
+        "{:.1f}".format(size / len(records) / 2**10),
+        "{:.1f}".format(size / 2**20)
+    ))
+
+
+#------------------------------------------------------------------------------------
+# Benchmark
+#
+
+# Get the layers' paths of a sample of an edition's avatars
+def get_edition_sample_paths(edition, count, seed=0):
+
+    rarity_table = load_traits(os.path.join('output', 'edition ' + str(edition)))
+    sample = rarity_table.sample(min(count, rarity_table.shape[0]), random_state=seed).sort_index()
+
+    # Trait names are mapped back to their PNG files, as nft.py does
+    trait_files = [get_trait_files(layer) for layer in CONFIG]
+
+    return [
+        [None if trait.lower() == 'none' else os.path.join(layer['directory'], files[trait]) \
+            for layer, files, trait in zip(CONFIG, trait_files, traits)] \
+        for traits in sample.itertuples(index=False)
+    ]
+
+
+# Encode the same images with every preset. Return (preset, images/s, average bytes, lossless) per preset
+def benchmark(images):
+
+    results = []
+    for encoder in ENCODER_PRESETS:
+
+        init_time = time.perf_counter()
+        encoded = [encode_image(img, encoder) for img in images]
+        elapsed = max(time.perf_counter() - init_time, 1e-9)
+
+        # Decoded files must give back the very same pixels
+        lossless = all(
+            Image.open(io.BytesIO(data)).convert(img.mode).tobytes() == img.tobytes() for img, data in zip(images, encoded)
+        )
+
+        results.append((encoder, len(images) / elapsed, sum(len(data) for data in encoded) / len(images), lossless))
+
+    return results
+
+
+# Main function: throughput and size of every preset on a sample of an edition
+def main():
+
+    if len(sys.argv) < 2:
+        print("Usage: python encoder.py [edition] [number of avatars]")
+        sys.exit(1)
+
+    edition = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    sample_paths = get_edition_sample_paths(edition, count)
+    print("Compositing %i avatars of edition '%s'..." % (len(sample_paths), edition))
+    images = [composite_layers(paths) for paths in sample_paths]
+
+    print("Encoding them with every preset...")
+    results = benchmark(images)
+
+    reference_rate, reference_size = results[0][1], results[0][2]
+    print()
+    print("  %-18s %10s %8s %10s %8s %9s" % ('preset', 'images/s', 'speed', 'KB/image', 'size', 'lossless'))
+    for encoder, rate, size, lossless in results:
+        print("  %-18s %10s %8s %10s %8s %9s%s" % (
+            encoder,
+            "{:.1f}".format(rate),
+            "x{:.2f}".format(rate / reference_rate),
+            "{:.1f}".format(size / 2**10),
+            "{:.0f}%".format(100 * size / reference_size),
+            'yes' if lossless else 'NO',
+            "  <- IMAGE_ENCODER" if encoder == IMAGE_ENCODER else ""
+        ))
+
+    if not all(result[3] for result in results):
+        sys.exit(1)
+
+
+# Run the main function
+if __name__ == '__main__':
+    main()
@@ -8,12 +8,17 @@ import os
 from progressbar import progressbar
 import json
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 # Please: Check in config.py general settings and parameters
-from config import JSON_DIR, ZEROS_PAD
+from config import JSON_DIR, ZEROS_PAD, METADATA_FAST, METADATA_WORKERS, METADATA_SINK
+from encoder import get_image_extension
+from sinks import open_sink, close_sink, write_file, is_shared_sink
+from checkpoint import save_render_report
+from metrics import measure, add_counters, pop_metrics, print_metrics
 
 # Base metadata. MUST BE EDITED.
 # ----------------------------------------------
@@ -51,6 +56,9 @@ BASE_JSON = {
 
 # ----------------------------------------------
 
+# Report of the last JSON metadata generation of an edition, within its folder (see save_metadata_report)
+METADATA_REPORT_FILE = 'metadata_report.json'
+
 # Get metadata and JSON files path based on edition
 def generate_paths(edition_name):
     edition_path = os.path.join('output', 'edition ' + str(edition_name))
@@ -74,13 +82,20 @@ def clean_attributes(attr_name):
 
 
 # Function to get attribure metadata
-def get_attribute_metadata(metadata_path):
+# With 'categorical', columns are turned into categoricals: each distinct trait is kept once
+def get_attribute_metadata(metadata_path, categorical=False):
 
     # Read attribute data from metadata file 
-    df = pd.read_csv(metadata_path)
+    # Traits are kept as strings, even if they look like numbers (e.g. '12.png') or missing values (e.g. 'NA.png'): the
+    # JSON values are the trait names, as in the JSON metadata written along with the images (see nft.get_render_tasks)
+    # With no missing values, every trait has a category in the fast path (see get_attribute_fragments)
+    df = pd.read_csv(metadata_path, dtype=str, keep_default_na=False)
     df = df.drop('Unnamed: 0', axis = 1)
     df.columns = [clean_attributes(col) for col in df.columns]
 
+    if categorical:
+        df = df.astype('category')
+
     # If zeros padd set to True...
     # Get zfill count based on number of images generated
     # -1 according to nft.py. Otherwise not working for 100 NFTs, 1000 NTFs, 10000 NFTs and so on
@@ -93,7 +108,210 @@ def get_attribute_metadata(metadata_path):
 
     return df, zfill_count
 
-# Main function that generates the JSON metadata
+
+# Get the JSON metadata (python dict) of a token given its attributes: {trait type (clean name): trait}
+def get_token_json(idx, attributes, zfill_count):
+
+    # Get a copy of the base JSON (python dict)
+    item_json = deepcopy(BASE_JSON)
+    
+    # Append number to base name 
+    item_json['name'] = item_json['name'] + str(idx)
+
+    # Append image file name (PNG, unless another IMAGE_ENCODER is set) to base image path
+    item_json['image'] = \
+        item_json['image'] + '/' + \
+        (str(idx).zfill(zfill_count) if ZEROS_PAD else str(idx)) + \
+        get_image_extension()
+
+    # Insert number to edition: Is added for the Base Metadata for Lighthouse
+    item_json['edition'] = idx
+    
+    # Add all existing traits to attributes dictionary
+    for attr in attributes:
+        
+        if attributes[attr] != 'none':
+            item_json['attributes'].append({ 'trait_type': attr, 'value': attributes[attr] })
+
+    return item_json
+
+
+# Get the JSON filename of a token
+# The original code lacks the adition of the '.json' extension
+def get_json_filename(idx, zfill_count):
+    return (str(idx).zfill(zfill_count) if ZEROS_PAD else str(idx)) + ".json"
+
+
+# Write the JSON metadata file of a token into a sink (see sinks.py)
+# Folder sinks write it atomically, so a file under its final name is always complete
+def write_token_json(json_sink, idx, attributes, zfill_count):
+    write_file(json_sink, get_json_filename(idx, zfill_count), json.dumps(get_token_json(idx, attributes, zfill_count)).encode(), idx)
+
+#------------------------------------------------------------------------------------
+# Fast path
+#
+# The JSON text of a token is assembled from pieces serialized once: BASE_JSON (all but the per token values) and one
+# fragment per distinct trait of each column. The result is byte-identical to json.dump of get_token_json's dictionary:
+# json.dump joins items with ', ' and keys with ': ', and the per token strings only append digits and the extension to
+# BASE_JSON's values, which never need escaping.
+#
+
+# Per token values of BASE_JSON
+TOKEN_FIELDS = ('name', 'image', 'edition', 'attributes')
+
+# Tokens per batch of files written by a thread
+METADATA_BATCH = 1000
+
+
+# Get BASE_JSON serialized as a template with '%(field)s' slots for the per token values
+def get_token_template():
+
+    # Placeholders go where the values would be, so keys keep the order of get_token_json
+    item_json = deepcopy(BASE_JSON)
+    for field in TOKEN_FIELDS:
+        item_json[field] = '\x00' + field + '\x00'
+
+    # '%' are escaped first, so only the slots are formatted
+    template = json.dumps(item_json).replace('%', '%%')
+    for field in TOKEN_FIELDS:
+        template = template.replace(json.dumps('\x00' + field + '\x00'), '%(' + field + ')s')
+
+    return template
+
+
+# Get the serialized attribute of each trait of a categorical column. None for 'none' (not an attribute)
+def get_attribute_fragments(trait_type, column):
+
+    fragments = np.empty(len(column.cat.categories), dtype=object)
+    for code, trait in enumerate(column.cat.categories):
+        fragments[code] = None if trait == 'none' else json.dumps({ 'trait_type': trait_type, 'value': trait })
+
+    return fragments
+
+
+# Write a batch of JSON files into a sink: (filename, text, token id) tuples
+def write_json_batch(json_sink, batch):
+    with measure('metadata.write'):
+        for filename, text, idx in batch:
+            write_file(json_sink, filename, text.encode(), idx)
+
+
+# Generate the JSON metadata of an existing edition, the fast way
+def generate_metadata_fast(edition_name):
+
+    edition_path, metadata_path, json_path = generate_paths(edition_name)
+
+    init_time = time.time()
+
+    # Get attribute data (read once, as categoricals) and zfill count (if it's the case)
+    with measure('metadata.read'):
+        df, zfill_count = get_attribute_metadata(metadata_path, categorical=True)
+
+    # Folder sinks are written by several threads. Archives and NDJSON files only have one writer
+    json_sink = open_sink(METADATA_SINK, json_path, df.shape[0])
+    workers = METADATA_WORKERS if is_shared_sink(METADATA_SINK) else 1
+
+    # Serialized attributes of each token, per column
+    with measure('metadata.serialize'):
+        columns = [get_attribute_fragments(col, df[col])[df[col].cat.codes.to_numpy()] for col in df.columns]
+
+    # Serialized pieces shared by all tokens. The closing quotes are left out, so per token strings can be appended
+    template = get_token_template()
+    name_prefix = json.dumps(BASE_JSON['name'])[:-1]
+    image_prefix = json.dumps(BASE_JSON['image'] + '/')[:-1]
+    extension = get_image_extension()
+    base_attributes = [json.dumps(attr) for attr in BASE_JSON['attributes']]
+
+    # Threads write the files while the next batches are assembled
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+
+        for start in progressbar(range(0, df.shape[0], METADATA_BATCH)):
+            stop = min(start + METADATA_BATCH, df.shape[0])
+
+            batch = []
+            with measure('metadata.serialize'):
+                for idx, fragments in zip(range(start, stop), zip(*[column[start:stop] for column in columns])):
+                    filename = str(idx).zfill(zfill_count) if ZEROS_PAD else str(idx)
+                    text = template % {
+                        'name': name_prefix + str(idx) + '"',
+                        'image': image_prefix + filename + extension + '"',
+                        'edition': str(idx),
+                        'attributes': '[' + ', '.join(base_attributes + [f for f in fragments if f is not None]) + ']'
+                    }
+                    batch.append((filename + '.json', text, idx))
+
+            futures.append(executor.submit(write_json_batch, json_sink, batch))
+
+            # Only a few batches are kept in memory, waiting to be written
+            if len(futures) > 2 * workers:
+                futures.pop(0).result()
+
+        for future in futures:
+            future.result()
+
+    with measure('metadata.write'):
+        close_sink(json_sink)
+
+    elapsed = max(time.time() - init_time, 1e-9)
+    print("%i JSON files written in %s seconds (%i rows/s)." % (df.shape[0], "{:.2f}".format(elapsed), df.shape[0] / elapsed))
+
+    save_metadata_report(edition_path, df.shape[0], elapsed)
+
+
+# Save the report of an edition's JSON metadata generation: its wall time and metrics (see metrics.py)
+# Files are written by several threads, so 'metadata.write' adds up the time of all of them
+def save_metadata_report(edition_path, count, seconds):
+
+    add_counters({'metadata.tokens': count})
+
+    report = {
+        'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'count': count,
+        'fast': METADATA_FAST,
+        'metadata_sink': METADATA_SINK,
+        'seconds': seconds
+    }
+    report.update(pop_metrics())
+
+    save_render_report(edition_path, report, METADATA_REPORT_FILE)
+    print_metrics(report)
+
+
+# Generate the JSON metadata of an existing edition
+# The fast path is used unless METADATA_FAST is set to False
+def generate_metadata(edition_name):
+
+    # The report only holds what's measured from now on
+    pop_metrics()
+
+    if METADATA_FAST:
+        generate_metadata_fast(edition_name)
+        return
+
+    edition_path, metadata_path, json_path = generate_paths(edition_name)
+
+    init_time = time.time()
+
+    # Get attribute data and zfill count (if it's the case)
+    with measure('metadata.read'):
+        df, zfill_count = get_attribute_metadata(metadata_path)
+
+    # Make the JSON sink (the json folder, by default)
+    json_sink = open_sink(METADATA_SINK, json_path, df.shape[0])
+
+    for idx, row in progressbar(df.iterrows()):    
+        
+        # Convert pandas series to dictionary, and write file to the JSON sink
+        with measure('metadata.write'):
+            write_token_json(json_sink, idx, dict(row), zfill_count)
+
+    with measure('metadata.write'):
+        close_sink(json_sink)
+
+    save_metadata_report(edition_path, df.shape[0], time.time() - init_time)
+
+# Main function that asks for the edition and generates its JSON metadata
 def main():
 
     # Get edition name
@@ -110,49 +328,9 @@ def main():
             print("Oops! Looks like this edition doesn't exist! Check your output folder to see what editions exist.")
             print("Enter edition you want to generate metadata for: ")
             continue
-    
-    # Make json folder
-    if not os.path.exists(json_path):
-        os.makedirs(json_path)
 
-    # Get attribute data and zfill count (if it's the case)
-    df, zfill_count = get_attribute_metadata(metadata_path)
-    
-    for idx, row in progressbar(df.iterrows()):    
-    
-        # Get a copy of the base JSON (python dict)
-        item_json = deepcopy(BASE_JSON)
-        
-        # Append number to base name 
-        item_json['name'] = item_json['name'] + str(idx)
-
-        # Append image PNG file name to base image path
-        item_json['image'] = \
-            item_json['image'] + '/' + \
-            (str(idx).zfill(zfill_count) if ZEROS_PAD else str(idx)) + \
-            '.png'
-
-        # Insert number to edition: Is added for the Base Metadata for Lighthouse
-        item_json['edition'] = idx
-        
-        # Convert pandas series to dictionary
-        attr_dict = dict(row)
-        
-        # Add all existing traits to attributes dictionary
-        for attr in attr_dict:
-            
-            if attr_dict[attr] != 'none':
-                item_json['attributes'].append({ 'trait_type': attr, 'value': attr_dict[attr] })
-        
-        # Write file to JSON_DIR folder
-        # The original code lacks the adition of the '.json' extension
-        item_assets_path = os.path.join(
-            json_path, 
-            (str(idx).zfill(zfill_count) if ZEROS_PAD else str(idx)) + ".json"
-            )
-        
-        with open(item_assets_path, 'w') as f:
-            json.dump(item_json, f)
+    generate_metadata(edition_name)
 
 # Run the main function
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+# Run metrics: wall time of each stage of a run, counters and peak memory, gathered into the edition's reports
+#
+# Stages are named after the step they measure, prefixed by their phase:
+#
+#   setup.*         assets scan, rarity CSVs, asset pack, restrictions (parse, setup, compile) and valid space
+#   sampling.*      sampling rounds, and within them: generation (validation included), validation and dedup
+#   render.*        per token: decode (on cache misses), composite, encode and write. 'render' is the whole loop
+#   metadata.*      metadata.py: reading metadata.csv, serializing and writing the JSON files
+#
+# Times are inclusive: a stage measured within another one (e.g. 'render.decode' within 'render.composite') is part of
+# its time too. Counters count what the stages deal with (rows sampled, rejected, duplicated, cache hits...).
+#
+# Metrics are gathered per process. pop_metrics takes the ones gathered since its last call, so every report (and every
+# chunk of a render worker) only holds its own. Render workers' metrics are added to the parent's (see add_metrics):
+# their stages add up over all workers, so they may take longer than the wall time of 'render' itself.
+#
+# With LIVE_METRICS, a JSON file is kept up to date during a run, to follow long ones (see update_live_metrics).
+# With PROFILE_RENDER, the render loop runs under cProfile (see start_profiler).
+
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from checkpoint import write_atomic
+from config import LIVE_METRICS_INTERVAL
+
+####################################################################################
+
+# GLOBALS
+
+# Files within the edition's folder: the live metrics (see start_live_metrics) and the render profile (see start_profiler)
+LIVE_METRICS_FILE = 'live_metrics.json'
+PROFILE_FILE = 'render_profile.pstats'
+
+# Time spent in each stage since the last pop_metrics: {name: {'seconds': total, 'calls': times measured}}
+STAGES = OrderedDict()
+
+# Counters since the last pop_metrics: {name: count}
+COUNTERS = OrderedDict()
+
+# Highest peak RSS (in bytes) reported by the render workers since the last pop_metrics
+WORKERS_PEAK = {'rss': None}
+
+# Metrics may be gathered by several threads at once (e.g. metadata.py's writers)
+LOCK = threading.Lock()
+
+# Live metrics file being kept up to date (see start_live_metrics):
+#   {'path', 'started', 'last' (time of the last update), 'info' (fixed fields, e.g. the edition),
+#    'first' (time and tokens done of the first progress update), 'progress' (latest tokens done and total)}
+LIVE = {}
+
+####################################################################################
+#
+# HELPER FUNCTIONS
+#
+#------------------------------------------------------------------------------------
+
+# Convert bytes into megabytes (None stays None)
+def to_mb(size):
+    return None if size is None else size / 2**20
+
+
+# Get a copy of the metrics gathered so far, without resetting them
+def get_metrics():
+
+    with LOCK:
+        peak = get_peak_rss()
+        metrics = {
+            'stages': {name: dict(stage) for name, stage in STAGES.items()},
+            'counters': dict(COUNTERS),
+            'peak_rss_mb': to_mb(peak)
+        }
+
+        if WORKERS_PEAK['rss'] is not None:
+            metrics['workers_peak_rss_mb'] = to_mb(WORKERS_PEAK['rss'])
+
+    return metrics
+
+
+# ======================================================================================
+#       PUBLIC
+# ======================================================================================
+
+# Get the peak resident memory of this process so far, in bytes. None where it can't be measured (Windows)
+def get_peak_rss():
+
+    if resource is None:
+        return None
+
+    # Kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Add the time of a stage measured by hand ('calls' times)
+def add_time(name, seconds, calls=1):
+
+    with LOCK:
+        stage = STAGES.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] += seconds
+        stage['calls'] += calls
+
+
+# Add to a counter
+def count(name, n=1):
+
+    with LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + n
+
+
+# Measure the time of a stage: 'with measure(name):'
+@contextmanager
+def measure(name):
+
+    init_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - init_time)
+
+
+# Add to several counters at once: {name: n}
+def add_counters(counters):
+    for name, n in counters.items():
+        count(name, n)
+
+
+# Add the metrics popped by another process (e.g. a render worker's chunk) to this process' own
+def add_metrics(metrics):
+
+    for name, stage in metrics['stages'].items():
+        add_time(name, stage['seconds'], stage['calls'])
+
+    add_counters(metrics['counters'])
+
+    peak = metrics['peak_rss_mb']
+    if peak is not None:
+        with LOCK:
+            WORKERS_PEAK['rss'] = max(WORKERS_PEAK['rss'] or 0, peak * 2**20)
+
+
+# Get the metrics gathered since the last call (or since the process started), and start gathering them from zero:
+#   'stages':               {name: {'seconds', 'calls'}}
+#   'counters':             {name: count}
+#   'peak_rss_mb':          peak RSS of this process so far (None where it can't be measured)
+#   'workers_peak_rss_mb':  highest peak RSS of the render workers, if any
+def pop_metrics():
+
+    metrics = get_metrics()
+
+    with LOCK:
+        STAGES.clear()
+        COUNTERS.clear()
+        WORKERS_PEAK['rss'] = None
+
+    return metrics
+
+
+# Print the stages and counters of some metrics
+def print_metrics(metrics):
+
+    print("Run metrics (peak memory: %s MB%s):" % (
+        '-' if metrics['peak_rss_mb'] is None else "{:.0f}".format(metrics['peak_rss_mb']),
+        ", render workers: %s MB" % "{:.0f}".format(metrics['workers_peak_rss_mb']) if 'workers_peak_rss_mb' in metrics else ""
+    ))
+
+    for name, stage in metrics['stages'].items():
+        print("  %-30s %10s s %10i calls" % (name, "{:.3f}".format(stage['seconds']), stage['calls']))
+    for name, n in metrics['counters'].items():
+        print("  %-30s %12i" % (name, n))
+
+
+#------------------------------------------------------------------------------------
+# Live metrics
+#
+
+# Start keeping a live metrics file up to date. 'info' are fixed fields written into it (e.g. the edition)
+def start_live_metrics(path, **info):
+
+    LIVE.clear()
+    LIVE.update({'path': path, 'started': time.time(), 'last': None, 'info': info})
+    update_live_metrics(force=True)
+
+
+# Update the live metrics file, at most every LIVE_METRICS_INTERVAL seconds unless forced. Nothing if there's none
+# Render progress ('done' out of 'total' tokens) adds the throughput and the time left. The latest one is kept
+def update_live_metrics(done=None, total=None, force=False, status='running'):
+
+    if not LIVE:
+        return
+
+    if done is not None:
+        LIVE['progress'] = (done, total)
+
+    now = time.time()
+    if not force and LIVE['last'] is not None and now - LIVE['last'] < LIVE_METRICS_INTERVAL:
+        return
+    LIVE['last'] = now
+
+    live = dict(LIVE['info'])
+    live.update({
+        'status': status,
+        'updated': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(now)),
+        'elapsed_seconds': now - LIVE['started']
+    })
+
+    if 'progress' in LIVE:
+        done, total = LIVE['progress']
+        since, first_done = LIVE.setdefault('first', (now, done))
+
+        rate = (done - first_done) / (now - since) if now > since else None
+        live.update({
+            'done': done,
+            'total': total,
+            'rate': rate,
+            'eta_seconds': (total - done) / rate if rate else None
+        })
+
+    live.update(get_metrics())
+
+    def write(temp_path):
+        with open(temp_path, 'w') as f:
+            json.dump(live, f, indent=4)
+
+    write_atomic(LIVE['path'], write)
+
+
+# Write the live metrics file a last time with the final status, and stop updating it
+def stop_live_metrics(status='complete'):
+
+    if LIVE:
+        update_live_metrics(force=True, status=status)
+        LIVE.clear()
+
+
+#------------------------------------------------------------------------------------
+# Profiling
+#
+
+# Start profiling this process with cProfile. Return the profiler
+def start_profiler():
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+# Stop a profiler and save its statistics
+def save_profile(profiler, path):
+    profiler.disable()
+    write_atomic(path, profiler.dump_stats)
+
+
+# Gather the profiles saved by several processes (e.g. render workers) into a single one. Their files are removed
+def merge_profiles(paths, path):
+
+    paths = [p for p in paths if os.path.isfile(p)]
+    if not paths:
+        return
+
+    stats = pstats.Stats(*paths)
+    write_atomic(path, stats.dump_stats)
+
+    for p in paths:
+        os.remove(p)
+
+
+# Print the functions that took the most time (cumulative) in a saved profile
+def print_profile(path, limit=15):
+
+    print("Render profile saved into '%s' (open it with 'python -m pstats'). Top %i functions:" % (path, limit))
+    pstats.Stats(path).sort_stats('cumulative').print_stats(limit)
@@ -4,24 +4,61 @@
 # Import required libraries
 import sys
 import math
-from PIL import Image
+import argparse
 import pandas as pd
 import numpy as np
 import time
 import os
 import random
-from progressbar import progressbar
+import hashlib
+from progressbar import progressbar, ProgressBar
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-from restriction_code import parse_restrictions, setup_restrictions, fix_trait, is_valid_trait, title_style
+from restriction_code import parse_restrictions, setup_restrictions, compile_restrictions, get_invalid_codes, \
+    confirm_continue
+from composite import composite_batch, to_image
+from valid_space import get_valid_space, new_ranker, draw_distinct_combinations
+from render_cache import composite_layers, get_render_cache_stats, merge_render_cache_stats, print_render_cache_stats, \
+    pop_occlusion_stats, merge_occlusion_stats, print_occlusion_stats, pop_cache_counters
+from metrics import measure, add_time, add_counters, add_metrics, pop_metrics, print_metrics, start_live_metrics, \
+    update_live_metrics, stop_live_metrics, start_profiler, save_profile, merge_profiles, print_profile, \
+    LIVE_METRICS_FILE, PROFILE_FILE
+from metadata import clean_attributes, get_json_filename, write_token_json
+from assetpack import update_asset_pack
+from asset_manifest import get_trait_files, get_asset_hashes, get_changed_traits
+from sinks import open_sink, close_sink, write_file, get_file_path, is_shared_sink, new_memory_sink, check_images_sink
+from encoder import encode_image, save_encoded_image, get_image_extension, save_encode_stats, print_encode_stats, \
+    load_encode_stats, get_visual_collisions, ENCODE_STATS_FILE
+from checkpoint import is_image_ok, save_checkpoint, save_manifest, load_manifest, save_render_report, load_render_report, \
+    REPORT_FILE, load_traits, get_traits_hash, get_shard_ids, save_shard_record, load_shard_records
 
 # These are general settings imports. Please review them in config.py
-from config import CONFIG, ASSETS_DIR, IMGS_DIR, ZEROS_PAD
+from config import CONFIG, ASSETS_DIR, IMGS_DIR, ZEROS_PAD, RENDER_WORKERS, PREFIX_CACHE_DEPTH, PREFIX_REORDER, \
+    COMPOSITE_ENGINE, COMPOSITE_BATCH, SEED, SAMPLING_MODE, RANK_WEIGHTED, SAMPLING_MEMORY_BYTES, JSON_DIR, FUSED_METADATA, \
+    IMAGES_SINK, METADATA_SINK, IMAGE_ENCODER, ASSET_PACK, LIVE_METRICS, PROFILE_RENDER
 
 # GLOBALS:
 RESTRICTIONS = {} # It will be updated with final restrictions' workable dictionary
+CONFLICTS = {} # It will be updated with the restrictions compiled into conflict matrices (see compile_restrictions)
+VALID_SPACE = {} # It will be updated with the exact figures of the valid combinations (see valid_space.get_valid_space)
+
+# Master seed: SEED (from config.py), or fresh entropy if it's None. Its entropy is recorded in each edition's manifest,
+# so setting SEED to it reproduces the edition
+SEED_SEQUENCE = np.random.SeedSequence(SEED)
+
+# Independent random generators derived from the master seed (see seed_generators):
+#   WEIGHTS_RNG draws the 'random' rarity weights, RNG draws the trait sets
+WEIGHTS_RNG, RNG = [np.random.default_rng(seed) for seed in SEED_SEQUENCE.spawn(2)]
+
+# Entropy of the master seed the 'random' rarity weights were drawn from (see parse_config). It's the edition's own seed,
+# unless the edition was re-seeded afterwards (e.g. by batch.py): both are recorded in the edition's manifest
+WEIGHTS_SEED = None
+
+# Render worker processes, kept alive from edition to edition so their decoded layers are re-used (see get_render_pool)
+RENDER_POOL = None
 
 # To minimize missmatches, trait name references within RESTRICTIONS and
 # PNG trait filenames are re-styled to 'Title Style'
@@ -35,23 +72,30 @@ RESTRICTIONS = {} # It will be updated with final restrictions' workable diction
 trait_file = {}
 
 
+# Re-seed the random generators from a new master seed (None for fresh entropy)
+# The 'random' rarity weights are drawn by parse_config: re-seeding afterwards only changes the trait sets drawn
+def seed_generators(seed):
+
+    global SEED_SEQUENCE, WEIGHTS_RNG, RNG
+
+    SEED_SEQUENCE = np.random.SeedSequence(seed)
+    WEIGHTS_RNG, RNG = [np.random.default_rng(child) for child in SEED_SEQUENCE.spawn(2)]
+
+
 # Parse the configuration file and make sure it's valid
 def parse_config():
 
+    global WEIGHTS_SEED
+    WEIGHTS_SEED = SEED_SEQUENCE.entropy
+
     # Collect new CSVs if recently created
     new_CSVs = []
 
     # Loop through all layers defined in CONFIG
     for layer in CONFIG:
 
-        # Go into assets/ to look for layer folders
-        layer_path = os.path.join(ASSETS_DIR, layer['directory'])
-        
-        # Make a reference of fixed and re-styled trait names to PNG trait filenames
-        trait_name = {
-            title_style(fix_trait(tr_file)): tr_file \
-                for tr_file in os.listdir(layer_path) if is_valid_trait(tr_file, layer_path)
-        }
+        # Make a reference of fixed and re-styled trait names to PNG trait filenames (scanned once, see asset_manifest)
+        trait_name = get_trait_files(layer)
 
         # Update map: re-styled trait names to corresponding PNG trait filenames
         trait_file[layer['name']] = trait_name
@@ -67,11 +111,12 @@ def parse_config():
         if layer['rarity_weights'] is None:
             rarities = [1 for x in traits]
         elif layer['rarity_weights'] == 'random':
-            rarities = [random.random() for x in traits]
+            rarities = WEIGHTS_RNG.random(len(traits)).tolist()
         elif layer['rarity_weights'] == 'file':
 
             # Get rarities from a CSV file
-            rarities, new_csv = get_rarities_from_csv(layer, traits)
+            with measure('setup.rarity_csv'):
+                rarities, new_csv = get_rarities_from_csv(layer, traits)
             
             # Collect CSV filename only if newly created
             if new_csv:
@@ -90,6 +135,9 @@ def parse_config():
         layer['cum_rarity_weights'] = np.cumsum(rarities)
         layer['traits'] = traits
 
+        # Trait names as they appear in the tables, indexed by trait code (the trait's index in 'traits')
+        layer['trait_names'] = np.array(['none' if trait is None else trait for trait in traits], dtype=object)
+
     return new_CSVs
 
 
@@ -188,25 +236,21 @@ def get_weighted_rarities(arr):
 
 
 # Generate a single image given an array of filepaths representing layers
+# Absent layers may be given as None, so bottom layers' composites can be re-used (see PREFIX_CACHE_DEPTH)
 def generate_single_image(filepaths, output_filename=None):
     
-    # Treat the first layer as the background
-    bg = Image.open(os.path.join(ASSETS_DIR, filepaths[0]))
-    
-    # Loop through layers 1 to n and stack them on top of another
-    for filepath in filepaths[1:]:
-        if filepath.endswith('.png'):
-            img = Image.open(os.path.join(ASSETS_DIR, filepath))
-            bg.paste(img, (0,0), img)
+    # Stack layers 0 to n on top of another. The first layer is the background
+    bg = composite_layers(filepaths)
     
-    # Save the final image into desired location
+    # Save the final image into desired location, encoded with the IMAGE_ENCODER (see encoder.py)
+    # Images are written atomically, so an interrupted job never leaves a truncated file under its final name
     if output_filename is not None:
-        bg.save(output_filename)
+        save_encoded_image(bg, output_filename)
     else:
         # If output filename is not specified, use timestamp to name the image and save it in output/single_images
         if not os.path.exists(os.path.join('output', 'single_images')):
             os.makedirs(os.path.join('output', 'single_images'))
-        bg.save(os.path.join('output', 'single_images', str(int(time.time())) + '.png'))
+        save_encoded_image(bg, os.path.join('output', 'single_images', str(int(time.time())) + get_image_extension()))
 
 
 # Get total number of distinct possible combinations
@@ -218,52 +262,103 @@ def get_total_combinations():
     return total
 
 
-# Select an index based on rarity weights
-def select_index(cum_rarities, rand):
-    
-    cum_rarities = [0] + list(cum_rarities)
-    for i in range(len(cum_rarities) - 1):
-        if rand >= cum_rarities[i] and rand <= cum_rarities[i+1]:
-            return i
-    
-    # Should not reach here if everything works okay
-    return None
+# Draw 'count' random trait sets at once, as a (count x layers) matrix of trait codes
+def sample_trait_codes(count, rng=None):
+    """
+    A trait code is the index of the trait within its layer's 'traits' list (and 'trait_names').
 
+    Each layer is sampled with a single searchsorted over its cumulative rarity weights. Random numbers are scaled to the last cumulative weight, so floating point rounding can never leave a number without a trait. Traits with a weight of zero are never drawn.
+    """
 
-# Generate a set of traits given rarities
-def generate_trait_set_from_config():
-    
-    trait_set = []
-    
-    for layer in CONFIG:
-        # Extract list of traits and cumulative rarity weights
-        traits, cum_rarities = layer['traits'], layer['cum_rarity_weights']
+    if rng is None:
+        rng = RNG
 
-        # Generate a random number
-        rand_num = random.random()
+    codes = np.empty((count, len(CONFIG)), dtype=np.int32)
 
-        # Select an element index based on random number and cumulative rarity weights
-        idx = select_index(cum_rarities, rand_num)
+    for j, layer in enumerate(CONFIG):
+        cum_rarities = layer['cum_rarity_weights']
+        codes[:, j] = np.searchsorted(cum_rarities, rng.random(count) * cum_rarities[-1], side='right')
 
-        # Add selected trait to trait set
-        trait_set.append(traits[idx])
+    return codes
 
-    return trait_set
+
+# Draw 'count' random trait sets layer by layer, never picking a trait forbidden by the ones already drawn
+def sample_valid_trait_codes(count, rng=None):
+    """
+    Layers are drawn in CONFIG order. For each avatar, the traits restricted by its traits of previous layers (see CONFLICTS) are masked out, and the rarity weights of the remaining ones are re-normalized. Thus, rows are valid by construction.
+
+    Rows may only be lost when all traits of a layer are masked out (e.g. an All/None issue reported by setup_restrictions). Those rows are dropped, so fewer than 'count' rows may be returned.
+
+    Take notice that the resulting distribution is NOT the one of the rejection sampling (SAMPLING_MODE = 'rejection'):
+    rejection keeps the avatars drawn with the plain rarity weights that happen to be valid, so a trait involved in many restrictions becomes rarer than its weight, whichever layer it belongs to. Here, the first layers keep their rarity weights exactly, while the later layers absorb the whole effect of the restrictions: their allowed traits become more frequent to make up for the masked ones.
+    """
+
+    if rng is None:
+        rng = RNG
+
+    codes = np.empty((count, len(CONFIG)), dtype=np.int32)
+    alive = np.ones(count, dtype=bool)
+
+    for j, layer in enumerate(CONFIG):
+
+        # Mask out the traits restricted by the ones already drawn
+        weights = np.broadcast_to(layer['rarity_weights'], (count, len(layer['traits']))).copy()
+        for i in range(j):
+            if (i, j) in CONFLICTS:
+                weights[CONFLICTS[(i, j)][codes[:, i]]] = 0
+
+        # Draw within the remaining traits, re-normalizing their weights
+        cum_rarities = np.cumsum(weights, axis=1)
+        total = cum_rarities[:, -1]
+        rand = rng.random(count) * total
+        codes[:, j] = np.minimum((cum_rarities <= rand[:, None]).sum(axis=1), len(layer['traits']) - 1)
+
+        # Dead ends: no trait left for this layer
+        alive &= total > 0
+
+    return codes[alive]
+
+
+# Convert a matrix of trait codes into a table (dataframe) of trait names
+def get_table_from_codes(codes):
+    return pd.DataFrame({layer['name']: layer['trait_names'][codes[:, j]] for j, layer in enumerate(CONFIG)})
+
+
+# Generate a set of traits given rarities
+def generate_trait_set_from_config():
+    return [CONFIG[j]['traits'][code] for j, code in enumerate(sample_trait_codes(1)[0])]
 
 
 # Get the corresponding traits paths set from given traits set
 def generate_paths_set_from_traits(traits_set):
+    return [path for path in generate_layer_paths_from_traits(traits_set) if path is not None]
+
+
+# Get the traits paths per layer from given traits set. Absent traits get a None
+def generate_layer_paths_from_traits(traits_set):
     traits_path = []
     for idx, trait in enumerate(traits_set):
 
-        # skip the none trait. There's no PNG equivalent
-        if (trait.lower() != 'none') and (trait is not None):
-            trait_path = os.path.join(CONFIG[idx]['directory'], trait_file[CONFIG[idx]['name']][trait])
-            traits_path.append(trait_path)
+        # the none trait has no PNG equivalent
+        if (trait is not None) and (trait.lower() != 'none'):
+            traits_path.append(os.path.join(CONFIG[idx]['directory'], trait_file[CONFIG[idx]['name']][trait]))
+        else:
+            traits_path.append(None)
 
     return traits_path
 
 
+# Get the order in which avatars are rendered
+# Avatars sharing bottom layers are grouped together, so their partial composites are re-used
+def get_render_order(rarity_table):
+
+    if not PREFIX_REORDER or PREFIX_CACHE_DEPTH == 0:
+        return rarity_table
+
+    # The stable sort keeps the index (the avatar's number) attached to its row
+    return rarity_table.sort_values(list(rarity_table.columns[:PREFIX_CACHE_DEPTH]), kind='stable')
+
+
 # Validate image's trait set: Image should not break a rule. Return True if it does!
 def is_image_invalid(row):
     
@@ -299,247 +394,1099 @@ def is_image_invalid(row):
     return False
 
 
-# Generate a table of raw data images based on random traits
-def generate_imgs_table(count, prog_bar=False):
+# Generate a matrix of valid trait codes (raw data images) based on random traits
+def generate_imgs_table(count):
 
     # The table size won't be equal to 'count' since it'll be purged
-    # 'prog_bar' is to inform the advanced of the operation...
-    # ...however, since first samples are small, no need to inform, hence 'prog_bar' is False
+    # Duplicates are dropped later on, against the dedup index of all accepted avatars (see add_to_dedup_index)
 
-    # Initialize an empty rarity table
-    rarity_table = {}
-    for layer in CONFIG:
-        rarity_table[layer['name']] = []
+    # Traits are drawn already valid
+    if SAMPLING_MODE == 'sequential':
+        return sample_valid_trait_codes(count)
 
-    # Wrap iterator range object with other iterator if prog_bar given
-    iter_obj = lambda rng_obj: progressbar(rng_obj,) if prog_bar else rng_obj
-      
-    # Generate traits rows data. Images not yet
-    for _ in iter_obj(range(count)):
+    elif SAMPLING_MODE != 'rejection':
+        raise ValueError("SAMPLING_MODE is invalid: expected 'rejection', 'sequential' or 'unrank'")
 
-        # Get a random set of valid traits based on rarity weights
-        trait_sets = generate_trait_set_from_config()
+    # Generate traits rows data, all at once. Images not yet
+    codes = sample_trait_codes(count)
 
-        # Populate the rarity table with metadata of newly created image
-        for idx, trait in enumerate(trait_sets):
-            if trait is not None:
-                rarity_table[CONFIG[idx]['name']].append(trait)
-            else:
-                rarity_table[CONFIG[idx]['name']].append('none')
+    # Check and remove invalid images (the ones that violate any rule)
+    with measure('sampling.validate'):
+        invalid = get_invalid_codes(codes, CONFLICTS)
 
-    # Inform user of task advance if prog_bar given
-    if prog_bar:
-        init_time = time.time()
-        print("Depurating table from duplicates and non-valid avatars. This may take a while. Please be patient...")
+    return codes[~invalid]
 
-    # Create a Data Frame
-    rarity_table = pd.DataFrame(rarity_table)
 
-    # Check and remove invalid images (the ones that violate any rule)
-    invalid_imgs = rarity_table.apply(is_image_invalid, axis=1)
-    invalid_imgs = invalid_imgs[invalid_imgs]
-    rarity_table.drop(invalid_imgs.index, inplace=True)
+# Get the number of candidate rows per chunk, so the sampling of a chunk fits into SAMPLING_MEMORY_BYTES
+def get_chunk_rows():
 
-    # Drop duplicates
-    rarity_table.drop_duplicates(inplace=True)
+    n_layers = len(CONFIG)
 
-    # Inform user the end of task if prog_bar given
-    if prog_bar:
-        end_time = time.time()
-        print("...depuration completed in %s seconds!" % ("{:2.2f}".format(end_time - init_time)))
+    # Trait codes (int32), random numbers (float64), validation flags and packed keys with their sorting copies
+    row_bytes = 4 * n_layers + 8 * n_layers + 2 * len(CONFLICTS) + 32 * len(get_key_groups())
 
-    return rarity_table
+    # Sequential sampling keeps, for a layer, its masked and cumulative weights (float64) and two boolean matrices: the
+    # restricted traits (a fancy-indexed copy of a conflict) and the cumulative weights below the random number. Then the
+    # drawn codes (int64, and their clipped copy), the dead ends' flags and the copy of the rows left alive
+    if SAMPLING_MODE == 'sequential':
+        row_bytes += 18 * max(len(layer['traits']) for layer in CONFIG) + 16 + 1 + 4 * n_layers
 
+    return max(1000, SAMPLING_MEMORY_BYTES // row_bytes)
 
-# Generate table with exact number of request data images, all distinct and depurated
-def generate_exact_imgs_table(count):
+
+# Split the layers into consecutive groups whose packed keys fit into an int64
+def get_key_groups():
+    """
+    A trait set is packed into a single mixed-radix integer, each layer's radix being its number of traits. When the total number of combinations doesn't fit into an int64, layers are split into groups and a trait set is keyed by one int64 per group.
     """
-    To create a table with an exact number of requested data images (all distinct and purified), we must gather preliminary statistics. This step is crucial, especially when handling requests for hundreds of thousands or even millions of avatar images.
 
-    In the previous script version, the entire image set was generated first, followed by the purification process. However, image production is significantly more computationally expensive than creating a trait-based dataset. Moreover, images are unnecessary for purging repetitions and bad images that do not comply with the RESTRICTIONS_CONFIG settings. All we need to accomplish the task is the raw data's table of trait sets.
+    groups = []
+    start, size = 0, 1
+    for j, layer in enumerate(CONFIG):
+        radix = len(layer['traits'])
+        if size * radix >= 2**63:
+            groups.append((start, j))
+            start, size = j, 1
+        size *= radix
+    groups.append((start, len(CONFIG)))
 
-    The assertion rate of valid images varies unpredictably based on the complexity of the restrictions settings. Therefore, before embarking on the production of a traits dataset on a large scale, it is advisable to assess the complexity using small samples. This function achieves precisely that. It tests ten samples, each containing one thousand data images, to measure the assertion rate before generating the entire set. Armed with these firsthand statistics, we can confidently request the necessary oversized image data table, ensuring that after depuration, we achieve the requested size with an accuracy of 97.5%.
-    """
+    return groups
+
+
+# Pack each row of trait codes into a single key: an int64, or a record of int64s if it doesn't fit
+def pack_codes(codes):
+
+    groups = get_key_groups()
+
+    keys = np.zeros((codes.shape[0], len(groups)), dtype=np.int64)
+    for g, (start, end) in enumerate(groups):
+        for j in range(start, end):
+            keys[:, g] *= len(CONFIG[j]['traits'])
+            keys[:, g] += codes[:, j]
+
+    if len(groups) == 1:
+        return keys[:, 0]
 
-    # For statistics:
-    n = 10     # --> Number of samples
-    m = 1000   # --> Number of traits dataset per sample (table)
-    results = [] # --> Collect n assertion rates per sample
+    # A record per row, so rows can be sorted and compared as a whole
+    dtype = np.dtype([('k%i' % g, np.int64) for g in range(len(groups))])
+    return np.ascontiguousarray(keys).view(dtype)[:, 0]
 
-    # Initialize an empty table: It'll append each new table as it's been produced
-    master_rt = pd.DataFrame()
 
-    # Generate n tables to collect their assertion rates
-    for _ in range(n):
+# Get an empty dedup index: the sorted keys of all accepted avatars plus their trait codes in acceptance order
+def new_dedup_index():
+    return {'keys': pack_codes(np.empty((0, len(CONFIG)), dtype=np.int32)), 'codes': [], 'count': 0}
 
-        # Generate a table of m images (rows)
-        # The resulting table will have only the valid traits datasets after depuration
-        rt = generate_imgs_table(m)
 
-        # Concatenate current table with master one... thus not wasting previous job
-        master_rt = pd.concat([master_rt, rt])
+# Add the new distinct trait sets from given codes to the dedup index
+# Return how many were accepted and how many were distinct within given codes
+def add_to_dedup_index(dedup_index, codes):
 
-        # master table may be the final if it has more traits set than requested
-        if master_rt.shape[0] >= count:
+    # Distinct keys within the batch, keeping the first occurrence of each one
+    keys = pack_codes(codes)
+    keys, first = np.unique(keys, return_index=True)
 
-            # If after dropping duplicates, still have more than requested. Just use it!
-            master_rt.drop_duplicates(inplace=True)
-            if master_rt.shape[0] >= count:
-                break
+    # Look for them in the index of accepted keys (sorted), without re-scanning the accepted avatars
+    accepted = dedup_index['keys']
+    pos = np.searchsorted(accepted, keys)
+    found = pos < accepted.shape[0]
+    found[found] = accepted[pos[found]] == keys[found]
 
-        # Collect the statistic: The percentage rate of assertion
-        results.append(rt.shape[0] / m)
+    # Insert the new keys in place, so the index stays sorted
+    new = ~found
+    dedup_index['keys'] = np.insert(accepted, pos[new], keys[new])
 
+    # Keep the new avatars in the same order they were sampled
+    new_codes = codes[np.sort(first[new])]
+    dedup_index['codes'].append(new_codes)
+    dedup_index['count'] += new_codes.shape[0]
+
+    return new_codes.shape[0], keys.shape[0]
+
+
+# Get all trait codes accepted into the dedup index
+def get_dedup_index_codes(dedup_index):
+    if not dedup_index['codes']:
+        return np.empty((0, len(CONFIG)), dtype=np.int32)
+    return np.concatenate(dedup_index['codes'])
+
+
+# Generate table with exact number of request data images, drawing distinct ranks of valid combinations
+def generate_unranked_imgs_table(count):
+
+    print("Drawing %i distinct avatars out of the %i valid combinations (%s)..." % \
+          (count, VALID_SPACE['count'], 'weighted' if RANK_WEIGHTED else 'uniform'))
+    init_time = time.time()
+
+    # Python's random handles ranks of any size. It's seeded from RNG, so SEED still applies
+    rnd = random.Random(int(RNG.integers(2**63)))
+    with measure('sampling.unrank'):
+        codes = draw_distinct_combinations(new_ranker(CONFIG, CONFLICTS), count, VALID_SPACE['count'], RANK_WEIGHTED, rnd)
+    add_counters({'sampling.accepted': codes.shape[0]})
+
+    print("...completed in %s seconds!" % "{:2.2f}".format(time.time() - init_time))
+    print()
+
+    return get_table_from_codes(codes)
+
+
+# Get the size of the next table to sample so it yields 'missing' new distinct valid avatars with a 97.5% probability
+def get_next_table_size(missing, accepted):
+    """
+    Sizing relies on the exact figures of the valid space (see valid_space.get_valid_space), not on sampled statistics:
+
+        - A row is valid with probability p: the exact acceptance rate of rejection sampling (1 for sequential sampling).
+        - Out of V valid combinations (exact), 'accepted' are already taken. Getting 'missing' new ones out of the U = V - accepted left takes about V * ln(U / (U - missing)) valid rows, as if they were equally likely (V * (ln U + 0.58) to get them all: the coupon collector's problem).
+
+    The number of valid rows out of n is ~ Binomial(n, p). The smallest n whose mean minus two standard deviations reaches the valid rows needed is returned:
+
+        n p - 2 sqrt(n p (1 - p)) >= needed
+    """
+
+    p = 1.0 if SAMPLING_MODE == 'sequential' else VALID_SPACE['acceptance']
+    valid_count = VALID_SPACE['count']
+
+    # Valid combinations exist, but the rarity weights never draw them (e.g. their traits weigh 0)
+    if p <= 0:
+        raise ValueError("No trait set drawn with the rarity weights complies with the restrictions settings, though %i " \
+                         "combinations do. Give their traits some weight, or set SAMPLING_MODE to 'sequential' or " \
+                         "'unrank' (with RANK_WEIGHTED = False) in config.py." % valid_count)
+    left = valid_count - accepted
+
+    # Valid rows needed to find 'missing' distinct new ones
+    if missing >= left:
+        needed = valid_count * (math.log(left) + 0.5772)
     else:
+        needed = valid_count * (math.log(left) - math.log(left - missing))
+    needed = max(needed, missing)
 
-        # Get the stats
-        results = np.array(results)
-        mean = np.mean(results)
-        stDev = np.std(results)
+    # Solve the inequality for sqrt(n)
+    b = 2 * math.sqrt(p * (1 - p))
+    x = (b + math.sqrt(b * b + 4 * p * needed)) / (2 * p)
 
-        if mean == 0.0:
-            print()
-            print("Failed to generate images!")
-            print("Restrictions settings (in RESTRICTIONS_CONFIG) are impossible to comply:")
-            print("From %i attempts, no single image was able to generate." % (n * m))
-            print("Take a deeper look to RESTRICTIONS_CONFIG settings and loose them up.")
-            print("Execution aborted!")
-            quit()
+    return max(math.ceil(x * x), missing)
 
-        elif mean < 0.05:
 
-            # Less than 5% of assertion rate!
-            print()
-            print("WARNING:")
-            print("From %i attempts it was only able to generate %s%% images." % (n * m, "{:2.2f}".format(mean * 100.0)))
-            print("The total generation of %s images may fail or consume a lot of time and resources." % count)
-            print("There might be not enough traits to make distinct combinations, or restrictions settings (in RESTRICTIONS_CONFIG) are very tough. It'll be recommended to make a deep review of them.")
-            print()
-            
-            while True:
-                resp = input("Despite warnings, do you want to continue Y/N?")
-                
-                if resp.lower() == 'y':
-                    print("Ok, let's try!...")
-                    break
+# Generate table with exact number of request data images, all distinct and depurated
+def generate_exact_imgs_table(count):
+    """
+    To create a table with an exact number of requested data images (all distinct and purified), the script generates an oversized table of raw trait sets and depurates it. This step is crucial, especially when handling requests for hundreds of thousands or even millions of avatar images.
+
+    In the previous script version, the entire image set was generated first, followed by the purification process. However, image production is significantly more computationally expensive than creating a trait-based dataset. Moreover, images are unnecessary for purging repetitions and bad images that do not comply with the RESTRICTIONS_CONFIG settings. All we need to accomplish the task is the raw data's table of trait sets.
+
+    The assertion rate of valid images depends on the complexity of the restrictions settings. Instead of measuring it with small samples, it's computed exactly beforehand (VALID_SPACE, see valid_space.py), along with the exact number of valid combinations. Armed with these figures, we know at once if the request is feasible, and we can confidently request the necessary oversized image data table, ensuring that after depuration, we achieve the requested size with a probability of 97.5%.
+    """
+
+    valid_count = VALID_SPACE['count']
+    acceptance = VALID_SPACE['acceptance']
+
+    if valid_count == 0:
+        print()
+        print("Failed to generate images!")
+        print("Restrictions settings (in RESTRICTIONS_CONFIG) are impossible to comply:")
+        print("There's no single trait combination complying with all of them.")
+        print("Take a deeper look to RESTRICTIONS_CONFIG settings and loose them up.")
+        print("Execution aborted!")
+        quit()
+
+    elif count > valid_count:
+        print()
+        print("WARNING:")
+        print("Only %i distinct trait combinations comply with the restrictions settings (in RESTRICTIONS_CONFIG)." % valid_count)
+        print("It's not possible to generate %i distinct images. Only %i images will be produced." % (count, valid_count))
+        print()
+        count = valid_count
 
-                elif resp.lower() == 'n':
-                    print("Execution aborted!")
-                    quit()
+    # Draw distinct valid avatars straight away: no rejections, no duplicates
+    if SAMPLING_MODE == 'unrank':
+        return generate_unranked_imgs_table(count)
+
+    if SAMPLING_MODE == 'rejection' and acceptance < 0.05:
+
+        # Less than 5% of assertion rate!
+        print()
+        print("WARNING:")
+        print("Only %s%% of the trait sets drawn with the rarity weights comply with the restrictions settings." % "{:2.2f}".format(acceptance * 100.0))
+        print("The total generation of %s images may consume a lot of time and resources." % count)
+        print("The restrictions settings (in RESTRICTIONS_CONFIG) are very tough. It'll be recommended to make a deep review of them, or to set SAMPLING_MODE to 'sequential' in config.py.")
+        print()
+        
+        confirm_continue('low_acceptance', "Despite warnings, do you want to continue Y/N?")
+        print("Ok, let's try!...")
 
-        # Try up to 10 times to get the missing traits dataset to fill the 'count' requested
-        for i in range(10):
+    # Initialize an empty dedup index: It'll accept the new distinct avatars of each table as it's been produced
+    dedup_index = new_dedup_index()
 
-            # Get the size for next table.
-            next_table_size = math.ceil((count - master_rt.shape[0]) / (mean - 2 * stDev))
+    # Tables are streamed in chunks: sample -> validate -> dedup -> accept, never holding more than a chunk at once
+    chunk_rows = get_chunk_rows()
 
-            print("We have already %i distintict and aproved avatars." % (master_rt.shape[0]))
+    # Try up to 10 times to get the missing traits dataset to fill the 'count' requested
+    for i in range(10):
+
+        # Get the size for next table.
+        # Sizing assumes valid combinations are equally likely, but the rarity weights make some of them rare.
+        # Each failed attempt doubles the size: tables are streamed and stop early, so an oversized one costs nothing
+        next_table_size = get_next_table_size(count - dedup_index['count'], dedup_index['count']) * 2**i
+
+        # Small tables are generated silently
+        verbose = next_table_size > 10000
+
+        if verbose:
+            print("We have already %i distintict and aproved avatars." % (dedup_index['count']))
             print("Due to an assertion rate of {:.2f}%, we have to generate {} aditional image data to fulfill the {} requested."\
-                  .format(mean * 100, next_table_size, count))
+                  .format((1.0 if SAMPLING_MODE == 'sequential' else acceptance) * 100, next_table_size, count))
             print("Remember that not all data images generated are incorpotated, because some are duplicates or fail to pass the restriction rules.")
             print("We have a 97.50% probability to acomplish the goal in the next atempt.")
             print()
-            print("Attempt %i of 10: Generating %i new images data..." % (i + 1, next_table_size))
+            print("Attempt %i of 10: Generating up to %i new images data, in chunks of %i..." % (i + 1, next_table_size, chunk_rows))
 
-            # Generate the next table and concatenate to the master one
-            # With given stats, we expect 97.5% chances to get enough depurated traits dataset in the first attempt
-            rt = generate_imgs_table(next_table_size, True)
-            master_rt = pd.concat([master_rt, rt])
-            master_rt.drop_duplicates(inplace=True)
+        # Stream the next table and add its new distinct avatars to the master index
+        # With given figures, we expect 97.5% chances to get enough depurated traits dataset in the first attempt
+        init_time = time.time()
+        generated = valid = accepted = 0
+        dedup_time = 0.0
+        missing = count - dedup_index['count']
+
+        chunks = range(math.ceil(next_table_size / chunk_rows))
+        with measure('sampling.round'):
+            for _ in (progressbar(chunks) if verbose else chunks):
+
+                rows = min(chunk_rows, next_table_size - generated)
+                with measure('sampling.generate'):
+                    rt = generate_imgs_table(rows)
+
+                # Drop duplicates against all avatars accepted so far
+                generated += rows
+                valid += rt.shape[0]
+                dedup_init_time = time.time()
+                with measure('sampling.dedup'):
+                    accepted += add_to_dedup_index(dedup_index, rt)[0]
+                dedup_time += time.time() - dedup_init_time
+
+                update_live_metrics()
+
+                # Stop as soon as we have enough
+                if dedup_index['count'] >= count:
+                    break
 
-            # Check if we reach the goal
-            if master_rt.shape[0] >= count:
+        # Rejected rows break a restriction (with sequential sampling: they're left without any trait for some layer)
+        # New distinct avatars beyond the requested count are chopped off at the end: they're 'surplus', not accepted
+        add_counters({
+            'sampling.rows': generated,
+            'sampling.rejected': generated - valid,
+            'sampling.duplicates': valid - accepted,
+            'sampling.surplus': max(accepted - missing, 0),
+            'sampling.accepted': min(accepted, missing)
+        })
+
+        if verbose:
+            elapsed = max(time.time() - init_time, 1e-9)
+            print("...%i rows generated, %i valid, %i new distinct avatars in %s seconds (%i rows/s generated, %i rows/s accepted)." % \
+                  (generated, valid, accepted, "{:2.2f}".format(elapsed), generated / elapsed, accepted / elapsed))
+            print("...Deduplication completed in %s seconds!" % "{:2.2f}".format(dedup_time))
+
+        # Check if we reach the goal
+        if dedup_index['count'] >= count:
+            if verbose:
                 print()
-                break
+            break
 
-            else:
+        else:
 
-                # Didn't reach the goal.
-                # This is a rare 2.5% case of failing in previous attempt 
-                # However, the newly traits dataset have been integrated
-                # Try again only for the remaing. 
-                # There's a 97.5% chance that next iteration will fullfill
+            # Didn't reach the goal.
+            # This is a rare 2.5% case of failing in previous attempt 
+            # However, the newly traits dataset have been integrated
+            # Try again only for the remaing. 
+            # There's a 97.5% chance that next iteration will fullfill
+            if verbose:
                 print("Last generated table wasn't enough to produce the avatar images requested.")
                 print()
 
-        else:
-
-            # It fails to get the missing data. Is virtually impossible.
-            print("After 10 attempts it wasn't possible to generate a table for all images required.")
-            print("Only %i distinct and valid images will be be produced." % master_rt.shape[0])
-            print()
+    else:
 
-    # Modify final rarity table to reflect removals
-    master_rt.reset_index(inplace=True)
-    master_rt.drop('index', axis=1, inplace=True)
+        # It fails to get the missing data. Is virtually impossible.
+        print("After 10 attempts it wasn't possible to generate a table for all images required.")
+        print("Only %i distinct and valid images will be be produced." % dedup_index['count'])
+        print()
 
-    # Chop the excess of rows so to match to requested 'count'
-    master_rt.drop(master_rt[master_rt.index>= count].index, inplace=True)
+    # Chop the excess of rows so to match to requested 'count', and make the final rarity table
+    master_rt = get_table_from_codes(get_dedup_index_codes(dedup_index)[:count])
 
     return master_rt
 
 
+# Print the realized frequency of each trait in the rarity table next to its target (its rarity weight)
+def print_trait_frequencies(rarity_table):
+
+    # With rejection sampling, the exact expected frequencies are known too (the marginals of the valid space)
+    expected = (SAMPLING_MODE == 'rejection' or (SAMPLING_MODE == 'unrank' and RANK_WEIGHTED)) and 'marginals' in VALID_SPACE
+
+    print("Trait frequencies: realized vs target (rarity weights)%s" % (" [expected with restrictions]" if expected else ""))
+
+    for j, layer in enumerate(CONFIG):
+        realized = rarity_table[layer['name']].value_counts(normalize=True)
+
+        print("  %s:" % layer['name'])
+        for k, (trait, target) in enumerate(zip(layer['trait_names'], layer['rarity_weights'])):
+            print("    %-30s %7s%%  vs  %7s%%%s" % \
+                  (trait, "{:.2f}".format(100 * realized.get(trait, 0.0)), "{:.2f}".format(100 * target),
+                   "  [%7s%%]" % "{:.2f}".format(100 * VALID_SPACE['marginals'][j][k]) if expected else ""))
+
+    print()
+
+
+# Get the image filename of an avatar given its index
+# Files are given their final name right away: zeros padded, unless ZEROS_PAD is set to False
+# The extension is the one of the IMAGE_ENCODER (see encoder.py)
+def get_img_name(idx, zfill_count):
+    return (str(idx).zfill(zfill_count) if ZEROS_PAD else str(idx)) + get_image_extension()
+
+
+# Check if an avatar's image has already been rendered into a (folder) sink and verifies
+def is_rendered(idx, image_sink, zfill_count):
+    return is_shared_sink(image_sink['kind']) and is_image_ok(get_file_path(image_sink, get_img_name(idx, zfill_count)))
+
+
+# Get the avatars to render as (index, layers' PNG paths, attributes) tasks, in render order
+# With a 'json_sink', attributes are the ones of the token's JSON metadata (see metadata.py). Otherwise, they're None
+# When resuming, the avatars already rendered (and their JSON, if required) are left out
+def get_render_tasks(rarity_table, image_sink=None, zfill_count=None, resume=False, json_sink=None):
+
+    # Same trait types as the ones metadata.py reads from metadata.csv
+    trait_types = [clean_attributes(name) for name in rarity_table.columns]
+
+    def is_done(idx):
+        if json_sink is not None and not (is_shared_sink(json_sink['kind']) and \
+                                          os.path.isfile(get_file_path(json_sink, get_json_filename(idx, zfill_count)))):
+            return False
+        return is_rendered(idx, image_sink, zfill_count)
+
+    render_table = get_render_order(rarity_table)
+    return [
+        (idx, generate_layer_paths_from_traits(list(traits)), None if json_sink is None else dict(zip(trait_types, traits))) \
+            for idx, traits in zip(render_table.index, render_table.itertuples(index=False)) \
+            if not (resume and is_done(idx))
+    ]
+
+
+# Follow the rendered avatars with a progress bar that starts at the ones already done
+# The live metrics file (if any) follows them too
+def track_progress(iterable, total, done):
+
+    bar = ProgressBar(max_value=total)
+    bar.start()
+    bar.update(done, force=True)
+    update_live_metrics(done, total, force=True)
+
+    for k, item in enumerate(iterable, 1):
+        bar.update(done + k)
+        update_live_metrics(done + k, total)
+        yield item
+
+    bar.finish()
+
+
+# Render given tasks with the COMPOSITE_ENGINE and yield each avatar's encode record once its image is written into
+# 'image_sink': (index, encode time in seconds, bytes, SHA-1 of the file)
+# With a 'json_sink', each token's JSON metadata is written right after its image
+def iter_render(tasks, image_sink, zfill_count, json_sink=None):
+
+    # The failing avatar is always reported, so the job can be stopped with a meaningful message
+    def render_error(idx, e):
+        return RuntimeError("Failed to render avatar %s (%s): %s: %s" % \
+                            (idx, get_img_name(idx, zfill_count), type(e).__name__, str(e)))
+
+    # Encode an avatar with the IMAGE_ENCODER and write its files. Return its encode record
+    # The hash of the file finds the avatars with pixel-identical images (see get_render_report)
+    def write_avatar(idx, img, attributes):
+        init_time = time.perf_counter()
+        data = encode_image(img)
+        seconds = time.perf_counter() - init_time
+        add_time('render.encode', seconds)
+
+        with measure('render.write'):
+            write_file(image_sink, get_img_name(idx, zfill_count), data, idx)
+            if json_sink is not None:
+                write_token_json(json_sink, idx, attributes, zfill_count)
+
+        add_counters({'render.tokens': 1, 'render.bytes': len(data)})
+
+        return idx, seconds, len(data), hashlib.sha1(data).hexdigest()
+
+    if COMPOSITE_ENGINE == 'pil':
+        for idx, trait_paths, attributes in tasks:
+            try:
+                with measure('render.composite'):
+                    img = composite_layers(trait_paths)
+                record = write_avatar(idx, img, attributes)
+            except Exception as e:
+                raise render_error(idx, e)
+
+            yield record
+
+    elif COMPOSITE_ENGINE == 'numpy':
+        for start in range(0, len(tasks), COMPOSITE_BATCH):
+            batch = tasks[start:start + COMPOSITE_BATCH]
+
+            try:
+                init_time = time.perf_counter()
+                out, mode = composite_batch([trait_paths for _, trait_paths, _ in batch])
+                add_time('render.composite', time.perf_counter() - init_time, len(batch))
+
+            except Exception:
+                # Composite the batch avatar by avatar to find the one failing
+                for idx, trait_paths, _ in batch:
+                    try:
+                        composite_batch([trait_paths])
+                    except Exception as e:
+                        raise render_error(idx, e)
+                raise
+
+            # Only encoding is left to PIL
+            for i, (idx, _, attributes) in enumerate(batch):
+                try:
+                    record = write_avatar(idx, to_image(out[i], mode), attributes)
+                except Exception as e:
+                    raise render_error(idx, e)
+
+                yield record
+
+    else:
+        raise ValueError("COMPOSITE_ENGINE is invalid: expected 'pil' or 'numpy'")
+
+
+# Render given avatars' tasks, one after another. 'done' avatars were already rendered by a previous job
+# With a 'profile_path', the render loop is profiled and its statistics saved there (see PROFILE_RENDER)
+# Each avatar's encode record (see iter_render) is added to 'records' as soon as it's written, so the caller keeps them
+# even if the job is interrupted. Return them all, and the occlusion statistics
+def render_images(tasks, image_sink, zfill_count, done=0, json_sink=None, profile_path=None, records=None):
+
+    pop_occlusion_stats()
+    pop_cache_counters()
+    profiler = start_profiler() if profile_path is not None else None
+
+    records = [] if records is None else records
+    records.extend(track_progress(iter_render(tasks, image_sink, zfill_count, json_sink), done + len(tasks), done))
+
+    if profiler is not None:
+        save_profile(profiler, profile_path)
+    occlusion = pop_occlusion_stats()
+    add_counters(pop_cache_counters())
+
+    # Inform how well the decoded layers and partial composites have been re-used, and how many layers were hidden
+    print_render_cache_stats()
+    print_occlusion_stats(occlusion)
+
+    return records, occlusion
+
+
+# Get the sink a worker process writes into: the folder sink itself, or a collector of the files for the parent process
+# Sinks are given as (kind, folder) specs, or None
+def get_worker_sink(spec):
+
+    if spec is None:
+        return None
+
+    kind, folder = spec
+    return open_sink(kind, folder) if is_shared_sink(kind) else new_memory_sink()
+
+
+# Render a chunk of avatars within a worker process of the render pool
+# With a 'profile_path', the chunk is profiled and its statistics saved there (see PROFILE_RENDER)
+def render_chunk(chunk, image_spec, zfill_count, json_spec=None, profile_path=None):
+
+    image_sink = get_worker_sink(image_spec)
+    json_sink = get_worker_sink(json_spec)
+
+    # Each worker process keeps its own decoded layers cache
+    # A failure is raised with the failing avatar. The parent process stops the whole job
+    # Only the chunk's own statistics and metrics are sent back (not the ones a new worker inherits from its parent)
+    pop_occlusion_stats()
+    pop_cache_counters()
+    pop_metrics()
+    profiler = start_profiler() if profile_path is not None else None
+
+    records = list(iter_render(chunk, image_sink, zfill_count, json_sink))
+
+    if profiler is not None:
+        save_profile(profiler, profile_path)
+    add_counters(pop_cache_counters())
+
+    # Files for sinks with a single writer are sent back to the parent process
+    files = [sink['files'] if sink is not None and sink['kind'] == 'memory' else [] for sink in (image_sink, json_sink)]
+
+    # Return the rendered avatars' encode records, their files (if any), the chunk's occlusion statistics, the
+    # worker's cache statistics so far and the chunk's metrics
+    return os.getpid(), records, files, pop_occlusion_stats(), get_render_cache_stats(), pop_metrics()
+
+
+# Get the pool of RENDER_WORKERS processes. It's started on first use and kept for the next editions
+def get_render_pool():
+
+    global RENDER_POOL
+
+    if RENDER_POOL is None:
+        RENDER_POOL = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+
+    return RENDER_POOL
+
+
+# Stop the render worker processes. Pending chunks are cancelled if 'wait' is False
+def close_render_pool(wait=True):
+
+    global RENDER_POOL
+
+    if RENDER_POOL is not None:
+        RENDER_POOL.shutdown(wait=wait, cancel_futures=not wait)
+        RENDER_POOL = None
+
+
+# Render given avatars' tasks spreading them over RENDER_WORKERS processes. 'done' avatars were already rendered
+# With a 'profile_path', all workers are profiled and their statistics saved there together (see PROFILE_RENDER)
+# Encode records are added to 'records' as soon as their chunk is done (see render_images). Return them all, and the
+# occlusion statistics
+def render_images_in_pool(tasks, image_sink, zfill_count, done=0, json_sink=None, profile_path=None, records=None):
+
+    # Traits' PNG paths are resolved in the tasks, so workers don't depend on this process' globals
+    # Avatars are sent in render order, so each chunk shares bottom layers as much as possible
+
+    # Small chunks keep all workers busy until the end, yet avoid the overhead of one task per avatar
+    chunk_size = max(1, min(256, math.ceil(len(tasks) / (RENDER_WORKERS * 8))))
+    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+
+    # Latest cache statistics reported by each worker process, and the occlusion statistics of each chunk
+    workers_stats = {}
+    occlusion_stats = []
+
+    # Each chunk is profiled on its own: the profiles are gathered once all of them are rendered
+    profile_paths = [None] * len(chunks) if profile_path is None else \
+        ['%s.%i' % (profile_path, k) for k in range(len(chunks))]
+
+    # Yield each rendered avatar as soon as its chunk is completed, so one progress bar follows all workers
+    # Files sent back by the workers are written into their sinks here, by this single process
+    def iter_rendered(futures):
+        for future in as_completed(futures):
+            pid, records, files, occlusion, stats, metrics = future.result()
+            workers_stats[pid] = stats
+            occlusion_stats.append(occlusion)
+            add_metrics(metrics)
+
+            for sink, sink_files in zip((image_sink, json_sink), files):
+                for name, data, idx in sink_files:
+                    write_file(sink, name, data, idx)
+
+            for record in records:
+                yield record
+
+    # Workers open their own (folder) sinks: open files can't be shared between processes
+    specs = [None if sink is None else (sink['kind'], sink['folder']) for sink in (image_sink, json_sink)]
+
+    executor = get_render_pool()
+    try:
+        futures = [
+            executor.submit(render_chunk, chunk, specs[0], zfill_count, specs[1], chunk_profile_path) \
+                for chunk, chunk_profile_path in zip(chunks, profile_paths)
+        ]
+        records = [] if records is None else records
+        records.extend(track_progress(iter_rendered(futures), done + len(tasks), done))
+
+    except BaseException:
+        # A failure in any worker (or a broken pool) stops the job without waiting for pending chunks
+        close_render_pool(wait=False)
+        raise
+
+    if profile_path is not None:
+        merge_profiles(profile_paths, profile_path)
+
+    # Inform how well the decoded layers and partial composites have been re-used across all workers
+    print_render_cache_stats(merge_render_cache_stats(workers_stats.values()))
+    occlusion = merge_occlusion_stats(occlusion_stats)
+    print_occlusion_stats(occlusion)
+
+    return records, occlusion
+
+
+# Get the filename of a shard's own copy of an edition file (e.g. its encode records): 'name-shard-i-of-N.ext'
+def get_shard_filename(filename, shard=None):
+
+    if shard is None:
+        return filename
+
+    name, extension = os.path.splitext(filename)
+    return '%s-shard-%i-of-%i%s' % (name, shard[0], shard[1], extension)
+
+
+# Get the render report of an edition from its avatars' encode records, the occlusion statistics and its runs' metrics:
+#   'occlusion':            layers skipped or clipped because layers above them hid them (see render_cache.get_paste_boxes)
+#   'visual_collisions':    groups of avatars whose images are pixel-identical despite their different traits
+#   'runs':                 the metrics of each job that rendered the edition (see metrics.py), plus what it rendered
+def get_render_report(rarity_table, stats, occlusion, runs):
+
+    return {
+        'count': int(stats.shape[0]),
+        'occlusion': occlusion,
+        'visual_collisions': [
+            {'ids': ids, 'traits': [rarity_table.loc[idx].to_dict() for idx in ids]} for ids in get_visual_collisions(stats)
+        ],
+        'runs': runs
+    }
+
+
+# Inform about the visual collisions of a render report, among 'total' avatars (the edition's or the shard's)
+def print_visual_collisions(report, total):
+
+    # Only the avatars with an encode record have been compared
+    if report['count'] < total:
+        print("Visual collisions were only checked among %i of the %i avatars: the others have no encode records." % (report['count'], total))
+
+    collisions = report['visual_collisions']
+    if not collisions:
+        print("No visual collisions: %s image is unique." % ("every avatar's" if report['count'] >= total else "every checked avatar's"))
+        return
+
+    print("Visual collisions: %i groups of avatars have pixel-identical images despite their different traits." % len(collisions))
+    for collision in collisions[:5]:
+        print("...avatars %s" % ', '.join(str(idx) for idx in collision['ids']))
+    print("Their traits differ in layers that end up hidden (or look the same). See '%s' for all of them." % REPORT_FILE)
+
+
+# Get the encode records of rendered avatars (token ids) missing from an edition's records (e.g. after a killed job)
+# They're rebuilt from their image files in a folder sink: (id, seconds, bytes, SHA-1). Only the encode time is unknown
+def rebuild_encode_records(edition_path, ids, image_sink, zfill_count, filename=ENCODE_STATS_FILE):
+
+    stats = load_encode_stats(edition_path, [filename])
+    known = set() if stats is None else set(stats.index)
+
+    records = []
+    for idx in ids:
+        if idx not in known:
+            with open(get_file_path(image_sink, get_img_name(idx, zfill_count)), 'rb') as f:
+                data = f.read()
+            records.append((idx, float('nan'), len(data), hashlib.sha1(data).hexdigest()))
+
+    if records:
+        print("...the encode records of %i of them were missing: rebuilt from their images." % len(records))
+
+    return records
+
+
+# Save the encode records of a render job over an edition (or shard), and its render report with the job's metrics
+# 'status' is 'complete', or 'interrupted' if the job was stopped midway: its records and metrics are kept for a resume
+# Return the render report
+def save_render_job(edition_path, rarity_table, shard, resume, records, occlusion, status):
+
+    # Record how long each avatar took to encode and its file size
+    print_encode_stats(records)
+    stats = save_encode_stats(edition_path, records, get_shard_filename(ENCODE_STATS_FILE, shard))
+
+    # This job's metrics: everything measured since the previous report (the setup comes with a process' first edition)
+    run = {
+        'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'status': status,
+        'resumed': resume,
+        'shard': None if shard is None else list(shard),
+        'rendered': len(records)
+    }
+    run.update(pop_metrics())
+    print_metrics(run)
+
+    # A resumed job adds up to the occlusion statistics of the previous ones, and to their runs
+    previous = load_render_report(edition_path, get_shard_filename(REPORT_FILE, shard)) if resume else None
+    runs = [run]
+    if previous is not None:
+        occlusion = merge_occlusion_stats([previous['occlusion'], occlusion])
+        runs = previous.get('runs', []) + runs
+
+    report = get_render_report(rarity_table, stats, occlusion, runs)
+    save_render_report(edition_path, report, get_shard_filename(REPORT_FILE, shard))
+
+    return report
+
+
 # Generate the image set
-def generate_images(edition, count):
+# With 'resume', the avatars of a previous (interrupted) job are completed instead. 'count' is then taken from its checkpoint
+# With 'shard' = (i, N), only the i-th of N slices of token ids is rendered (see merge_shards)
+# With 'metadata', each token's JSON metadata is written along with its image, as metadata.py would do (FUSED_METADATA by default)
+def generate_images(edition, count, resume=False, shard=None, metadata=None):
 
     # Define output path to output/edition {edition_num}
-    op_path = os.path.join('output', 'edition ' + str(edition), IMGS_DIR)
+    edition_path = os.path.join('output', 'edition ' + str(edition))
+    if not os.path.exists(edition_path):
+        os.makedirs(edition_path)
 
-    # Create output directory if it doesn't exist
-    if not os.path.exists(op_path):
-        os.makedirs(op_path)
+    # Without LIVE_METRICS, there's no live metrics file to keep up to date
+    if LIVE_METRICS:
+        start_live_metrics(os.path.join(edition_path, get_shard_filename(LIVE_METRICS_FILE, shard)),
+                           edition=str(edition), shard=None if shard is None else list(shard), resumed=resume)
 
-    # Generate a table with exact 'count' rows, distinct and valid avatar imgs.
-    # No further depuration is required
-    rarity_table = generate_exact_imgs_table(count)
+    try:
+        rarity_table = generate_edition_images(edition, edition_path, count, resume, shard, metadata)
 
-    # Adjust the number of expected images if complete required table generation fails 
-    if rarity_table.shape[0] < count:
-            count = rarity_table.shape[0]
+    except BaseException:
+        stop_live_metrics('failed')
+        raise
 
-    # Will require this to name final images as 000, 001,...
-    # later on, these zeros will be removed if Zeroes Padding is set to False
-    zfill_count = len(str(count - 1))
+    stop_live_metrics('complete')
 
-    print("Generating %s images..." % count)
+    return rarity_table
 
-    # Loop the table (dataframe)
-    iter_rows = rarity_table.iterrows()
-    for _ in progressbar(range(rarity_table.shape[0])):
 
-        # Get next row with data and extract the depurated traits
-        row = next(iter_rows)
-        trait_set = list(row[1])
+# Generate the image set of an edition into its folder (see generate_images)
+def generate_edition_images(edition, edition_path, count, resume, shard, metadata):
 
-        # Get the corresponding PNG paths of traits
-        trait_paths = generate_paths_set_from_traits(trait_set)
+    # The JSON metadata goes into its own sink, as metadata.py does
+    with_metadata = FUSED_METADATA if metadata is None else metadata
 
-        # Generate next image filename
-        img_name = str(row[0]).zfill(zfill_count) + '.png'
-        
-        # Generate the actual image
-        generate_single_image(trait_paths, os.path.join(op_path, img_name))
+    # Images can't go into a sink of JSON text: fail before sampling anything
+    check_images_sink(IMAGES_SINK)
+
+    # Shards are gathered by copying their files into one place: only folder sinks can be gathered this way
+    if shard is not None:
+        for kind in [IMAGES_SINK] + ([METADATA_SINK] if with_metadata else []):
+            if not is_shared_sink(kind):
+                raise ValueError("Sink '%s' can't be split into shards. Use the 'flat' or 'sharded' sink" % kind)
+
+    if resume:
+        # Render the very same avatars as the interrupted job
+        manifest = load_manifest(edition_path)
+        rarity_table = load_traits(edition_path)
+        zfill_count = manifest['zfill_count']
+
+    else:
+        # Generate a table with exact 'count' rows, distinct and valid avatar imgs.
+        # No further depuration is required
+        with measure('sampling'):
+            rarity_table = generate_exact_imgs_table(count)
+
+        # Adjust the number of expected images if complete required table generation fails 
+        if rarity_table.shape[0] < count:
+                count = rarity_table.shape[0]
+
+        # Will require this to name final images as 000, 001,... (unless ZEROS_PAD is set to False)
+        zfill_count = len(str(count - 1))
+
+        # Persist the trait table and what the edition is made of before rendering anything
+        manifest = {
+            'edition': str(edition),
+            'count': int(rarity_table.shape[0]),
+            'layers': [layer['name'] for layer in CONFIG],
+            'imgs_dir': IMGS_DIR,
+            'zfill_count': zfill_count,
+            'zeros_pad': ZEROS_PAD,
+            'image_encoder': IMAGE_ENCODER,
+            'images_sink': IMAGES_SINK,
+            'metadata_sink': METADATA_SINK if with_metadata else None,
+            'seed': SEED_SEQUENCE.entropy,
+            'weights_seed': WEIGHTS_SEED,
+            'status': 'rendering',
+            'assets': get_asset_hashes()
+        }
+        save_checkpoint(edition_path, rarity_table, manifest)
+
+    count = rarity_table.shape[0]
+
+    # Inform how the restrictions (and the sampling mode) shifted the rarities
+    print_trait_frequencies(rarity_table)
+
+    # A shard only renders its slice of token ids. Token ids are the table's row numbers
+    if shard is not None:
+        ids = get_shard_ids(count, *shard)
+        rarity_table_to_render = rarity_table.iloc[ids.start:ids.stop]
+        print("Shard %i of %i: token ids from %i to %i." % (shard[0], shard[1], ids.start, ids.stop - 1))
+    else:
+        rarity_table_to_render = rarity_table
+
+    # Each shard keeps its own encode records (and report). A new job doesn't keep the ones of an edition it replaces
+    stats_filename = get_shard_filename(ENCODE_STATS_FILE, shard)
+    if not resume and os.path.isfile(os.path.join(edition_path, stats_filename)):
+        os.remove(os.path.join(edition_path, stats_filename))
+
+    # Archive and NDJSON sinks are written from scratch: a resumed job only skips avatars in folder sinks
+    image_sink = open_sink(IMAGES_SINK, os.path.join(edition_path, IMGS_DIR), count, resume)
+    json_sink = open_sink(METADATA_SINK, os.path.join(edition_path, JSON_DIR), count, resume) if with_metadata else None
 
-    if not ZEROS_PAD:
-        # Remove the zeros at the left of the PNG new avatar filename
-        # Some tools like Lighthouse require to remove the zeros padding
+    # Encode records of this job, added as avatars are written: an interrupted job still saves them
+    records = []
+    total = rarity_table_to_render.shape[0]
 
-        for filename in os.listdir(op_path):
-            if filename.startswith('0'):
+    try:
+        # Only the avatars whose image is missing or corrupt are rendered when resuming
+        tasks = get_render_tasks(rarity_table_to_render, image_sink, zfill_count, resume, json_sink)
+        done = total - len(tasks)
 
-                # Remove the '0's padding of all PNG avatars...
-                new_filename = filename.lstrip('0')
+        if resume:
+            print("%i of %i images are already rendered and verified. Generating the remaining %i images..." % (done, total, len(tasks)))
 
-                # ...except the '0.png' filename
-                if new_filename == '.png':
-                    new_filename = '0' + new_filename
+            # A killed job didn't save the encode records of its avatars: they're rebuilt from their images
+            pending = set(idx for idx, _, _ in tasks)
+            rendered_ids = [idx for idx in rarity_table_to_render.index if idx not in pending]
+            save_encode_stats(edition_path, rebuild_encode_records(edition_path, rendered_ids, image_sink, zfill_count, stats_filename), stats_filename)
+        else:
+            print("Generating %s images..." % total)
 
-                # Rename the filenames
-                os.rename(os.path.join(op_path, filename), os.path.join(op_path, new_filename))
+        # Render all avatars, either one after another or spread over RENDER_WORKERS processes
+        # With PROFILE_RENDER, the render loop is profiled (all processes together)
+        profile_path = os.path.join(edition_path, get_shard_filename(PROFILE_FILE, shard)) if PROFILE_RENDER else None
+
+        with measure('render'):
+            if RENDER_WORKERS > 1:
+                _, occlusion = render_images_in_pool(tasks, image_sink, zfill_count, done, json_sink, profile_path, records)
+            else:
+                _, occlusion = render_images(tasks, image_sink, zfill_count, done, json_sink, profile_path, records)
+
+    except BaseException:
+        # The avatars rendered so far and this job's metrics are kept for a resume (workers' occlusion stats are lost)
+        close_sink(image_sink)
+        if json_sink is not None:
+            close_sink(json_sink)
+        save_render_job(edition_path, rarity_table, shard, resume, records, pop_occlusion_stats(), 'interrupted')
+        print("Render job interrupted: the records of its %i avatars and its metrics are saved for a resume." % len(records))
+        raise
+
+    close_sink(image_sink)
+    if json_sink is not None:
+        close_sink(json_sink)
+
+    if profile_path is not None:
+        print_profile(profile_path)
+
+    report = save_render_job(edition_path, rarity_table, shard, resume, records, occlusion, 'complete')
+    print_visual_collisions(report, total)
+
+    # Shards are completed by merge_shards, once all of them are gathered in one place
+    if shard is not None:
+        save_shard_record(edition_path, {
+            'shard': shard[0],
+            'shards': shard[1],
+            'ids': [ids.start, ids.stop],
+            'traits_sha256': get_traits_hash(edition_path)
+        })
+        return rarity_table
+
+    # All avatars are rendered: a later resume has nothing left to do
+    manifest['status'] = 'complete'
+    save_manifest(edition_path, manifest)
 
     return rarity_table
 
 
+# Check that the shards of an edition, gathered into its folder, cover every token id exactly once
+# Then complete the edition as a single job would do. Return the rarity table, or None if the check fails
+def merge_shards(edition):
+
+    edition_path = os.path.join('output', 'edition ' + str(edition))
+
+    manifest = load_manifest(edition_path)
+    if manifest is None:
+        print("Edition '%s' has no render manifest. Nothing to merge." % edition)
+        return None
+
+    image_sink = open_sink(manifest.get('images_sink', 'flat'), os.path.join(edition_path, manifest['imgs_dir']))
+
+    records = load_shard_records(edition_path)
+    traits_hash = get_traits_hash(edition_path)
+    count = manifest['count']
+
+    errors = []
+
+    # All shards must come from this very trait table
+    for record in records:
+        if record['traits_sha256'] != traits_hash:
+            errors.append("Shard %i of %i was rendered from a different trait table." % (record['shard'], record['shards']))
+
+    # Every token id must be covered exactly once
+    covered = np.zeros(count, dtype=np.int64)
+    for record in records:
+        covered[record['ids'][0]:record['ids'][1]] += 1
+
+    missing = np.flatnonzero(covered == 0)
+    duplicated = np.flatnonzero(covered > 1)
+    if missing.size:
+        errors.append("%i token ids are not covered by any shard. First ones: %s" % (missing.size, missing[:10].tolist()))
+    if duplicated.size:
+        errors.append("%i token ids are covered by several shards. First ones: %s" % (duplicated.size, duplicated[:10].tolist()))
+
+    # Every image must be there, and verify
+    if not errors:
+        broken = [idx for idx in range(count) if not is_rendered(idx, image_sink, manifest['zfill_count'])]
+        if broken:
+            errors.append("%i images are missing or corrupt. First ones: %s" % (len(broken), broken[:10]))
+
+    print("Merging %i shards of edition '%s' (%i avatars)..." % (len(records), edition, count))
+    if errors:
+        for error in errors:
+            print("..." + error)
+        print("Merge failed! Re-run the shards involved (with the same trait table) and merge again.")
+        return None
+
+    print("...all %i token ids are covered exactly once and all images verify." % count)
+
+    # Visual collisions may involve avatars of different shards: the edition's report is made from all shards' records
+    rarity_table = load_traits(edition_path)
+    shards = [(record['shard'], record['shards']) for record in records]
+    stats = load_encode_stats(edition_path, [get_shard_filename(ENCODE_STATS_FILE, shard) for shard in shards])
+    if stats is not None:
+        reports = [load_render_report(edition_path, get_shard_filename(REPORT_FILE, shard)) for shard in shards]
+        occlusion = merge_occlusion_stats(report['occlusion'] for report in reports if report is not None)
+        runs = [run for report in reports if report is not None for run in report.get('runs', [])]
+
+        report = get_render_report(rarity_table, stats, occlusion, runs)
+        save_render_report(edition_path, report)
+        print_visual_collisions(report, count)
+
+    manifest['status'] = 'complete'
+    save_manifest(edition_path, manifest)
+
+    return rarity_table
+
+
+# Get how long rendering all 'count' avatars of an edition took, from the runs of its render report
+# Re-renders are left out. None if the runs don't cover every avatar (or their times weren't measured)
+def get_full_render_seconds(report, count):
+
+    runs = [run for run in report.get('runs', []) if not run.get('rerender')] if report is not None else []
+    if sum(run['rendered'] for run in runs) < count or not all('render' in run.get('stages', {}) for run in runs):
+        return None
+
+    return sum(run['stages']['render']['seconds'] for run in runs)
+
+
+# Re-render the avatars of a complete edition that have a trait whose PNG changed since (e.g. an artist fixed it)
+# Token ids and traits are kept: only their images are composited again, over the previous ones. The JSON metadata is
+# left as is, since it only depends on the traits. Return the ids of the re-rendered avatars, or None if it can't be done
+def rerender_edition(edition):
+
+    edition_path = os.path.join('output', 'edition ' + str(edition))
+
+    manifest = load_manifest(edition_path)
+    if manifest is None or manifest['status'] != 'complete':
+        print("Edition '%s' has no complete render. Render it (or resume it) first." % edition)
+        return None
+
+    if 'assets' not in manifest:
+        print("Edition '%s' was rendered before the traits' hashes were recorded: there's no telling what changed since." % edition)
+        return None
+
+    errors = []
+    if manifest['layers'] != [layer['name'] for layer in CONFIG]:
+        errors.append("Its layers don't match CONFIG anymore.")
+    if not is_shared_sink(manifest['images_sink']):
+        errors.append("Its images are in a '%s' archive, which can't be partly re-written." % manifest['images_sink'])
+    if manifest['image_encoder'] != IMAGE_ENCODER or manifest['zeros_pad'] != ZEROS_PAD:
+        errors.append("IMAGE_ENCODER or ZEROS_PAD (in config.py) changed since: the new images wouldn't replace the previous ones.")
+
+    # Traits and token ids are the ones the edition's metadata was made from
+    rarity_table = load_traits(edition_path, 'metadata.csv')
+    count = rarity_table.shape[0]
+
+    # Avatars with any changed trait, in any layer
+    changed = get_changed_traits(manifest['assets'])
+    affected = np.zeros(count, dtype=bool)
+    for name, traits in changed.items():
+        if name in rarity_table.columns:
+            affected |= rarity_table[name].isin(traits).to_numpy()
+
+    # Re-styled trait names to PNG filenames, as parse_config does (rarity weights aren't needed)
+    for layer in CONFIG:
+        trait_file[layer['name']] = get_trait_files(layer)
+
+    # Traits gone from the assets can't be rendered again
+    for name, traits in changed.items():
+        gone = sorted(trait for trait in traits if trait not in trait_file.get(name, {}) and (rarity_table[name] == trait).any())
+        if gone:
+            errors.append("Traits '%s' of layer '%s' are used by the edition, but their PNGs are gone." % ("', '".join(gone), name))
+
+    if errors:
+        print("Edition '%s' can't be re-rendered:" % edition)
+        for error in errors:
+            print("..." + error)
+        return None
+
+    # From now on, the edition is compared with the current traits
+    manifest['assets'] = get_asset_hashes()
+
+    if not affected.any():
+        save_manifest(edition_path, manifest)
+        print("None of the traits of edition '%s' has changed since it was rendered. There's nothing to re-render." % edition)
+        return []
+
+    for name, traits in changed.items():
+        if traits:
+            print("Changed traits of layer '%s': '%s'." % (name, "', '".join(sorted(traits))))
+
+    # Decoded traits are mapped from the asset pack, which must have the changed traits' new pixels
+    if ASSET_PACK:
+        with measure('setup.asset_pack'):
+            update_asset_pack()
+
+    rarity_table_to_render = rarity_table[affected]
+    print("Re-rendering %i of the %i images of edition '%s'..." % (rarity_table_to_render.shape[0], count, edition))
+
+    image_sink = open_sink(manifest['images_sink'], os.path.join(edition_path, manifest['imgs_dir']))
+    zfill_count = manifest['zfill_count']
+
+    init_time = time.perf_counter()
+    try:
+        tasks = get_render_tasks(rarity_table_to_render)
+        with measure('render'):
+            if RENDER_WORKERS > 1:
+                records, occlusion = render_images_in_pool(tasks, image_sink, zfill_count)
+            else:
+                records, occlusion = render_images(tasks, image_sink, zfill_count)
+
+    finally:
+        close_sink(image_sink)
+
+    seconds = time.perf_counter() - init_time
+
+    # The re-rendered avatars' encode records replace their previous ones (the shards' ones too, if it was sharded)
+    print_encode_stats(records)
+    save_encode_stats(edition_path, records)
+    shards = [(record['shard'], record['shards']) for record in load_shard_records(edition_path)]
+    stats = load_encode_stats(edition_path, [get_shard_filename(ENCODE_STATS_FILE, shard) for shard in shards] + [ENCODE_STATS_FILE])
+
+    # Time saved compared with rendering the whole edition again: as long as it took, or as estimated from this job
+    previous = load_render_report(edition_path)
+    full_seconds = get_full_render_seconds(previous, count)
+    estimated = full_seconds is None
+    if estimated:
+        full_seconds = seconds * count / len(records)
+
+    run = {
+        'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'resumed': False,
+        'shard': None,
+        'rendered': len(records),
+        'rerender': True,
+        'changed_traits': {name: sorted(traits) for name, traits in changed.items() if traits},
+        'full_render_seconds': full_seconds,
+        'saved_seconds': full_seconds - seconds
+    }
+    run.update(pop_metrics())
+    print_metrics(run)
+
+    # Occlusion statistics stay the ones of the whole edition: the re-rendered avatars are already counted in them
+    if previous is not None:
+        occlusion = previous['occlusion']
+    runs = (previous.get('runs', []) if previous is not None else []) + [run]
+
+    report = get_render_report(rarity_table, stats, occlusion, runs)
+    save_render_report(edition_path, report)
+    print_visual_collisions(report, count)
+
+    save_manifest(edition_path, manifest)
+
+    print("Re-rendered %i of %i avatars in %s seconds. A full render %s %s seconds: %s seconds saved." % (
+        len(records),
+        count,
+        "{:.2f}".format(seconds),
+        "would take about" if estimated else "took",
+        "{:.2f}".format(full_seconds),
+        "{:.2f}".format(full_seconds - seconds)
+    ))
+
+    return [int(idx) for idx in rarity_table_to_render.index]
+
+
 # New CSVs require user to be alerted
 def manage_new_CSVs(new_csvs):
 
@@ -558,40 +1505,121 @@ def manage_new_CSVs(new_csvs):
     print("You may wish to edit them before continue with the avatars creation.")
     print()
 
-    # Get a response from user
-    while True:
-        resp = input("Despite the advice, do you want to continue? (Y/N)")
-        if resp.lower() == 'y':
-            break # user decided to keep with the task
-
-        elif resp.lower() == 'n':
-            print("Execution aborted!")
-            quit()
+    # Get a response from user (or follow the 'new_csvs' warning policy)
+    confirm_continue('new_csvs', "Despite the advice, do you want to continue? (Y/N)")
         
 
-# Main function. Point of entry
-def main():
+# Parse a '--shard' argument: 'i/N' stands for the i-th (from 0) of N shards
+def parse_shard_arg(value):
+
+    try:
+        shard, shards = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not a valid shard. Expected 'i/N', e.g. '0/4'" % value)
+
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError("Shard %i/%i doesn't exist: it must be from 0 to %i" % (shard, shards, shards - 1))
+
+    return shard, shards
+
+
+# Parse the command line arguments
+def parse_args():
+
+    parser = argparse.ArgumentParser(description="Generate an edition of avatars with rarities and restrictions.")
+    parser.add_argument('--shard', type=parse_shard_arg, metavar='i/N',
+                        help="render only the i-th (from 0) of N slices of token ids, so N machines can share an edition")
+    parser.add_argument('--merge', action='store_true',
+                        help="check that the shards gathered into an edition's folder cover every token id, and complete it")
+    parser.add_argument('--rerender', action='store_true',
+                        help="re-render only the avatars of an edition that have a trait whose PNG changed since it was rendered")
+
+    return parser.parse_args()
+
+
+# Complete an edition rendered in shards. Point of entry of '--merge'
+def main_merge():
+
+    print("Which edition would you like to merge?: ")
+    edition_name = input()
+
+    rt = merge_shards(edition_name)
+    if rt is None:
+        sys.exit(1)
+
+    print("Saving metadata...")
+    rt.to_csv(os.path.join('output', 'edition ' + str(edition_name), 'metadata.csv'))
+
+    print("Task complete!")
+
+
+# Re-render the avatars of an edition whose traits changed. Point of entry of '--rerender'
+def main_rerender():
+
+    print("Which edition would you like to re-render?: ")
+    edition_name = input()
+
+    if rerender_edition(edition_name) is None:
+        sys.exit(1)
+
+    close_render_pool()
+    print("Task complete!")
+
+
+# Prepare everything the editions are made from: traits, rarity weights, restrictions and the valid space
+# It's done once per process: all editions rendered afterwards re-use it
+def setup():
 
     # Prepare traits information and rarities weights
     print("Checking assets...")
-    new_CSVs = parse_config()
+    with measure('setup.config'):
+        new_CSVs = parse_config()
 
     # Manage properly if new CSVs have been created
     manage_new_CSVs(new_CSVs)
 
+    # Decoded traits are mapped from the asset pack by all render processes
+    if ASSET_PACK:
+        with measure('setup.asset_pack'):
+            update_asset_pack()
+
     print("Checking the restriction file...")
-    parse_restrictions()
+    with measure('setup.restrictions_parse'):
+        parse_restrictions()
     print("Restrictions configuration is all good! We are now good to go!")
     print()
 
     print("Setting up RESTRICTIONS_CONFIG and looking for warnings and issues...")
-    RESTRICTIONS.update(setup_restrictions())
-
-    tot_comb = get_total_combinations()
-    print("A total of %i of distinct trait combinations has been calculated.\nNot all of them can be transformed into avatars."  % (tot_comb))
-    print("The output number will be less, and it will depend on the severity of the 'RESTRICTIONS_CONFIG' settings.")
+    with measure('setup.restrictions_setup'):
+        RESTRICTIONS.update(setup_restrictions())
+    with measure('setup.restrictions_compile'):
+        CONFLICTS.update(compile_restrictions(RESTRICTIONS, CONFIG))
+
+    with measure('setup.valid_space'):
+        VALID_SPACE.update(get_valid_space(CONFIG, CONFLICTS))
+    print("A total of %i of distinct trait combinations has been calculated.\nNot all of them can be transformed into avatars."  % (VALID_SPACE['total']))
+    print("Exactly %i of them comply with the 'RESTRICTIONS_CONFIG' settings. That's the maximum number of avatars you can create." % VALID_SPACE['count'])
+    print("A trait set drawn with the rarity weights complies with them with a probability of %s%%." % "{:.2f}".format(100 * VALID_SPACE['acceptance']))
     print()
 
+
+# Main function. Point of entry
+def main():
+
+    args = parse_args()
+
+    # Merging shards only deals with the files already rendered
+    if args.merge:
+        main_merge()
+        return
+
+    # Re-rendering only deals with an edition already rendered
+    if args.rerender:
+        main_rerender()
+        return
+
+    setup()
+
     print("How many avatars would you like to create? We will try to acomplish exactly your request.")
     print("Enter a number greater than 0: ")
     while True:
@@ -602,9 +1630,52 @@ def main():
     print("What would you like to call this edition?: ")
     edition_name = input()
 
+    # An interrupted job of this edition may be completed instead of starting over
+    resume = False
+    manifest = load_manifest(os.path.join('output', 'edition ' + str(edition_name)))
+
+    if args.shard is not None:
+
+        # Shards are gathered by copying their files: archives can't be split
+        if not is_shared_sink(IMAGES_SINK):
+            print("Rendering in shards requires IMAGES_SINK (in config.py) to be 'flat' or 'sharded'.")
+            sys.exit(1)
+
+        # All shards must render the same trait table: the edition's one if it's already here...
+        if manifest is not None:
+            if manifest['layers'] != [layer['name'] for layer in CONFIG]:
+                print("This edition's layers don't match CONFIG anymore. Its shards can't be rendered.")
+                sys.exit(1)
+            print("Rendering shard %i of %i from the trait table of this edition (%i avatars)." % (args.shard + (manifest['count'],)))
+            resume = True
+
+        # ...or a new one, which every machine only gets the same with the same master seed
+        elif SEED is None:
+            print("Rendering in shards requires a master seed (SEED in config.py), so all machines get the same trait table.")
+            print("Otherwise, copy 'traits.csv' and 'render_manifest.json' from the edition's folder of a first machine.")
+            sys.exit(1)
+
+    elif manifest is not None and manifest['status'] != 'complete':
+
+        if manifest['layers'] != [layer['name'] for layer in CONFIG]:
+            print("This edition has an unfinished render job, but its layers don't match CONFIG anymore. It can't be resumed.")
+        else:
+            print("This edition has an unfinished render job of %i avatars." % manifest['count'])
+            while True:
+                resp = input("Do you want to resume it? Otherwise, a new edition will replace it (Y/N)")
+                if resp.lower() in ('y', 'n'):
+                    resume = resp.lower() == 'y'
+                    break
+
     print("Starting task...")
     print()
-    rt = generate_images(edition_name, num_avatars)
+    rt = generate_images(edition_name, num_avatars, resume, args.shard)
+    close_render_pool()
+
+    if args.shard is not None:
+        print("Shard %i of %i complete!" % args.shard)
+        print("Gather the images and the 'shards' folder of all shards into one edition's folder, then run 'python nft.py --merge'.")
+        return
 
     print("Saving metadata...")
     rt.to_csv(os.path.join('output', 'edition ' + str(edition_name), 'metadata.csv'))
@@ -613,4 +1684,5 @@ def main():
 
 
 # Run the main function
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
\ No newline at end of file
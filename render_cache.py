@@ -0,0 +1,466 @@
+import os
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+from assetpack import get_packed_layer, get_alpha_box
+from metrics import measure
+from config import ASSETS_DIR, LAYER_CACHE_BYTES, PREFIX_CACHE_DEPTH, PREFIX_CACHE_BYTES, ASSET_PACK, OCCLUSION_TILE
+
+####################################################################################
+
+# GLOBALS
+
+# Decoded trait images, keyed by their PNG path relative to ASSETS_DIR and their mode ('crop' for the upper layers
+# cropped to their non transparent pixels, stored as (box, image): see get_upper_layer)
+# The NumPy compositing engine keeps its layers' arrays here too, so they share LAYER_CACHE_BYTES (see composite.py)
+# Kept in "least recently used" order: the first item is the next one to be released
+LAYERS = OrderedDict()
+
+# Usage statistics of the decoded layers cache
+LAYER_STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+# Partial composites: the stack of the first k layers (k <= PREFIX_CACHE_DEPTH) of an avatar
+# Keyed by the tuple of those k layers' PNG paths (None for an absent trait), in CONFIG order.
+# Since a prefix of length k is cached along with its shorter ones, the keys form a trie.
+# Kept in "least recently used" order, like LAYERS
+PREFIXES = OrderedDict()
+
+# Usage statistics of the partial composites cache. 'hits' counts the hits per prefix depth
+PREFIX_STATS = {'hits': {}, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+# Tiles of each upper layer, for the occlusion analysis (see get_paste_boxes)
+# Keyed by (PNG path, canvas size): (box, covered, opaque), the layer's box (see get_upper_layer) and two boolean arrays
+# of (rows, columns) tiles of OCCLUSION_TILE pixels: the tiles where the layer has some non transparent pixel, and the
+# ones it fully covers (all pixels opaque)
+OPACITY = {}
+
+# Statistics of the occlusion analysis: upper layers 'pasted' (whole), 'clipped' (partly hidden, only the rest pasted)
+# and 'skipped' (fully hidden), plus the pixels the analysed layers take ('pixels') and the ones left unpasted ('saved')
+OCCLUSION_STATS = {'pasted': 0, 'clipped': 0, 'skipped': 0, 'pixels': 0, 'saved': 0}
+
+# Caches' statistics already counted by pop_cache_counters
+CACHE_COUNTED = {}
+
+####################################################################################
+#
+# HELPER FUNCTIONS
+#
+#------------------------------------------------------------------------------------
+
+# Memory taken by a decoded image: one byte per pixel and band
+def image_bytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+# Private memory taken by a cached layer: an image, or a tuple of images and arrays (e.g. a cropped layer and its box)
+# Images read in place from the asset pack take none: their pages are shared
+def layer_bytes(layer):
+
+    total = 0
+    for part in (layer if type(layer) is tuple else (layer,)):
+        if isinstance(part, np.ndarray):
+            total += part.nbytes
+        elif isinstance(part, Image.Image) and not part.readonly:
+            total += image_bytes(part)
+
+    return total
+
+
+# Decode a trait PNG (relative to ASSETS_DIR) and release its file handle right away
+def decode_layer(filepath, mode=None):
+
+    with measure('render.decode'), Image.open(os.path.join(ASSETS_DIR, filepath)) as img:
+        img.load()
+        if mode is not None and img.mode != mode:
+            img = img.convert(mode)
+
+    return img
+
+
+# Keep a decoded layer in the cache, releasing the least recently used ones if needed
+def store_layer(key, layer):
+
+    LAYERS[key] = layer
+    LAYER_STATS['misses'] += 1
+    LAYER_STATS['bytes'] += layer_bytes(layer)
+
+    evict_layers()
+
+
+# Release the least recently used layers until the cache fits into LAYER_CACHE_BYTES
+def evict_layers():
+
+    # No budget means all layers are pinned in memory
+    if LAYER_CACHE_BYTES is None:
+        return
+
+    # Always keep the most recent layer, even if it alone exceeds the budget
+    while LAYER_STATS['bytes'] > LAYER_CACHE_BYTES and len(LAYERS) > 1:
+        _, layer = LAYERS.popitem(last=False)
+        LAYER_STATS['bytes'] -= layer_bytes(layer)
+        LAYER_STATS['evictions'] += 1
+
+
+# Store a partial composite and release the least recently used ones beyond PREFIX_CACHE_BYTES
+def store_prefix(key, img):
+
+    PREFIXES[key] = img
+    PREFIX_STATS['bytes'] += image_bytes(img)
+
+    while PREFIX_STATS['bytes'] > PREFIX_CACHE_BYTES and len(PREFIXES) > 1:
+        _, old_img = PREFIXES.popitem(last=False)
+        PREFIX_STATS['bytes'] -= image_bytes(old_img)
+        PREFIX_STATS['evictions'] += 1
+
+
+# ======================================================================================
+#       PUBLIC
+# ======================================================================================
+
+# Get the decoded image of a trait given its PNG path (relative to ASSETS_DIR)
+def get_layer(filepath, mode=None):
+    """
+    Images are decoded once (or mapped from the asset pack) and served from memory afterwards. The returned image is shared, so it must not be modified: use a copy if it's going to be pasted on.
+
+    'mode' converts the decoded image (e.g. 'RGBA' for layers pasted with their own alpha mask). The first layer (background) is kept in its original mode, so the final PNGs keep the same format as before.
+    """
+
+    key = (filepath, mode)
+
+    # Serve it from memory if already decoded
+    if key in LAYERS:
+        LAYERS.move_to_end(key)
+        LAYER_STATS['hits'] += 1
+        return LAYERS[key]
+
+    # Read it from the asset pack if there's an up to date one with the whole image (see assetpack.py)
+    # Otherwise, decode the PNG
+    packed = get_packed_layer(filepath, mode) if ASSET_PACK else None
+    img = packed[1] if packed is not None and packed[0] is None else decode_layer(filepath, mode)
+
+    store_layer(key, img)
+
+    return img
+
+
+# Get a layer from the decoded layers cache given its key, or make it with 'make_layer()' and keep it
+# It's charged to LAYER_CACHE_BYTES and released like the decoded layers (e.g. the NumPy engine's arrays)
+def get_cached_layer(key, make_layer):
+
+    if key in LAYERS:
+        LAYERS.move_to_end(key)
+        LAYER_STATS['hits'] += 1
+        return LAYERS[key]
+
+    layer = make_layer()
+    store_layer(key, layer)
+
+    return layer
+
+
+# Get an upper layer cropped to its non transparent pixels, given its PNG path (relative to ASSETS_DIR)
+def get_upper_layer(filepath):
+    """
+    Return (box, img): 'img' holds the 'RGBA' pixels within 'box' = (left, upper, right, lower), the bounding box of the layer's alpha. Fully transparent pixels leave the image they're pasted on untouched, so pasting 'img' (with its own alpha) at (left, upper) gives exactly the same result as pasting the whole layer. A fully transparent layer has an empty box.
+
+    Like get_layer, cropped layers are cached (taking less memory than whole ones) and shared: don't modify them.
+    """
+
+    key = (filepath, 'crop')
+
+    if key in LAYERS:
+        LAYERS.move_to_end(key)
+        LAYER_STATS['hits'] += 1
+        return LAYERS[key]
+
+    # The asset pack stores the upper layers already cropped
+    layer = get_packed_layer(filepath, 'RGBA') if ASSET_PACK else None
+    if layer is None:
+        img = decode_layer(filepath, 'RGBA')
+        box = get_alpha_box(img)
+        layer = (box, img.crop(box))
+
+    store_layer(key, layer)
+
+    return layer
+
+
+# Stack the given layers on top of another and return the resulting image
+def composite_layers(filepaths):
+    """
+    'filepaths' are the PNG paths of an avatar's layers in CONFIG order, the first one being the background. Absent traits may be given as None.
+
+    The stack of the deepest cached prefix (up to PREFIX_CACHE_DEPTH layers) is re-used, so only the layers below it are pasted. Prefixes composed along the way are cached for the next avatars. Layers hidden by opaque layers above them are skipped or clipped (see OCCLUSION_TILE). The result is the same as pasting all layers one by one.
+    """
+
+    depth = min(PREFIX_CACHE_DEPTH, len(filepaths))
+
+    # Look for the deepest prefix already composed
+    bg = None
+    start = 0
+    for k in range(depth, 0, -1):
+        key = tuple(filepaths[:k])
+        if key in PREFIXES:
+            PREFIXES.move_to_end(key)
+            PREFIX_STATS['hits'][k] = PREFIX_STATS['hits'].get(k, 0) + 1
+            bg = PREFIXES[key].copy()
+            start = k
+            break
+    else:
+        if depth:
+            PREFIX_STATS['misses'] += 1
+
+    # Layers from the prefix cache's depth on may be (partly) hidden by the layers above them: only their visible
+    # part is pasted (see get_paste_boxes). Shallower layers are pasted whole, since their composites are cached
+    boxes = None
+
+    # Stack the remaining layers on top of another
+    for i in range(start, len(filepaths)):
+        filepath = filepaths[i]
+
+        if bg is None:
+            # Treat the first layer as the background
+            # Decoded layers are shared across avatars, so paste on a copy
+            bg = get_layer(filepath).copy()
+
+        elif filepath is not None and filepath.endswith('.png'):
+            # Only the non transparent area of the layer is pasted
+            box, img = get_upper_layer(filepath)
+
+            if OCCLUSION_TILE and i >= depth:
+                if boxes is None:
+                    boxes = get_paste_boxes(filepaths, max(start, depth), bg.size)
+
+                if boxes[i] is not None and boxes[i] != box:
+                    img = img.crop((boxes[i][0] - box[0], boxes[i][1] - box[1], boxes[i][2] - box[0], boxes[i][3] - box[1]))
+                box = boxes[i]
+
+            if box is not None and box[0] < box[2]:
+                bg.paste(img, box[:2], img)
+
+        # Keep a copy of the partial composite if it's short enough to be cached
+        if i < depth:
+            store_prefix(tuple(filepaths[:i + 1]), bg.copy())
+
+    return bg
+
+
+# Get the box, the covered and the opaque tiles of an upper layer on a canvas of given size (see OPACITY)
+# A layer larger than the canvas is clipped to it: pasting its pixels beyond the canvas makes no difference
+def get_tile_masks(filepath, canvas_size):
+
+    key = (filepath, canvas_size)
+    if key not in OPACITY:
+        box, img = get_upper_layer(filepath)
+        width, height = canvas_size
+        rows, cols = -(-height // OCCLUSION_TILE), -(-width // OCCLUSION_TILE)
+
+        clipped = (box[0], box[1], min(box[2], width), min(box[3], height))
+        box = clipped if clipped[0] < clipped[2] and clipped[1] < clipped[3] else (0, 0, 0, 0)
+
+        alpha = np.zeros((rows * OCCLUSION_TILE, cols * OCCLUSION_TILE), dtype=np.uint8)
+        if box[0] < box[2]:
+            alpha[box[1]:box[3], box[0]:box[2]] = np.asarray(img.getchannel('A'))[:box[3] - box[1], :box[2] - box[0]]
+
+        # Pixels beyond the canvas (in the last row and column of tiles) don't need to be covered to hide a tile
+        outside = np.ones(alpha.shape, dtype=bool)
+        outside[:height, :width] = False
+
+        tiles = lambda arr: arr.reshape(rows, OCCLUSION_TILE, cols, OCCLUSION_TILE)
+        covered = tiles(alpha > 0).any(axis=(1, 3))
+        opaque = tiles((alpha == 255) | outside).all(axis=(1, 3))
+
+        OPACITY[key] = (box, covered, opaque)
+
+    return OPACITY[key]
+
+
+# Get where each layer of an avatar has to be pasted, given the size of the canvas
+def get_paste_boxes(filepaths, first, canvas_size, clip=True):
+    """
+    Return a list with a box (left, upper, right, lower) per layer, or None if it doesn't need to be pasted at all. Only the upper layers from 'first' on are analysed: the entries of the others are left as None.
+
+    A layer is skipped if all the tiles it covers are fully covered by opaque pixels of the layers above it: pasting them would make no difference. With 'clip', a layer that is only partly hidden is pasted within the bounding box of its visible tiles. Pasting an opaque pixel gives that pixel whatever was below, so the result is exactly the same.
+    """
+
+    boxes = [None] * len(filepaths)
+    hidden = None
+
+    # From the top layer down, gathering the tiles hidden by the layers above
+    for i in range(len(filepaths) - 1, max(first, 1) - 1, -1):
+        filepath = filepaths[i]
+        if filepath is None or not filepath.endswith('.png'):
+            continue
+
+        box, covered, opaque = get_tile_masks(filepath, canvas_size)
+
+        if box[0] < box[2]:
+            area = (box[2] - box[0]) * (box[3] - box[1])
+            visible = covered if hidden is None else covered & ~hidden
+            OCCLUSION_STATS['pixels'] += area
+
+            if not visible.any():
+                box = None
+                OCCLUSION_STATS['skipped'] += 1
+                OCCLUSION_STATS['saved'] += area
+
+            elif clip and hidden is not None and not (visible == covered).all():
+                rows, cols = np.flatnonzero(visible.any(axis=1)), np.flatnonzero(visible.any(axis=0))
+                clipped = (
+                    max(box[0], int(cols[0]) * OCCLUSION_TILE),
+                    max(box[1], int(rows[0]) * OCCLUSION_TILE),
+                    min(box[2], (int(cols[-1]) + 1) * OCCLUSION_TILE),
+                    min(box[3], (int(rows[-1]) + 1) * OCCLUSION_TILE)
+                )
+                saved = area - (clipped[2] - clipped[0]) * (clipped[3] - clipped[1])
+                if saved:
+                    box = clipped
+                    OCCLUSION_STATS['clipped'] += 1
+                    OCCLUSION_STATS['saved'] += saved
+                else:
+                    OCCLUSION_STATS['pasted'] += 1
+
+            else:
+                OCCLUSION_STATS['pasted'] += 1
+
+        boxes[i] = box
+        hidden = opaque if hidden is None else hidden | opaque
+
+    return boxes
+
+
+# Get a copy of the decoded layers and partial composites caches statistics
+def get_render_cache_stats():
+
+    layer_stats = dict(LAYER_STATS)
+    layer_stats['count'] = len(LAYERS)
+
+    prefix_stats = dict(PREFIX_STATS)
+    prefix_stats['hits'] = dict(PREFIX_STATS['hits'])
+    prefix_stats['count'] = len(PREFIXES)
+
+    return {'layers': layer_stats, 'prefixes': prefix_stats}
+
+
+# Add up the cache statistics reported by several processes (e.g. render workers)
+def merge_render_cache_stats(stats_list):
+
+    merged = {
+        'layers': {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0, 'count': 0},
+        'prefixes': {'hits': {}, 'misses': 0, 'evictions': 0, 'bytes': 0, 'count': 0}
+    }
+
+    for stats in stats_list:
+        for cache, cache_stats in stats.items():
+            for key, value in cache_stats.items():
+
+                # Prefix hits are counted per depth
+                if type(value) is dict:
+                    for depth, hits in value.items():
+                        merged[cache][key][depth] = merged[cache][key].get(depth, 0) + hits
+                else:
+                    merged[cache][key] += value
+
+    return merged
+
+
+# Print a summary of the decoded layers and partial composites caches usage
+# If no statistics are given, the ones from current process are used
+def print_render_cache_stats(stats=None):
+
+    if stats is None:
+        stats = get_render_cache_stats()
+
+    layers = stats['layers']
+    total = layers['hits'] + layers['misses']
+    print("Layer cache: %i hits, %i misses (%s%% hit rate), %i evictions. %i layers resident in %s MB." % (
+        layers['hits'],
+        layers['misses'],
+        "{:2.2f}".format(100.0 * layers['hits'] / total if total else 0.0),
+        layers['evictions'],
+        layers['count'],
+        "{:.2f}".format(layers['bytes'] / 2**20)
+    ))
+
+    prefixes = stats['prefixes']
+    if not (prefixes['hits'] or prefixes['misses']):
+        return
+
+    hits = sum(prefixes['hits'].values())
+    total = hits + prefixes['misses']
+    print("Prefix cache: %i hits, %i misses (%s%% hit rate), %i evictions. %i prefixes resident in %s MB." % (
+        hits,
+        prefixes['misses'],
+        "{:2.2f}".format(100.0 * hits / total if total else 0.0),
+        prefixes['evictions'],
+        prefixes['count'],
+        "{:.2f}".format(prefixes['bytes'] / 2**20)
+    ))
+    print("Prefix cache hits per depth (layers re-used): %s" % \
+        ', '.join("%i: %i" % (depth, prefixes['hits'][depth]) for depth in sorted(prefixes['hits'])))
+
+
+# Get the caches' hits, misses and evictions since the last call, as counters of the run metrics (see metrics.py)
+# Like the occlusion statistics, they're counted per job, while get_render_cache_stats adds up all jobs of the process
+def pop_cache_counters():
+
+    counted = {
+        'cache.layer_hits': LAYER_STATS['hits'],
+        'cache.layer_misses': LAYER_STATS['misses'],
+        'cache.layer_evictions': LAYER_STATS['evictions'],
+        'cache.prefix_hits': sum(PREFIX_STATS['hits'].values()),
+        'cache.prefix_misses': PREFIX_STATS['misses'],
+        'cache.prefix_evictions': PREFIX_STATS['evictions']
+    }
+
+    counters = {name: n - CACHE_COUNTED.get(name, 0) for name, n in counted.items()}
+    CACHE_COUNTED.update(counted)
+
+    return counters
+
+
+# Get the occlusion statistics gathered since the last call, and start counting again from zero
+# Unlike the caches' statistics, they're counted per job (e.g. per edition or per chunk of a render worker)
+def pop_occlusion_stats():
+
+    stats = dict(OCCLUSION_STATS)
+    OCCLUSION_STATS.update({'pasted': 0, 'clipped': 0, 'skipped': 0, 'pixels': 0, 'saved': 0})
+
+    return stats
+
+
+# Add up occlusion statistics (e.g. from several render workers' chunks)
+def merge_occlusion_stats(stats_list):
+
+    merged = {'pasted': 0, 'clipped': 0, 'skipped': 0, 'pixels': 0, 'saved': 0}
+    for stats in stats_list:
+        for key, value in stats.items():
+            merged[key] += value
+
+    return merged
+
+
+# Print a summary of the occlusion statistics
+def print_occlusion_stats(stats):
+
+    if not stats['pixels']:
+        return
+
+    print("Occlusion: %i hidden layers skipped, %i partly hidden layers clipped, %i pasted whole. %s%% of their pixels left unpasted." % (
+        stats['skipped'],
+        stats['clipped'],
+        stats['pasted'],
+        "{:2.2f}".format(100.0 * stats['saved'] / stats['pixels'])
+    ))
+
+
+# Release all decoded layers, partial composites and occlusion tiles
+def clear_render_cache():
+    LAYERS.clear()
+    LAYER_STATS.update({'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0})
+    PREFIXES.clear()
+    PREFIX_STATS.update({'hits': {}, 'misses': 0, 'evictions': 0, 'bytes': 0})
+    OPACITY.clear()
+    CACHE_COUNTED.clear()
+    OCCLUSION_STATS.update({'pasted': 0, 'clipped': 0, 'skipped': 0, 'pixels': 0, 'saved': 0})
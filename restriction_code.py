@@ -1,8 +1,11 @@
-import os
+import sys
 from  itertools import chain
+import numpy as np
 
 from restrictions import RESTRICTIONS_CONFIG
-from config import CONFIG, ASSETS_DIR
+from metrics import measure
+from asset_manifest import title_style, get_layer_traits
+from config import CONFIG
 
 ####################################################################################
 
@@ -11,57 +14,15 @@ from config import CONFIG, ASSETS_DIR
 # This will update with  map of current names and traits once uploaded
 NAMES = {}
 
+# What to do on each warning that asks the user whether to continue: 'ask' (the default), 'continue' or 'abort'
+# Keys are the warnings: 'collisions', 'all_none' (here), 'new_csvs' and 'low_acceptance' (nft.py)
+# Non-interactive jobs set them all, so nothing ever waits for an input (see batch.py)
+WARNING_POLICIES = {}
+
 ####################################################################################
 #
 # HELPER FUNCTIONS
 #
-#------------------------------------------------------------------------------------
-# Public Helper Funcions:
-#
-
-# Check if given filename is a valid trait
-def is_valid_trait(trait_filename, layer_path):
-
-    # traits should be a file, not a folder
-    if os.path.isdir(os.path.join(layer_path, trait_filename)):
-        return False
-
-    # not whatever file, but a PNG
-    if not trait_filename.endswith('.png'):
-        return False
-
-    # only visible ones
-    if trait_filename[0] == '.':
-        return False
-    
-    return True
-
-
-# Remove the '.png' extension from trait filenames if they have
-def fix_trait(trait):
-
-    if trait.endswith('.png'):
-        trait = trait[:-4]
-
-    # No traits should be named as "none.png" since 'none' is reserved for trait's absence
-    if trait.lower() == 'none':
-        raise ValueError("Not allowed 'none.png', 'None.png', 'NONE.png', etc. filenames for traits.")
-    
-    return trait
-
-
-# Re-style name to "A Title Style", but keep the upparcase words intact
-def title_style(name):
-    words = name.split()
-    idxs = [i for i, tr in  enumerate(words) if tr.isupper()]
-    name = name.title()
-    words = name.split()
-    for i in idxs:
-        words[i] = words[i].upper()
-    name = ' '.join(words)
-    return name
-
-
 #------------------------------------------------------------------------------------
 # Private Helper Funcions:
 #
@@ -109,20 +70,8 @@ def map_assets():
     # Loop through all layers defined in CONFIG
     for layer in CONFIG:
 
-        # Go into assets/ to look for layer folders
-        layer_path =os.path.join(ASSETS_DIR, layer['directory'])
-
-        # Get trait filenames array found in 'directory' folder
-        traits = [filename for filename in os.listdir(layer_path) if is_valid_trait(filename, layer_path)]
-
-        # Remove '.png' extensions and reject 'none.png', 'None.png', 'NONE.png', etc
-        try:
-            traits = [fix_trait(filename) for filename in traits]
-        except ValueError as e:
-            raise ValueError("%s One found in folder '%s'" % (str(e), layer_path))
-        
-        # Make traits "Title Style"
-        traits = [title_style(trait) for trait in traits]
+        # Traits ("Title Style") found in the layer's folder, from the asset manifest
+        traits = list(get_layer_traits(layer))
 
         # map in a dictionary the traits, quantity + other relevant data from CONFIG
         names_map[layer['name']] = {
@@ -135,6 +84,32 @@ def map_assets():
     return names_map
 
 
+# Decide whether to continue despite given warning, following its policy in WARNING_POLICIES
+# Asking is the default. Aborting stops the execution with an exit code of 1
+def confirm_continue(warning, question="Do you want to continue anyway? Y/N:"):
+
+    policy = WARNING_POLICIES.get(warning, 'ask')
+
+    if policy == 'continue':
+        print("Continuing anyway, as set by the '%s' warning policy." % warning)
+        return
+
+    if policy == 'ask':
+        while True:
+            r = input(question)
+            if r.lower() == 'y':
+                return
+
+            if r.lower() == 'n':
+                break
+
+    elif policy != 'abort':
+        raise ValueError("Warning policy '%s' for '%s' is invalid: expected 'ask', 'continue' or 'abort'" % (policy, warning))
+
+    print("Execution aborted!")
+    sys.exit(1)
+
+
 ####################################################################################
 #  Private:
 #------------------------------------------------------------------------------------
@@ -590,14 +565,7 @@ def get_wble_dictionaries():
 
         print("""Restriction settings still work, but they may output undesired results. Consider to split given restriction lines in order to avoid these collisions and ensure appropiate results.""")
 
-        while True:
-            r = input("Do you want to continue anyway? Y/N:")
-            if r == "Y" or r == "y":
-                break
-
-            if r == "N" or r == "n":
-                print("Execution aborted!")
-                quit()
+        confirm_continue('collisions')
 
         # Continue despite the warnings!
         print()
@@ -785,14 +753,7 @@ def check_for_all_none_issues(restr_WD):
         print("===============================")
         print("We encourage you to carefully review the RESTRICTION_CONFIG settings in restrictions.py")
         
-        while True:
-            r = input("Do you want to continue anyway? Y/N:")
-            if r == "Y" or r == "y":
-                break
-
-            if r == "N" or r == "n":
-                print("Execution aborted!")
-                quit()
+        confirm_continue('all_none')
 
         # Continue despite the warnings!
         print()
@@ -924,15 +885,76 @@ def setup_restrictions():
     return restr_WD
 
 
+# Compile the final workable dictionary into conflict matrices between layers, indexed by trait codes
+def compile_restrictions(restr_WD, layers):
+    """
+    'layers' is the CONFIG already parsed: each layer has its 'trait_names' array ('none' for the absence of a trait), and a trait code is the index of a trait within it.
+
+    Return a dictionary { (i, j): matrix } for every pair of layers i < j (in CONFIG order) with at least one restriction between them. 'matrix' is a boolean array of shape (traits of i, traits of j), where matrix[a, b] is True when trait code a of layer i and trait code b of layer j can't be together, whichever of both imposes the restriction. 'Restrict All' is folded in as all traits but 'none'.
+
+    A row of trait codes is invalid if any of its pairs is True: the very same rule as nft.is_image_invalid.
+    """
+
+    idx_of = {layer['name']: idx for idx, layer in enumerate(layers)}
+    codes_of = [{trait: code for code, trait in enumerate(layer['trait_names'])} for layer in layers]
+
+    conflicts = {}
+
+    # Loop through all restrictor name/trait pairs and their restricted names
+    for rstor_name, rstor_traits in restr_WD.items():
+        i = idx_of[rstor_name]
+
+        for rstor_trait, restricted_names in rstor_traits.items():
+
+            # Restrictor traits absent from the layer can't be in any avatar
+            if rstor_trait not in codes_of[i]:
+                continue
+            a = codes_of[i][rstor_trait]
+
+            for restricted_name, restricted_traits in restricted_names.items():
+                j = idx_of[restricted_name]
+
+                # A layer can't restrict itself: an avatar has a single trait per layer
+                if i == j:
+                    continue
+
+                # Matrices are kept for i < j only, so restrictions from a lower layer are transposed
+                key = (min(i, j), max(i, j))
+                if key not in conflicts:
+                    conflicts[key] = np.zeros((len(codes_of[key[0]]), len(codes_of[key[1]])), dtype=bool)
+                matrix = conflicts[key] if i < j else conflicts[key].T
+
+                # All traits but the absence of a trait are restricted
+                if restricted_traits['Restrict All']:
+                    matrix[a] |= layers[j]['trait_names'] != 'none'
+
+                for trait in restricted_traits['Restricted']:
+                    if trait in codes_of[j]:
+                        matrix[a, codes_of[j][trait]] = True
+
+    return conflicts
+
+
+# Check rows of trait codes against the compiled restrictions. Return a boolean array: True if the row is invalid
+def get_invalid_codes(codes, conflicts):
+
+    invalid = np.zeros(codes.shape[0], dtype=bool)
+    for (i, j), matrix in conflicts.items():
+        invalid |= matrix[codes[:, i], codes[:, j]]
+
+    return invalid
+
+
 #------------------------------------------------------------------------------------
 # End of Public Functions
 # ======================================================================================
 
 # Main function. 
 def main():
-    # Need to map PNGs traits and filenames per categories based on CONFIG
+    # Need to map PNGs traits and filenames per categories based on CONFIG (the assets are scanned once, here)
     # Update map into global and public NAMES
-    NAMES.update(map_assets())
+    with measure('setup.assets_map'):
+        NAMES.update(map_assets())
 
 
 # Run when module is imported
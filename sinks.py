@@ -0,0 +1,203 @@
+# Output sinks: where the images and the JSON metadata of an edition are written
+#
+#   'flat':     one file per token in a single folder (the original layout)
+#   'sharded':  one file per token, spread over 256 subfolders by a hash of its filename, so no folder grows too large
+#   'tar':      a single uncompressed tar archive, written as a stream
+#   'zip':      a single zip archive (stored, since PNGs are already compressed), written as a stream
+#   'ndjson':   JSON metadata only: a single file with one JSON per line, plus an index of each token's (offset, length)
+#
+# A sink is a dictionary made by open_sink and written with write_file. Files are always given their final name.
+# Folder sinks ('flat' and 'sharded') can be written by several processes at once: each file is independent and
+# written atomically. The other ones have a single writer (see is_shared_sink).
+
+import os
+import io
+import json
+import hashlib
+import tarfile
+import zipfile
+import numpy as np
+
+from checkpoint import write_atomic, remove_temp_files
+
+####################################################################################
+
+# GLOBALS
+
+SINK_KINDS = ('flat', 'sharded', 'tar', 'zip', 'ndjson')
+
+# Sinks images can be written into: NDJSON records are single lines of JSON text
+IMAGE_SINK_KINDS = ('flat', 'sharded', 'tar', 'zip')
+
+# Extensions of the file sinks, appended to the folder they replace
+SINK_EXTENSIONS = {'tar': '.tar', 'zip': '.zip', 'ndjson': '.ndjson'}
+
+# Extension of the NDJSON offset index: a NumPy (count x 2) int64 array of (offset, length), -1 for absent tokens
+NDJSON_INDEX_EXTENSION = '.index.npy'
+
+####################################################################################
+#
+# HELPER FUNCTIONS
+#
+#------------------------------------------------------------------------------------
+
+# Get the subfolder of a file within a 'sharded' sink: 2 hex digits of its filename's hash
+def get_shard_dir(name):
+    return hashlib.md5(name.encode()).hexdigest()[:2]
+
+
+# Get the fixed metadata of an archive member, so archives only depend on their content
+def get_tar_info(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = 0
+    return info
+
+
+# ======================================================================================
+#       PUBLIC
+# ======================================================================================
+
+# Get where a sink of given kind writes, in place of 'folder': the folder itself, or a file next to it
+def get_sink_path(kind, folder):
+
+    if kind not in SINK_KINDS:
+        raise ValueError("Sink '%s' is invalid: expected one of %s" % (kind, ', '.join(SINK_KINDS)))
+
+    return folder + SINK_EXTENSIONS.get(kind, '')
+
+
+# Check that a sink kind can hold images (e.g. IMAGES_SINK)
+def check_images_sink(kind):
+
+    get_sink_path(kind, '')
+    if kind not in IMAGE_SINK_KINDS:
+        raise ValueError("Sink '%s' can't hold images: expected one of %s" % (kind, ', '.join(IMAGE_SINK_KINDS)))
+
+
+# Check if a sink kind can be written by several processes at once
+def is_shared_sink(kind):
+    return kind in ('flat', 'sharded')
+
+
+# Open a sink of given kind in place of 'folder'
+def open_sink(kind, folder, count=None, resume=False):
+    """
+    'count' (the number of tokens) is required by the 'ndjson' sink, to index its records by token id.
+
+    Folder sinks keep the files already written, so a resumed job only writes the missing ones ('resume' removes the temporary files of an interrupted job). Archive and NDJSON sinks are always written from scratch.
+    """
+
+    path = get_sink_path(kind, folder)
+    sink = {'kind': kind, 'folder': folder, 'path': path}
+
+    if is_shared_sink(kind):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        if resume:
+            for dirpath, _, _ in os.walk(path):
+                remove_temp_files(dirpath)
+
+        return sink
+
+    # Single file sinks live next to the folder they replace
+    parent = os.path.dirname(path)
+    if parent and not os.path.exists(parent):
+        os.makedirs(parent)
+
+    if kind == 'tar':
+        sink['archive'] = tarfile.open(path, 'w', format=tarfile.PAX_FORMAT)
+
+    elif kind == 'zip':
+        sink['archive'] = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+
+    else:
+        if count is None:
+            raise ValueError("The 'ndjson' sink requires the number of tokens")
+
+        sink['file'] = open(path, 'wb')
+        sink['offset'] = 0
+        sink['index'] = np.full((count, 2), -1, dtype=np.int64)
+
+    return sink
+
+
+# Get the path of a file within a folder sink
+def get_file_path(sink, name):
+
+    if sink['kind'] == 'sharded':
+        return os.path.join(sink['path'], get_shard_dir(name), name)
+
+    return os.path.join(sink['path'], name)
+
+
+# Write a file (bytes) into a sink. 'idx' is the token id, required by the 'ndjson' sink
+def write_file(sink, name, data, idx=None):
+
+    kind = sink['kind']
+
+    if is_shared_sink(kind):
+        path = get_file_path(sink, name)
+
+        if kind == 'sharded' and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def write(temp_path):
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+
+        write_atomic(path, write)
+
+    elif kind == 'tar':
+        sink['archive'].addfile(get_tar_info(name, len(data)), io.BytesIO(data))
+
+    elif kind == 'zip':
+        sink['archive'].writestr(zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0)), data)
+
+    elif kind == 'ndjson':
+        if b'\n' in data:
+            raise ValueError("NDJSON records can't span several lines: '%s'" % name)
+
+        sink['file'].write(data + b'\n')
+        sink['index'][idx] = (sink['offset'], len(data))
+        sink['offset'] += len(data) + 1
+
+    # Collector of the files written by a render worker, for sinks with a single writer (see new_memory_sink)
+    else:
+        sink['files'].append((name, data, idx))
+
+
+# Get a sink that only collects the files written into it, to be written into the actual sink later
+def new_memory_sink():
+    return {'kind': 'memory', 'folder': None, 'path': None, 'files': []}
+
+
+# Close a sink. The 'ndjson' sink saves its offset index
+def close_sink(sink):
+
+    if 'archive' in sink:
+        sink['archive'].close()
+
+    elif sink['kind'] == 'ndjson':
+        sink['file'].close()
+
+        # Saved through a file object, so np.save doesn't append its extension to the temporary file
+        def write(temp_path):
+            with open(temp_path, 'wb') as f:
+                np.save(f, sink['index'])
+
+        write_atomic(sink['path'] + NDJSON_INDEX_EXTENSION, write)
+
+
+# Read the JSON metadata of a token from an NDJSON sink, through its offset index
+def read_ndjson_record(path, idx):
+
+    offset, length = np.load(path + NDJSON_INDEX_EXTENSION, mmap_mode='r')[idx]
+    if offset < 0:
+        raise KeyError("Token %i is not in '%s'" % (idx, path))
+
+    with open(path, 'rb') as f:
+        f.seek(int(offset))
+        return json.loads(f.read(int(length)))
@@ -0,0 +1,329 @@
+# Exact figures about the space of valid avatars (the trait combinations complying with RESTRICTIONS_CONFIG)
+#
+# Restrictions only relate pairs of layers, so the valid space is a product of pairwise factors:
+#
+#   valid(t_1, ..., t_n) = product over restricted pairs (i, j) of  not conflict_ij[t_i, t_j]
+#
+# Summing it over all combinations is done by variable elimination: layers are summed out one by one, only
+# multiplying the factors they're involved in. The cost depends on how entangled the restrictions are, not on the
+# total number of combinations. Counts are exact Python integers, so they never overflow.
+#
+# The same counts give a bijection between the integers 0..V-1 and the V valid combinations (ranking/unranking),
+# so distinct valid avatars can be drawn as distinct integers: no rejections and no duplicates at all.
+
+import numpy as np
+
+####################################################################################
+#
+# HELPER FUNCTIONS
+#
+#------------------------------------------------------------------------------------
+
+# Number of traits per layer
+def get_sizes(layers):
+    return [len(layer['traits']) for layer in layers]
+
+
+# Get the data type for counts: int64 if no count can overflow it, Python integers (object) otherwise
+def get_count_dtype(layers):
+
+    total = 1
+    for size in get_sizes(layers):
+        total *= size
+
+    return np.int64 if total < 2**62 else object
+
+
+# Get the factors describing the valid space: a list of (layers, array) where array's axes follow layers
+def get_factors(layers, conflicts, weighted):
+
+    # Unary factors: the rarity weights (probabilities), or a plain count of 1 per trait
+    dtype = float if weighted else get_count_dtype(layers)
+    if weighted:
+        factors = [((j,), np.asarray(layer['rarity_weights'], dtype=float)) for j, layer in enumerate(layers)]
+    else:
+        factors = [((j,), np.ones(len(layer['traits']), dtype=dtype)) for j, layer in enumerate(layers)]
+
+    # Pairwise factors: 1 if both traits can be together, 0 otherwise
+    for (i, j), matrix in conflicts.items():
+        factors.append(((i, j), (~matrix).astype(dtype)))
+
+    return factors
+
+
+# Multiply factors into a single one over the union of their layers
+# Factors' layers are always kept sorted, so their axes only need to be broadcast over the missing layers
+def multiply_factors(factors, sizes):
+
+    scope = tuple(sorted(set(j for f_layers, _ in factors for j in f_layers)))
+
+    product = None
+    for f_layers, array in factors:
+        array = array.reshape([sizes[j] if j in f_layers else 1 for j in scope])
+        product = array if product is None else product * array
+
+    return scope, product
+
+
+# Sum out all layers but the kept one. Return the resulting array over 'keep' (or a scalar if None)
+def eliminate(factors, sizes, keep=None):
+
+    factors = list(factors)
+    remaining = set(j for f_layers, _ in factors for j in f_layers) - {keep}
+
+    # Size of the factor produced when eliminating a layer
+    def cost(j):
+        scope = set(v for f_layers, _ in factors if j in f_layers for v in f_layers)
+        return np.prod([float(sizes[v]) for v in scope])
+
+    while remaining:
+
+        # Greedy order: the layer whose elimination produces the smallest factor
+        j = min(remaining, key=cost)
+        remaining.remove(j)
+
+        involved = [f for f in factors if j in f[0]]
+        factors = [f for f in factors if j not in f[0]]
+
+        scope, product = multiply_factors(involved, sizes)
+        axis = scope.index(j)
+        # Object arrays sum into plain integers when no axis is left: keep them as (0-d) arrays
+        factors.append((scope[:axis] + scope[axis + 1:], np.asarray(product.sum(axis=axis), dtype=product.dtype)))
+
+    # Only the kept layer (or scalars) is left
+    _, product = multiply_factors(factors, sizes)
+    return product
+
+
+# ======================================================================================
+#       PUBLIC
+# ======================================================================================
+
+# Get the exact number of valid trait combinations
+def count_valid_combinations(layers, conflicts):
+    return int(eliminate(get_factors(layers, conflicts, False), get_sizes(layers)))
+
+
+# Get the probability that a trait set drawn with the rarity weights is valid (the rejection sampling's acceptance rate)
+def get_acceptance_probability(layers, conflicts):
+    return float(eliminate(get_factors(layers, conflicts, True), get_sizes(layers)))
+
+
+# Get the probability of each trait within the valid avatars drawn with the rarity weights (rejection sampling)
+def get_trait_marginals(layers, conflicts):
+
+    factors = get_factors(layers, conflicts, True)
+
+    marginals = []
+    for j in range(len(layers)):
+        weights = eliminate(factors, get_sizes(layers), keep=j)
+        total = weights.sum()
+        marginals.append(weights / total if total > 0 else weights)
+
+    return marginals
+
+
+# Get all exact figures about the valid space at once
+def get_valid_space(layers, conflicts):
+    """
+    'layers' is the CONFIG already parsed (with 'traits' and normalized 'rarity_weights') and 'conflicts' its compiled restrictions (see restriction_code.compile_restrictions).
+
+    Return a dictionary with:
+        'total': number of trait combinations, ignoring restrictions
+        'count': number of valid trait combinations
+        'acceptance': probability that a trait set drawn with the rarity weights is valid
+        'marginals': per layer, the probability of each trait within the valid avatars drawn with the rarity weights
+    """
+
+    total = 1
+    for layer in layers:
+        total *= len(layer['traits'])
+
+    return {
+        'total': total,
+        'count': count_valid_combinations(layers, conflicts),
+        'acceptance': get_acceptance_probability(layers, conflicts),
+        'marginals': get_trait_marginals(layers, conflicts)
+    }
+
+
+#------------------------------------------------------------------------------------
+# Ranking and unranking of valid combinations
+#
+# Valid combinations are ranked in lexicographic order of their trait codes (layers in CONFIG order).
+# Unranking walks down the layers: at layer j, each trait covers as many ranks as valid completions it has given
+# the traits already chosen.
+#
+# Those completions come from eliminating the layers in reverse CONFIG order once and for all (bucket elimination):
+# eliminating layer k sums out its factors into a 'message' over previous layers only. The completions of trait t at
+# layer j are the product of the messages from layers after j that only depend on layers up to j, and the factors
+# between j and previous layers, evaluated on the traits already chosen. Nothing else is computed per avatar.
+#
+
+# Get a ranker: the factors needed to rank and unrank valid combinations, per layer
+def new_ranker(layers, conflicts):
+
+    sizes = get_sizes(layers)
+    ranker = {'layers': layers, 'sizes': sizes, 'count_dtype': get_count_dtype(layers)}
+
+    for weighted in (False, True):
+
+        # Place each factor in the bucket of its last layer. 'origin' tells the layer it was eliminated from
+        buckets = [[] for _ in layers]
+        for f_layers, array in get_factors(layers, conflicts, weighted):
+            buckets[f_layers[-1]].append((None, f_layers, array))
+
+        messages = []
+        for k in range(len(layers) - 1, 0, -1):
+
+            _, product = multiply_factors([(f_layers, array) for _, f_layers, array in buckets[k]], sizes)
+            scope = tuple(sorted(set(v for _, f_layers, _ in buckets[k] for v in f_layers) - {k}))
+            message = (k, scope, np.asarray(product.sum(axis=-1), dtype=product.dtype))
+
+            # Messages without layers are plain multipliers of the completions of all previous layers
+            if scope:
+                buckets[scope[-1]].append(message)
+            else:
+                messages.append(message)
+
+        # Terms of layer j: its bucket (factors with previous layers and messages from later ones),
+        # and the messages from later layers that only depend on previous ones
+        terms = []
+        for j in range(len(layers)):
+            terms.append(
+                [(f_layers, array) for _, f_layers, array in buckets[j]] + \
+                [(f_layers, array) for i in range(j) for origin, f_layers, array in buckets[i] if origin is not None and origin > j] + \
+                [(f_layers, array) for origin, f_layers, array in messages if origin > j]
+            )
+
+        ranker['weighted' if weighted else 'counts'] = terms
+
+    return ranker
+
+
+# Get the valid completions of each trait of layer j given the traits already chosen (prefix of trait codes)
+# They're counts (Python integers) or, if weighted, the sum of the rarity weights' products (probabilities)
+def get_completions(ranker, j, prefix, weighted=False):
+
+    completions = None
+    for f_layers, array in ranker['weighted' if weighted else 'counts'][j]:
+
+        # Evaluate the factor on the chosen traits, leaving layer j's axis (its last one, if present)
+        value = array[tuple(prefix[v] for v in f_layers if v < j)]
+        completions = value if completions is None else completions * value
+
+    # Broadcast a plain multiplier over the traits of layer j
+    return completions * np.ones(ranker['sizes'][j], dtype=float if weighted else ranker['count_dtype'])
+
+
+# Get the valid combination (trait codes) of given rank: an integer from 0 to V - 1
+def unrank(ranker, rank):
+
+    prefix = []
+    for j in range(len(ranker['layers'])):
+        for code, n in enumerate(get_completions(ranker, j, prefix).tolist()):
+            if rank < n:
+                break
+            rank -= n
+        else:
+            raise ValueError("Rank out of the valid combinations' range")
+
+        prefix.append(code)
+
+    return prefix
+
+
+# Get the rank of a valid combination given its trait codes
+def rank(ranker, codes):
+
+    result = 0
+    for j, code in enumerate(codes):
+        completions = get_completions(ranker, j, codes[:j])
+        if completions[code] == 0:
+            raise ValueError("Trait codes %s are not a valid combination" % list(codes))
+        result += sum(completions[:code].tolist())
+
+    return result
+
+
+# Draw a valid combination (trait codes) with the probability rejection sampling would give it, without any rejection
+def draw_weighted(ranker, rnd):
+
+    prefix = []
+    for j in range(len(ranker['layers'])):
+        weights = get_completions(ranker, j, prefix, weighted=True)
+        cum_weights = np.cumsum(weights)
+        code = int(np.searchsorted(cum_weights, rnd.random() * cum_weights[-1], side='right'))
+        prefix.append(min(code, len(weights) - 1))
+
+    return prefix
+
+
+# Draw 'count' distinct integers from range(n) but the ones in 'taken' (sorted), in random order
+def draw_free_ranks(n, count, taken, rnd):
+    """
+    Integers are drawn among the n - len(taken) free ones and then mapped to them, skipping the taken ones. Memory is proportional to 'count' (and 'taken'), never to n.
+    """
+
+    free = n - len(taken)
+
+    # A set of random integers is enough when they're few compared to the free ones (and range() can't hold huge ones)
+    if 2 * count < free:
+        drawn = set()
+        while len(drawn) < count:
+            drawn.add(rnd.randrange(free))
+    else:
+        drawn = rnd.sample(range(free), count)
+
+    ranks = []
+    k = 0
+    for x in sorted(drawn):
+
+        # The x-th free integer r satisfies r = x + (number of taken integers <= r)
+        while k < len(taken) and taken[k] <= x + k:
+            k += 1
+        ranks.append(x + k)
+
+    rnd.shuffle(ranks)
+    return ranks
+
+
+# Draw 'count' distinct valid combinations as a (count x layers) matrix of trait codes
+def draw_distinct_combinations(ranker, count, valid_count, weighted, rnd):
+    """
+    Uniform: 'count' distinct ranks are drawn out of V and unranked. Every valid combination is equally likely.
+
+    Weighted: combinations are drawn with the rarity weights (as rejection sampling would do, but without rejections) and duplicates are skipped. Once duplicates become frequent (as the requested count approaches V), the remaining ones are drawn uniformly among the ranks not taken yet. Either way, exactly 'count' distinct combinations are returned (count <= V).
+    """
+
+    if count > valid_count:
+        raise ValueError("Only %i valid combinations exist: %i distinct ones can't be drawn" % (valid_count, count))
+
+    taken = set()
+    combinations = []
+
+    if weighted:
+        draws = 0
+        while len(combinations) < count:
+
+            # Too many duplicates lately: switch to uniform among the ranks left
+            if draws >= 1000 and draws > 2 * len(combinations):
+                break
+
+            codes = tuple(draw_weighted(ranker, rnd))
+            draws += 1
+
+            if codes not in taken:
+                taken.add(codes)
+                combinations.append(codes)
+
+    # Ranks are only needed for the combinations left
+    if len(combinations) == count:
+        taken = []
+    else:
+        taken = sorted(rank(ranker, codes) for codes in taken)
+
+    for r in draw_free_ranks(valid_count, count - len(combinations), taken, rnd):
+        combinations.append(unrank(ranker, r))
+
+    return np.array(combinations, dtype=np.int32).reshape(count, len(ranker['layers']))